@@ -104,6 +104,24 @@ system_params['workerStoreDtype'] = np.float32  # The calibration system is crea
               # The system will emit warnings if the calibrated ndarrays have to be truncated to fit
               # into a workerStoreDtype that is not np.float64.
 
+## To store more times than fit in memory, the workers can keep the stored data in a memory mapped file 
+## in this directory, preferably node local scratch. Environment variables, like $TMPDIR, are expanded.
+## Only recently used data stays in memory, see the tutorial for the throughput tradeoff.
+system_params['workerStoreDir'] = None
+## If > 0, G2atEnd correlates the stored data by blocks of this many times, reading it sequentially.
+system_params['workerBlockTimes'] = 0
+## 'time' stores a row of pixels for each time. 'pixel' stores the time series of each pixel 
+## contiguously, G2atEnd then correlates a block of pixels at a time.
+system_params['workerStoreLayout'] = 'time'
+## With the 'pixel' layout, if > 0, workers buffer this many new events before writing them into the store.
+## Not for G2IncrementalAccumulator or G2IncrementalWindowed.
+system_params['workerInsertBlock'] = 0
+## Sparse photon mode: if not None, the ADU of one photon. Servers convert the data to photon counts and 
+## send the workers (pixel, count) pairs, which the workers store and correlate sparsely. For low count rates.
+system_params['sparsePhotonADU'] = None
+## fraction of a photon that counts as a photon, 0.5 rounds to the nearest number of photons
+system_params['sparsePhotonThreshold'] = 0.5
+
 
 ############## mask ##############
 # The mask a numpy array of int's that must have the same shape as the detector array returned by
@@ -158,6 +176,71 @@ eventsPerSecond = 120
 numSeconds = 20
 system_params['update'] = numSeconds * eventsPerSecond  # update/viewer publish every n events. 
               # Set to 0 to only update at the end.
+system_params['fullUpdate'] = 0  # If > 0, the updates above are light - only the reduced arrays from the
+              # user workerReduce callback, i.e, the color delay curves, are sent to the viewer. Every 
+              # fullUpdate events, and at the end, the full per pixel arrays are gathered.
+system_params['asyncUpdate'] = False  # If True, workers copy their results and go back to storing 
+              # data while the per pixel arrays are gathered at the viewer. The master waits for the 
+              # viewer to finish one update before starting the next.
+system_params['viewerDelayBlock'] = 0  # If > 0, the viewer gathers, publishes and writes this many delays
+              # at a time. This bounds viewer memory for many delays on large detectors.
+system_params['updateMaxFraction'] = 0.0  # If > 0, the master times each update and stretches or shrinks
+              # the 'update' interval, between update/10 and 10*update events, so that updates take 
+              # about this fraction of the time. There is always an update at the end.
+system_params['numViewers'] = 1  # If > 1, this many ranks are viewers. Each gathers and publishes its own
+              # range of delays, and the first viewer merges the delay curves. With h5output, each other viewer
+              # writes the arrays for its delays to its own file, named like h5output with _viewer<n> before the 
+              # extension, linked from h5output as /viewer<n>. The first viewer writes the delay curves.
+
+########### rebalance ##############
+# Workers that are slower than the others (a busy node, a slow network link) hold up every
+# event. Every rebalanceInterval events, the master checks how long each worker spent storing
+# data and calculating. If one worker takes more than rebalanceThreshold times the median,
+# for rebalanceChecks checks in a row, some of its pixels are moved to its neighbors.
+# The user class must implement workerPixelArrays and workerSetPixelArrays (UserG2 does).
+system_params['rebalanceInterval'] = 0      # units are events. 0 turns off rebalancing.
+system_params['rebalanceThreshold'] = 1.5
+system_params['rebalanceChecks'] = 2
+
+########### pixel order ##############
+# By default workers get contiguous ranges of the masked pixels in flattened ndarray order, so
+# every color is spread over all the workers. Set orderPixelsByLabels to a list of .npy label files,
+# usually the color and finecolor files, to sort the masked pixels by these labels (the first file
+# is the primary key) before they are divided among the workers. Each worker then holds whole, or
+# nearly whole, finecolor bins. The permutation is written to /system/maskedFlatIndices in h5output.
+system_params['orderPixelsByLabels'] = None
+# Set maskDropColorZero to True to turn off the mask pixels that are 0 in user_params['colorNdarrayCoords'],
+# the viewer does not use them. excludePixelFiles is a list of .npy files of pixels to turn off, i.e, saturated 
+# or hot pixels, either with the shape of the mask (nonzero is turned off) or a list of flat indices.
+# Results are still ndarrays with the shape of the mask, the removed pixels are 0.
+system_params['maskDropColorZero'] = False
+system_params['excludePixelFiles'] = None
+# Set h5maskedFlat to True to write the G2, IF and IP results to h5output as 1D arrays of just the
+# masked in pixels, in the order of /system/maskedFlatIndices. ParCorAna.expandMaskedFlat(h5file, array)
+# gives back the ndarray shape. For a small mask this is a much smaller file, written faster.
+system_params['h5maskedFlat'] = False
+
+########### time parallel ##############
+# For a small mask and many times, with G2atEnd. Rather than dividing the pixels, each worker stores all 
+# the masked pixels for a block of times (times/numWorkers counters) and max(delays) after it. The sums 
+# are reduced over the workers at each update. Not for rebalancing, checkpoints, workerReduce or sparse.
+# Results match dividing the pixels while the counters of the run span no more than 'times'. After that,
+# the window is the last numWorkers*ceil(times/numWorkers) counters, not events.
+system_params['timeParallel'] = False
+
+########### delay groups ##############
+# Split the delays as well as the pixels. Workers are taken in pixel groups of delayGroups workers, 
+# the workers in a group store the same pixels, and each computes every delayGroups'th delay. The 
+# sums are reduced onto the first worker of the group. numWorkers must be a multiple of delayGroups.
+# Not for rebalancing, checkpoints, workerReduce, timeParallel or sparse.
+system_params['delayGroups'] = 1
+
+########### worker reduce ##############
+# By default every update gathers the D x numPixels G2, IF and IP arrays at the viewer. When
+# workerReduce is True, workers reduce their results with the user workerReduce callback and only
+# the small reduced arrays are summed at the viewer. For UserG2 this is the color delay curves, 
+# the G2, IF and IP matrices are not written to h5output. Works well with orderPixelsByLabels.
+system_params['workerReduce'] = False
 
 
 ######### delays ############
@@ -170,6 +253,8 @@ system_params['delays'] = ParCorAna.makeDelayList(start=1,
 ######## User Module ########
 import ParCorAna.UserG2 as UserG2
 system_params['userClass'] = UserG2.G2atEnd
+# userClass can also be a list of classes, i.e, [UserG2.G2atEnd, UserG2.G2IncrementalAccumulator], to 
+# run several analyses on one pass of the data. Each writes to a subgroup named after its class.
 
 ######## h5output, overwrite ########### 
 # The system will optionally manage an h5output file. This is not a file for collective MPI
@@ -202,6 +287,22 @@ system_params['testH5output'] = 'g2calc_test_%s-r%4.4d.h5' % (experiment, run)
 ## overwrite can also be specified on the command line, --overwrite=True which overrides what is below
 system_params['overwrite'] = False   # if you want to overwrite an h5output file that already exists
 
+## If > 0, the viewer writes h5output from a background thread, queuing at most this many writes. The viewer
+## goes on with the next update while the results are written. The writes are done before the file is closed.
+system_params['h5writerQueue'] = 0
+## If True, the workers write the G2, IF, IP arrays at each update into a second file, named like h5output
+## with _workers before the extension, in parallel with the MPI-IO driver. The viewer only writes the delay
+## curves and links the workers file as /workers. Needs h5py built with MPI. 
+system_params['h5parallel'] = False
+
+######## checkpoint #########
+## If checkpointInterval > 0, every checkpointInterval events the workers write their stored data and 
+## results to files named like checkpoint with _worker<n>_<slot> before the extension, and the master 
+## then writes the checkpoint file. Run parCorAnaDriver with --resume to continue from the last checkpoint,
+## the number of workers may change, but not the number of servers, the mask or times.
+system_params['checkpoint'] = None
+system_params['checkpointInterval'] = 0
+
 ######## verbosity #########
 # verbosity can be one of INFO, DEBUG, WARNING (levels from the Python logging module)
 system_params['verbosity'] = 'INFO'
@@ -235,6 +336,14 @@ user_params['notzero'] = 1E-5
 user_params['psmon_plot'] = False
 # to set a different port for psmon plotting, change this
 # user_params['psmon_port'] = 12301
+# to build and send the plots from a separate process, so the viewer does not wait on 
+# plotting, set this to True. The process is forked from the viewer rank. If the process is
+# behind, it only publishes the latest plots. Some MPI implementations do not support fork,
+# leave this False with those.
+# user_params['psmon_process'] = False
+# user_params['h5layout'] = 'groups'  # 'groups' for a group per update, a dataset per delay. 'appended' for
+              # one dataset per array shaped (update, delay, ndarray), and delay curves (update, color, delay).
+# user_params['h5compression'] = None  # or 'gzip' or 'lzf' for the G2, IF, IP datasets
 user_params['plot_colors'] = None
 user_params['print_delay_curves'] = False
 user_params['debug_plot'] = False
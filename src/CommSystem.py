@@ -19,7 +19,7 @@ from . import CommSystemUtil
 from . import PsanaUtil
 from .MessageBuffers import SM_MsgBuffer, MVW_MsgBuffer
 from . import Timing
-from .XCorrBase import XCorrBase
+from .XCorrBase import XCorrBase, writeCheckpointMaster, readCheckpointMaster
 from . import Counter120hz
 
 MPI4PY_200 = mpi4py.__version__.startswith('2')
@@ -156,7 +156,7 @@ class MPI_Communicators(object):
 
     def setLogger(self, verbosity):
         self.logger = CommSystemUtil.makeLogger(self.testMode, self.isMaster, \
-                        self.isViewer, self.isServer, self.rank, verbosity)
+                        self.isViewer or self.isHelperViewer, self.isServer, self.rank, verbosity)
 
     def notWorker2toN(self):
         if self.isWorker and not self.isFirstWorker:
@@ -190,12 +190,19 @@ class MPI_Communicators(object):
             self.logger.error(msg)
 
 
-    def setMask(self, maskNdarrayCoords):
+    def setMask(self, maskNdarrayCoords, orderLabels=None, delayGroups=1):
         '''sets scatterv parameters and stores mask
 
         Args:
           maskNdarrayCoords (numpy.ndarray): integer array, 1 for elements that should be processed. 
                                               It must have the same shape as the NDArray for the detector.
+          orderLabels (list): optional list of integer label arrays (such as the color and 
+                              finecolor arrays), each with the same shape as the mask. When given,
+                              the masked elements are sorted by these labels, the first is
+                              the primary key. Workers then get contiguous runs of labels.
+          delayGroups (int): workers are grouped in pixel groups of delayGroups workers. The 
+                             first worker of a group gets the pixels of the group, the others
+                             get a count of 0 (see system_params['delayGroups']).
 
         Notes:
           sets the following attributes
@@ -206,6 +213,10 @@ class MPI_Communicators(object):
                                            a flattened version of the ndarray
           * maskNdarrayCoords:             the mask as a logical True/False array
                                            shape has not been changed
+          * maskedFlatIndices:             index into the flattened ndarray for each of the
+                                           masked elements, in the order they are processed
+          * pixelsInLabelOrder:            True if orderLabels was used
+          * delayGroups:                   the delayGroups argument
 
         '''
         mask_flat = maskNdarrayCoords.flatten()
@@ -221,10 +232,63 @@ class MPI_Communicators(object):
                           (self.maskNdarrayCoords.shape, np.sum(self.maskNdarrayCoords),
                            np.sum(0==self.maskNdarrayCoords)))
 
-        workerOffsets, workerCounts = CommSystemUtil.divideAmongWorkers(self.totalElements, 
-                                                                 self.numWorkers)
+        self.maskedFlatIndices = np.flatnonzero(self.maskNdarrayCoords)
+        self.pixelsInLabelOrder = orderLabels is not None
+        if self.pixelsInLabelOrder:
+            for labels in orderLabels:
+                assert labels.shape == self.maskNdarrayCoords.shape, "order labels shape=%s != mask shape=%s" % \
+                    (labels.shape, self.maskNdarrayCoords.shape)
+            # lexsort is stable and uses the last key as the primary key
+            sortKeys = [labels.flatten()[self.maskedFlatIndices] for labels in reversed(orderLabels)]
+            self.maskedFlatIndices = self.maskedFlatIndices[np.lexsort(sortKeys)]
+            self.logInfo("MPIParams.setMask: ordered %d masked elements by %d label arrays" % \
+                         (len(self.maskedFlatIndices), len(orderLabels)))
+
+        self.delayGroups = delayGroups
+        workerOffsets, workerCounts = CommSystemUtil.divideAmongDelayGroups(self.totalElements, 
+                                                                            self.numWorkers,
+                                                                            self.delayGroups)
+        self.setWorkerCounts(workerCounts)
+
+    def workerPixelGroup(self, workerRank):
+        '''for system_params['delayGroups'], returns the pixel group and delay group of a worker,
+        and the world rank of the first worker in its pixel group, which has the pixels of the group.
+        '''
+        workerIdx = self.workerRanks.index(workerRank)
+        pixelGroup = workerIdx // self.delayGroups
+        delayGroup = workerIdx % self.delayGroups
+        return pixelGroup, delayGroup, self.workerRanks[pixelGroup * self.delayGroups]
+
+    def maskedFlat(self, ndarray):
+        '''returns the masked elements of an ndarray, as a 1D array in the order they are processed.
+        '''
+        return np.take(ndarray, self.maskedFlatIndices)
+
+    def maskedFlatToNdarray(self, maskedFlat, dtype=None):
+        '''inverse of maskedFlat. returns an ndarray with the shape of the mask, 0 for elements
+        that are masked out.
+        '''
+        if dtype is None:
+            dtype = maskedFlat.dtype
+        ndarray = np.zeros(self.maskNdarrayCoords.shape, dtype)
+        np.put(ndarray, self.maskedFlatIndices, maskedFlat)
+        return ndarray
+
+    def setWorkerCounts(self, workerCounts):
+        '''sets the number of elements each worker processes, and the scatterv parameters.
+
+        Workers process contiguous ranges of the masked elements, in worker order. This is
+        called by setMask, and again on all ranks when the workers are rebalanced.
+
+        Args:
+          workerCounts (list): number of elements for each worker, in the order of workerRanks.
+                               Must sum to totalElements.
+        '''
+        workerCounts = [int(count) for count in workerCounts]
+        workerOffsets = [0] + [int(offset) for offset in np.cumsum(workerCounts)[0:-1]]
         assert self.numWorkers == len(self.workerRanks)
         assert len(workerCounts)==self.numWorkers
+        CommSystemUtil.checkCountsOffsets(workerCounts, workerOffsets, self.totalElements)
 
         self.workerWorldRankToCount = {}
         self.workerWorldRankToOffset = {}
@@ -253,6 +317,11 @@ class MPI_Communicators(object):
             self.serverWorkers[serverRank]['groupScattervOffsets'] = tuple(scatterOffsets)
             CommSystemUtil.checkCountsOffsets(scatterCounts, scatterOffsets, self.totalElements)
 
+    def workerCounts(self):
+        '''returns list of the number of elements each worker processes, in workerRanks order
+        '''
+        return [self.workerWorldRankToCount[rank] for rank in self.workerRanks]
+
 def getTestingMPIObject():
     '''mock up MPI_Communicators object for test_alt mode.
     
@@ -265,6 +334,7 @@ def getTestingMPIObject():
     mp.isFirstWorker = True
     mp.isFirstServer = True
     mp.isViewer = True
+    mp.isHelperViewer = False
     mp.isMaster = False
     mp.testMode = True
     mp.rank = MPI.COMM_WORLD.rank
@@ -275,9 +345,13 @@ def getTestingMPIObject():
     mp.serverWorkers = {}
     mp.serverWorkers[0]={'serverRankInComm':0}
     mp.viewerRankInViewerWorkersComm = 0
+    mp.numViewers = 1
+    mp.viewerRanks = [mp.rank]
+    mp.viewerIndex = 0
+    mp.viewerRanksInViewerWorkersComms = [0]
     return mp
 
-def identifyCommSubsystems(serverRanks, worldComm=None):
+def identifyCommSubsystems(serverRanks, worldComm=None, numViewers=1):
     '''Return a fully initialized instance of a MPI_Communicators object
     The object will contain the following attributes::
 
@@ -286,14 +360,18 @@ def identifyCommSubsystems(serverRanks, worldComm=None):
       rank             - rank in worldComm
       worldNumProcs    - size of worldComm
       masterRank       - master rank in worldComm
-      viewerRank       - viewer rank in worldComm
+      viewerRank       - viewer rank in worldComm, the first of the viewerRanks
+      viewerRanks      - list of viewer ranks in worldComm, numViewers of them
+      numViewers       - number of viewers
+      viewerIndex      - index of this rank in viewerRanks, None if not a viewer
       workerRanks      - list of worker ranks in worldComm
       firstWorkerRank  - first worker rank in worldComm
       numWorkers       - number of workers
 
       # these parameters identify which group this rank is
       isMaster
-      isViewer
+      isViewer         - True for the first viewer, the one the master talks to
+      isHelperViewer   - True for the other viewers
       isServer
       isFirstWorker
       isWorker
@@ -301,9 +379,14 @@ def identifyCommSubsystems(serverRanks, worldComm=None):
       isTestMode = False
 
       masterWorkersComm - intra communicator for master/workers collective communication
+      workersComm       - intra communicator for just the workers, used when moving data between workers
       viewerWorkersComm - intra communicator for viewer/workers collective communication
       viewerRankInViewerWorkersComm      - viewer rank in the above intra-communicator
       firstWorkerRankInViewerWorkersComm - first worker rank in the above intra-communicator
+      viewerWorkersComms - list with an intra communicator for each viewer and the workers,
+                           the first is viewerWorkersComm
+      viewerRanksInViewerWorkersComms - for each viewer, its rank in the above intra-communicator
+      viewersComm       - intra communicator for the viewers, the first viewer is rank 0
 
       # the following is a dict with one key for each server rank
       serverWorkers[serverRank]['comm'] - intra communicator, this server and all workers
@@ -313,6 +396,7 @@ def identifyCommSubsystems(serverRanks, worldComm=None):
     '''
     assert len(serverRanks) > 0, "need at least one server"
     assert min(serverRanks) >= 0, "cannot have negative server ranks"
+    assert numViewers >= 1, "need at least one viewer"
     if worldComm is None:
         worldComm = MPI.COMM_WORLD
 
@@ -329,8 +413,13 @@ def identifyCommSubsystems(serverRanks, worldComm=None):
                   if rank not in mc.serverRanks]
     assert len(availRanks)>=3, "To many servers for world size. " + \
         ("Only %d ranks left for master/viewer/workers" % len(availRanks))
-    mc.viewerRank = min(availRanks)
-    availRanks.remove(mc.viewerRank)
+    assert len(availRanks)>=numViewers+2, "To many viewers for world size. " + \
+        ("Only %d ranks left for master/%d viewers/workers" % (len(availRanks), numViewers))
+    mc.numViewers = numViewers
+    mc.viewerRanks = availRanks[0:numViewers]
+    mc.viewerRank = mc.viewerRanks[0]
+    for viewerRank in mc.viewerRanks:
+        availRanks.remove(viewerRank)
     mc.masterRank = min(availRanks)
     availRanks.remove(mc.masterRank)
     mc.workerRanks = availRanks
@@ -339,23 +428,42 @@ def identifyCommSubsystems(serverRanks, worldComm=None):
 
     mc.isMaster = mc.rank == mc.masterRank
     mc.isViewer = mc.rank == mc.viewerRank
+    mc.isHelperViewer = mc.rank in mc.viewerRanks[1:]
+    mc.viewerIndex = None
+    if mc.rank in mc.viewerRanks:
+        mc.viewerIndex = mc.viewerRanks.index(mc.rank)
     mc.isServer = mc.rank in mc.serverRanks
     mc.isFirstWorker = mc.rank == mc.firstWorkerRank
     mc.isFirstServer = mc.rank == mc.firstServerRank
-    mc.isWorker = mc.rank not in ([mc.masterRank, mc.viewerRank] + mc.serverRanks)
+    mc.isWorker = mc.rank not in ([mc.masterRank] + mc.viewerRanks + mc.serverRanks)
     mc.numWorkers = len(mc.workerRanks)
     
     worldGroup = mc.comm.Get_group()
-    masterWorkersGroup = worldGroup.Excl([mc.viewerRank] + mc.serverRanks)
-    viewerWorkersGroup = worldGroup.Excl([mc.masterRank] + mc.serverRanks)
+    masterWorkersGroup = worldGroup.Excl(mc.viewerRanks + mc.serverRanks)
+    workersGroup = worldGroup.Excl([mc.masterRank] + mc.viewerRanks + mc.serverRanks)
+    viewersGroup = worldGroup.Incl(mc.viewerRanks)
 
     mc.masterWorkersComm = mc.comm.Create(masterWorkersGroup)  # will be an invalid group on proc with viewer
-    mc.viewerWorkersComm = mc.comm.Create(viewerWorkersGroup)  # will be an invalid group on proc with master
+    mc.workersComm = mc.comm.Create(workersGroup)              # will be an invalid group on all but workers
+    mc.viewersComm = mc.comm.Create(viewersGroup)              # will be an invalid group on all but viewers
+
+    # each viewer gathers from the workers through its own communicator
+    mc.viewerWorkersComms = []
+    mc.viewerRanksInViewerWorkersComms = []
+    for viewerRank in mc.viewerRanks:
+        otherViewers = [rank for rank in mc.viewerRanks if rank != viewerRank]
+        oneViewerWorkersGroup = worldGroup.Excl([mc.masterRank] + otherViewers + mc.serverRanks)
+        mc.viewerWorkersComms.append(mc.comm.Create(oneViewerWorkersGroup))
+        mc.viewerRanksInViewerWorkersComms.append(MPI.Group.Translate_ranks(worldGroup, [viewerRank],
+                                                                            oneViewerWorkersGroup)[0])
+        if viewerRank == mc.viewerRank:
+            viewerWorkersGroup = oneViewerWorkersGroup
+    mc.viewerWorkersComm = mc.viewerWorkersComms[0]           # will be an invalid group on proc with master
 
     mc.serverWorkers = dict()
     for serverRank in mc.serverRanks:
         otherServers = [rank for rank in mc.serverRanks if rank != serverRank]
-        serverWorkersGroup = worldGroup.Excl([mc.viewerRank, mc.masterRank]+otherServers)
+        serverWorkersGroup = worldGroup.Excl(mc.viewerRanks + [mc.masterRank] + otherServers)
         serverRankInComm = MPI.Group.Translate_ranks(worldGroup, [serverRank],
                                                      serverWorkersGroup)[0]
         workerRanksInComm = MPI.Group.Translate_ranks(worldGroup, mc.workerRanks,
@@ -382,12 +490,16 @@ class ScatterDataQueue(object):
 
     After a server gets data and tells the master its timestamp, it will work on adding
     a new array to the queue.
+
+    If photonADU is not None, the masked data is photonized, and a (pixels, photons) tuple
+    is queued rather than the array.
     '''
-    def __init__(self, maskToCopyOutData, dtypeForScatter, logger):
-        assert maskToCopyOutData.dtype == np.bool
-        self.maskToCopyOutData = maskToCopyOutData
-        self.numElements = np.sum(maskToCopyOutData)
+    def __init__(self, maskedFlatIndices, dtypeForScatter, logger, photonADU=None, photonThreshold=0.5):
+        self.maskedFlatIndices = maskedFlatIndices
+        self.numElements = len(maskedFlatIndices)
         self.dtypeForScatter = dtypeForScatter
+        self.photonADU = photonADU
+        self.photonThreshold = photonThreshold
         self.iterDataQueue = []
         self.scatterDataQueue = []
         self.logger = logger
@@ -417,8 +529,12 @@ class ScatterDataQueue(object):
             except StopIteration:
                 self.logger.debug("ScatterDataQueue: addFrom: dataGen is empty")
                 return
-            scatterData = np.zeros(self.numElements, dtype=self.dtypeForScatter)
-            scatterData[:] = datum.dataArray[self.maskToCopyOutData]
+            if self.photonADU is None:
+                scatterData = np.zeros(self.numElements, dtype=self.dtypeForScatter)
+                scatterData[:] = np.take(datum.dataArray, self.maskedFlatIndices)
+            else:
+                scatterData = CommSystemUtil.photonize(np.take(datum.dataArray, self.maskedFlatIndices),
+                                                       self.photonADU, self.photonThreshold)
             self.iterDataQueue.append(datum)
             self.scatterDataQueue.append(scatterData)
             if self.logger.isEnabledFor(logging.DEBUG):
@@ -487,9 +603,20 @@ class RunServer(object):
                            source=self.masterRank)
 
     @Timing.timecall(timingDict=timingdict)
-    def scatterToWorkers(self):
+    def receiveWorkerCountsFromMaster(self):
+        workerCounts = np.zeros(self.xCorrBase.mp.numWorkers, np.int64)
+        self.comm.Recv([workerCounts, MPI.INT64_T], source=self.masterRank)
+        self.logger.debug("RunServer: received new worker counts from master: %r" % workerCounts)
+        self.xCorrBase.mp.setWorkerCounts(workerCounts)
+
+    @Timing.timecall(timingDict=timingdict)
+    def scatterToWorkers(self, counter):
         self.logger.debug("RunServer: about to scatter to workers")
         toScatter1DArray = self.scatterDataQueue.popHead()
+        if self.xCorrBase.timeParallel:
+            self.xCorrBase.serverWorkersSendTimeParallel(counter, detectorData1Darray=toScatter1DArray,
+                                                         serverWorldRank=None)
+            return
         self.xCorrBase.serverWorkersScatter(detectorData1Darray=toScatter1DArray, 
                                             serverWorldRank=None)
 
@@ -499,7 +626,9 @@ class RunServer(object):
         receiveOkForWorkersBuffer = SM_MsgBuffer(rank=self.rank)
         abortFromMaster = False
         self.dataGen = self.dataIter.dataGenerator()
-        self.scatterDataQueue=ScatterDataQueue(self.xCorrBase.mp.maskNdarrayCoords, np.float32, self.logger)
+        self.scatterDataQueue=ScatterDataQueue(self.xCorrBase.mp.maskedFlatIndices, np.float32, self.logger,
+                                               photonADU=self.xCorrBase.photonADU,
+                                               photonThreshold=self.xCorrBase.photonThreshold)
         initialQueueSize = 1
 
         while initialQueueSize > 0:
@@ -512,8 +641,12 @@ class RunServer(object):
             # read new data before waiting to be told to scatter
             self.addDataToScatterQueue()
             self.receiveMessageFromMaster(receiveOkForWorkersBuffer)
+            while receiveOkForWorkersBuffer.isRepartition():
+                # workers have been rebalanced, the next scatter uses the new counts
+                self.receiveWorkerCountsFromMaster()
+                self.receiveMessageFromMaster(receiveOkForWorkersBuffer)
             if receiveOkForWorkersBuffer.isSendToWorkers():
-                self.scatterToWorkers()
+                self.scatterToWorkers(receiveOkForWorkersBuffer.getCounter())
             elif receiveOkForWorkersBuffer.isAbort():
                 self.logger.debug("RunServer: After Recv. Abort")
                 abortFromMaster = True
@@ -531,12 +664,22 @@ class RunServer(object):
                            dest=self.masterRank)
             self.logger.debug("CommSystem.run: After Send END. Finished")
 
+def viewerReportsUpdateDone(asyncUpdate, updateMaxFraction, light):
+    '''the viewer and master both use this to decide if the viewer sends the master how long
+    an update took.
+    '''
+    return (asyncUpdate and not light) or (updateMaxFraction > 0)
+
 class RunMaster(object):
     '''runs master message passing.
     '''
     def __init__(self, worldComm, masterRank, viewerRank, serverRanks, serversRoundRobin,
                  masterWorkersComm, masterRankInMasterWorkersComm,
-                 updateIntervalEvents, hostmsg, logger):
+                 updateIntervalEvents, hostmsg, logger,
+                 workerRanks=None, workerCounts=None, rebalanceInterval=0,
+                 rebalanceThreshold=1.5, rebalanceChecks=2, fullUpdateIntervalEvents=0,
+                 asyncUpdate=False, updateMaxFraction=0.0, checkpoint=None, checkpointInterval=0,
+                 numTimes=0, resumeState=None):
 
         self.worldComm = worldComm
         self.masterRank = masterRank
@@ -559,10 +702,72 @@ class RunMaster(object):
         self.bcastWorkersBuffer = MVW_MsgBuffer()
         self.viewerBuffer = MVW_MsgBuffer()
         self.lastUpdate = 0
+        # when there are full updates, the other updates are light
+        self.fullUpdateIntervalEvents = fullUpdateIntervalEvents
+        self.lastFullUpdate = 0
+        # with asyncUpdate, the viewer tells the master when it is done with a full update
+        self.asyncUpdate = asyncUpdate
+        self.viewerDoneBuffer = np.zeros(1, np.float64)
+        self.viewerDoneRequest = None
+        # with updateMaxFraction, the viewer tells the master how long each update took, and the
+        # master stretches or shrinks the update interval to keep updates to that fraction of the time
+        assert updateMaxFraction >= 0.0 and updateMaxFraction < 1.0, "updateMaxFraction=%s must be in [0,1)" % updateMaxFraction
+        self.updateMaxFraction = updateMaxFraction
+        self.minUpdateIntervalEvents = max(1, updateIntervalEvents // 10)
+        self.maxUpdateIntervalEvents = updateIntervalEvents * 10
+        self.updateStartTime = None
+        self.lastUpdateLight = False
         self.numEvents = 0
         
         self.eventIdToCounter = None
 
+        # for moving pixels from a slow worker to its neighbors
+        self.workerRanks = workerRanks
+        self.workerCounts = workerCounts
+        self.rebalanceInterval = rebalanceInterval
+        if (workerRanks is None) or (len(workerRanks) < 2):
+            self.rebalanceInterval = 0
+        self.rebalanceThreshold = rebalanceThreshold
+        self.rebalanceChecks = rebalanceChecks
+        self.lastRebalanceCheck = 0
+        self.stragglerIdx = None
+        self.stragglerChecks = 0
+
+        # for checkpoints, the first event defines the counters, and for each server, the 
+        # sec/nsec of the last event it gave to the workers
+        self.checkpoint = checkpoint
+        self.checkpointInterval = checkpointInterval
+        self.numTimes = numTimes
+        self.checkpointNumber = 0
+        self.lastCheckpoint = 0
+        self.firstEventId = None
+        self.serverLastEventIds = dict((serverRank, (-1, -1)) for serverRank in serverRanks)
+        self.resumeLatestEventId = None
+        if resumeState is not None:
+            self.resumeFromCheckpoint(resumeState)
+
+    def resumeFromCheckpoint(self, state):
+        '''picks up the event counting where the checkpoint left off. The workers restore their 
+        data, and the servers skip the events already processed.
+        '''
+        assert int(state['numServers']) == len(self.serverRanks), "checkpoint was written with %d servers, but there are %d" % \
+            (int(state['numServers']), len(self.serverRanks))
+        sec, nsec, fiducials = [int(x) for x in state['firstEventId']]
+        self.firstEventId = (sec, nsec, fiducials)
+        self.eventIdToCounter = Counter120hz.Counter120hz(sec, nsec, fiducials)
+        self.numEvents = int(state['numEvents'])
+        self.lastUpdate = self.numEvents
+        self.lastFullUpdate = self.numEvents
+        self.lastRebalanceCheck = self.numEvents
+        self.lastCheckpoint = self.numEvents
+        self.checkpointNumber = int(state['checkpointNumber'])
+        for serverRank, eventId in zip(self.serverRanks, state['serverLastEventIds']):
+            self.serverLastEventIds[serverRank] = tuple([int(x) for x in eventId])
+        sec, nsec, fiducials, counter = [int(x) for x in state['latestEventId']]
+        self.resumeLatestEventId = {'sec':sec, 'nsec':nsec, 'fiducials':fiducials, 'counter':counter}
+        self.logger.info("CommSystem: resuming from checkpoint %d after %d events, last counter=%d" % \
+                         (self.checkpointNumber, self.numEvents, counter))
+
     def getNextServerData(self, serverDataList, lastServerRank):
         '''Takes a list of server data buffers. identifies next server. 
 
@@ -639,8 +844,11 @@ class RunMaster(object):
             self.logger.debug("CommSystem: after Bcast/Barrier -> workers EVT counter=%d" % counter)
 
     @Timing.timecall(timingDict=timingdict)
-    def informViewerOfUpdate(self, latestEventId):
-        self.viewerBuffer.setUpdate()
+    def informViewerOfUpdate(self, latestEventId, light=False):
+        if light:
+            self.viewerBuffer.setLightUpdate()
+        else:
+            self.viewerBuffer.setUpdate()
         self.viewerBuffer.setSeconds(latestEventId['sec'])
         self.viewerBuffer.setNanoSeconds(latestEventId['nsec'])
         self.viewerBuffer.setFiducials(latestEventId['fiducials'])
@@ -649,6 +857,50 @@ class RunMaster(object):
                              self.viewerBuffer.getMPIType()],
                             dest=self.viewerRank)
 
+    def informOfUpdate(self, latestEventId, light=False):
+        self.updateStartTime = time.time()
+        self.lastUpdateLight = light
+        self.informViewerOfUpdate(latestEventId, light)
+        self.informWorkersToUpdateViewer(light)
+        if viewerReportsUpdateDone(self.asyncUpdate, self.updateMaxFraction, light):
+            self.viewerDoneRequest = self.worldComm.Irecv([self.viewerDoneBuffer, MPI.DOUBLE],
+                                                          source=self.viewerRank)
+
+    def viewerBusyWithUpdate(self):
+        '''for asyncUpdate or updateMaxFraction, returns True if the viewer has not finished 
+        the last update. The master holds back on the next one until it has.
+        '''
+        if self.viewerDoneRequest is None:
+            return False
+        if not self.viewerDoneRequest.Test():
+            return True
+        self.viewerDoneRequest = None
+        self.logger.debug("CommSystem: viewer finished update in %.2f sec" % self.viewerDoneBuffer[0])
+        # the 'update' interval is for light updates when there are full updates
+        if (self.updateMaxFraction > 0) and (self.lastUpdateLight == (self.fullUpdateIntervalEvents > 0)):
+            self.adaptUpdateInterval(self.viewerDoneBuffer[0])
+        return False
+
+    def adaptUpdateInterval(self, updateSeconds):
+        '''called when the viewer reports how long an update took, right before the next
+        update is due.
+        '''
+        if self.updateIntervalEvents == 0:
+            return
+        cycleSeconds = time.time() - self.updateStartTime
+        newInterval = CommSystemUtil.adaptUpdateInterval(self.updateIntervalEvents, updateSeconds, cycleSeconds,
+                                                         self.updateMaxFraction, self.minUpdateIntervalEvents, 
+                                                         self.maxUpdateIntervalEvents)
+        if newInterval != self.updateIntervalEvents:
+            self.logger.info("CommSystem: update took %.2f of %.2f sec, changing update interval from %d to %d events" % \
+                             (updateSeconds, cycleSeconds, self.updateIntervalEvents, newInterval))
+            self.updateIntervalEvents = newInterval
+
+    def waitForViewerDoneWithUpdate(self):
+        if self.viewerDoneRequest is not None:
+            self.viewerDoneRequest.Wait()
+            self.viewerDoneRequest = None
+
     def sendEndToViewer(self):
         self.viewerBuffer.setEnd()
         self.worldComm.Send([self.viewerBuffer.getNumpyBuffer(),
@@ -656,9 +908,12 @@ class RunMaster(object):
                             dest=self.viewerRank)
 
     @Timing.timecall(timingDict=timingdict)
-    def informWorkersToUpdateViewer(self):
-        self.logger.debug("CommSystem: before Bcast -> workers UPDATE")
-        self.bcastWorkersBuffer.setUpdate()
+    def informWorkersToUpdateViewer(self, light=False):
+        self.logger.debug("CommSystem: before Bcast -> workers UPDATE light=%s" % light)
+        if light:
+            self.bcastWorkersBuffer.setLightUpdate()
+        else:
+            self.bcastWorkersBuffer.setUpdate()
         self.masterWorkersComm.Bcast([self.bcastWorkersBuffer.getNumpyBuffer(),
                                       self.bcastWorkersBuffer.getMPIType()],
                                      root=self.masterRankInMasterWorkersComm)
@@ -674,6 +929,94 @@ class RunMaster(object):
  #       self.masterWorkersComm.Barrier()
         self.logger.debug("CommSystem: after Bcast/Barrier -> workers END")
 
+    @Timing.timecall(timingDict=timingdict)
+    def rebalanceWorkers(self, serverRequests, serverReceiveData):
+        '''gathers how long each worker has been busy since the last check. If the same worker 
+        has been a straggler for rebalanceChecks checks in a row, moves some of its pixels to its 
+        neighbors.
+
+        This is called between events. New worker counts are broadcast to the workers, who
+        move the data for the pixels between themselves. Servers that are not finished, and the
+        viewer, are sent the new counts before they are told to scatter or gather again.
+        '''
+        self.bcastWorkersBuffer.setRebalance()
+        self.masterWorkersComm.Bcast([self.bcastWorkersBuffer.getNumpyBuffer(),
+                                      self.bcastWorkersBuffer.getMPIType()],
+                                     root=self.masterRankInMasterWorkersComm)
+        rankBusyTimes = self.masterWorkersComm.gather(None, root=self.masterRankInMasterWorkersComm)
+        rank2busyTime = dict([rankBusy for rankBusy in rankBusyTimes if rankBusy is not None])
+        busyTimes = [rank2busyTime[rank] for rank in self.workerRanks]
+
+        newCounts = self.workerCounts
+        straggler = CommSystemUtil.identifyStraggler(busyTimes, self.rebalanceThreshold)
+        if (straggler is None) or (straggler != self.stragglerIdx):
+            self.stragglerChecks = 0
+        self.stragglerIdx = straggler
+        if straggler is not None:
+            self.stragglerChecks += 1
+            self.logger.info("CommSystem: worker rank=%d busy for %.2f sec, median is %.2f sec. Straggler for %d checks in a row" % \
+                             (self.workerRanks[straggler], busyTimes[straggler], np.median(busyTimes), self.stragglerChecks))
+            if self.stragglerChecks >= self.rebalanceChecks:
+                newCounts = CommSystemUtil.migrateFromStraggler(self.workerCounts, busyTimes, 
+                                                                straggler, self.rebalanceThreshold)
+                self.stragglerChecks = 0
+
+        workerCounts = np.array(newCounts, np.int64)
+        self.masterWorkersComm.Bcast([workerCounts, MPI.INT64_T],
+                                     root=self.masterRankInMasterWorkersComm)
+        if newCounts == self.workerCounts:
+            return
+
+        self.logger.info("CommSystem: moving %d pixels from worker rank=%d to its neighbors. new counts=%s" % \
+                         (self.workerCounts[straggler] - newCounts[straggler], self.workerRanks[straggler], newCounts))
+        self.workerCounts = newCounts
+
+        # every server that is not finished must be waiting on a message from the master
+        # before we can tell it about the new counts
+        if len(self.notReadyServers) > 0:
+            self.waitOnServers(serverRequests, serverReceiveData)
+        for serverRank in self.readyServers:
+            self.sendOkForWorkersBuffer.setRepartition()
+            self.worldComm.Send([self.sendOkForWorkersBuffer.getNumpyBuffer(), 
+                                 self.sendOkForWorkersBuffer.getMPIType()], 
+                                dest=serverRank)
+            self.worldComm.Send([workerCounts, MPI.INT64_T], dest=serverRank)
+
+        self.viewerBuffer.setRebalance()
+        self.worldComm.Send([self.viewerBuffer.getNumpyBuffer(),
+                             self.viewerBuffer.getMPIType()],
+                            dest=self.viewerRank)
+        self.worldComm.Send([workerCounts, MPI.INT64_T], dest=self.viewerRank)
+
+    @Timing.timecall(timingDict=timingdict)
+    def checkpointWorkers(self, latestEventId):
+        '''has the workers write their checkpoint files, and then writes the master checkpoint file.
+
+        This is called between events, so the workers have stored exactly the events the master 
+        has given them. The master file is written last, a crash while the workers are writing 
+        leaves the previous checkpoint in place.
+        '''
+        self.checkpointNumber += 1
+        self.bcastWorkersBuffer.setCheckpoint()
+        self.bcastWorkersBuffer.setCounter(self.checkpointNumber)
+        self.masterWorkersComm.Bcast([self.bcastWorkersBuffer.getNumpyBuffer(),
+                                      self.bcastWorkersBuffer.getMPIType()],
+                                     root=self.masterRankInMasterWorkersComm)
+        # the workers are done when they return from the gather
+        self.masterWorkersComm.gather(None, root=self.masterRankInMasterWorkersComm)
+        state = {'checkpointNumber':self.checkpointNumber,
+                 'numWorkers':len(self.workerRanks),
+                 'numServers':len(self.serverRanks),
+                 'times':self.numTimes,
+                 'numEvents':self.numEvents,
+                 'firstEventId':np.array(self.firstEventId, np.int64),
+                 'latestEventId':np.array([latestEventId['sec'], latestEventId['nsec'], 
+                                           latestEventId['fiducials'], latestEventId['counter']], np.int64),
+                 'serverLastEventIds':np.array([self.serverLastEventIds[serverRank] for serverRank in self.serverRanks], 
+                                               np.int64)}
+        writeCheckpointMaster(self.checkpoint, state)
+        self.logger.info("CommSystem: wrote checkpoint %d after %d events" % (self.checkpointNumber, self.numEvents))
+
     @Timing.timecall(timingDict=timingdict)
     def waitOnServers(self, serverRequests, serverReceiveData):
         '''called during communication loop. 
@@ -712,8 +1055,10 @@ class RunMaster(object):
         self.readyServers.extend(newReadyServers)
 
     @Timing.timecall(timingDict=timingdict)
-    def tellServerToScatterToWorkers(self, selectedServerRank):
+    def tellServerToScatterToWorkers(self, selectedServerRank, counter):
         self.sendOkForWorkersBuffer.setSendToWorkers()
+        # the server routes the data by counter in the time parallel mode
+        self.sendOkForWorkersBuffer.setCounter(counter)
         if self.logger.isEnabledFor(logging.DEBUG):
             self.logger.debug("CommSystem: before SendOkForWorkers to server %d" % selectedServerRank)
         self.worldComm.Send([self.sendOkForWorkersBuffer.getNumpyBuffer(), 
@@ -722,6 +1067,7 @@ class RunMaster(object):
     def run(self):
         ####### helper functions ##########
         def initializeCounterFunctionWithFirstTime(sec, nsec, fiducials):
+            self.firstEventId = (sec, nsec, fiducials)
             self.eventIdToCounter = Counter120hz.Counter120hz(sec, nsec, fiducials)
 
         def updateLatestEventId(latestEventId, counter, sec, nsec, fiducials):
@@ -733,12 +1079,17 @@ class RunMaster(object):
         ##################################
 
         serverReceiveData, serverRequests = self.initRecvRequestsFromServers()
-        numEventsAtLastDataRateMsg = 0
+        numEventsAtStart = self.numEvents
+        numEventsAtLastDataRateMsg = self.numEvents
         timeAtLastDataRateMsg = time.time()
         startTime = time.time()
         noData = True
         selectedServerRank = None
         latestEventId = {'sec':None, 'nsec':None, 'fiducials':None, 'counter':None}
+        if self.resumeLatestEventId is not None:
+            # the workers have data from before the checkpoint
+            noData = False
+            latestEventId = dict(self.resumeLatestEventId)
 
         while True:
             # a server must be in one of: ready, noReady or finished
@@ -769,11 +1120,12 @@ class RunMaster(object):
                 initializeCounterFunctionWithFirstTime(sec, nsec, fiducials)
             counter = self.eventIdToCounter.getCounter(sec, fiducials)
             updateLatestEventId(latestEventId, counter, sec, nsec, fiducials)
+            self.serverLastEventIds[selectedServerRank] = (sec, nsec)
             if self.logger.isEnabledFor(logging.DEBUG):
                 self.logger.debug("CommSystem: next server rank=%d sec=0x%8.8X nsec=0x%8.8X fiducials=0x%5.5X counter=%5d" % \
                                   (selectedServerRank, sec, nsec, fiducials, counter))
             self.informWorkersOfNewData(selectedServerRank, sec, nsec, fiducials, counter)
-            self.tellServerToScatterToWorkers(selectedServerRank)
+            self.tellServerToScatterToWorkers(selectedServerRank, counter)
 
             self.readyServers.remove(selectedServerRank)
             self.notReadyServers.append(selectedServerRank)
@@ -788,11 +1140,32 @@ class RunMaster(object):
 
             # check to see if there should be an update for the viewer
             self.numEvents += 1
-            if (self.updateIntervalEvents > 0) and (self.numEvents - self.lastUpdate > self.updateIntervalEvents):
+            fullUpdateDue = (self.fullUpdateIntervalEvents > 0) and \
+                            (self.numEvents - self.lastFullUpdate > self.fullUpdateIntervalEvents)
+            updateDue = (self.updateIntervalEvents > 0) and (self.numEvents - self.lastUpdate > self.updateIntervalEvents)
+            if (fullUpdateDue or updateDue) and self.viewerBusyWithUpdate():
+                # asyncUpdate or updateMaxFraction - only one update in flight, try again after the next event
+                pass
+            elif fullUpdateDue:
+                self.lastFullUpdate = self.numEvents
+                self.lastUpdate = self.numEvents
+                self.logger.debug("CommSystem: Informing viewers and workers to do a full update" )
+                self.informOfUpdate(latestEventId)
+            elif updateDue:
                 self.lastUpdate = self.numEvents
-                self.logger.debug("CommSystem: Informing viewers and workers to update" )
-                self.informViewerOfUpdate(latestEventId)
-                self.informWorkersToUpdateViewer()
+                light = self.fullUpdateIntervalEvents > 0
+                self.logger.debug("CommSystem: Informing viewers and workers to update light=%s" % light)
+                self.informOfUpdate(latestEventId, light)
+
+            # check to see if workers should be rebalanced
+            if (self.rebalanceInterval > 0) and (self.numEvents - self.lastRebalanceCheck >= self.rebalanceInterval):
+                self.lastRebalanceCheck = self.numEvents
+                self.rebalanceWorkers(serverRequests, serverReceiveData)
+
+            # check to see if the workers should checkpoint
+            if (self.checkpointInterval > 0) and (self.numEvents - self.lastCheckpoint >= self.checkpointInterval):
+                self.lastCheckpoint = self.numEvents
+                self.checkpointWorkers(latestEventId)
 
             # check to display message
             eventsSinceLastDataRateMsg = self.numEvents - numEventsAtLastDataRateMsg
@@ -806,13 +1179,14 @@ class RunMaster(object):
         assert noData == False, "There was no data in master loop"
 
         # one last datarate msg
-        dataRateHz = self.numEvents/(time.time()-startTime)
+        dataRateHz = (self.numEvents - numEventsAtStart)/(time.time()-startTime)
         self.logger.info("Overall data rate is %.2f Hz. Number of events is %d" % (dataRateHz, self.numEvents))
 
         # send one last update at the end
         self.logger.debug("CommSystem: servers finished. sending one last update")
-        self.informViewerOfUpdate(latestEventId)
-        self.informWorkersToUpdateViewer()
+        self.waitForViewerDoneWithUpdate()
+        self.informOfUpdate(latestEventId)
+        self.waitForViewerDoneWithUpdate()
 
         self.sendEndToWorkers()
         self.sendEndToViewer()
@@ -827,6 +1201,7 @@ class RunWorker(object):
         self.isFirstWorker = isFirstWorker
         self.msgBuffer = MVW_MsgBuffer()
         self.evtNumber = 0
+        self.reducedFullUpdate = xCorrBase.reducedFullUpdate()
 
     @Timing.timecall(timingDict=timingdict)
     def workerWaitForMasterBcast(self):
@@ -840,13 +1215,39 @@ class RunWorker(object):
         self.xCorrBase.serverWorkersScatter(detectorData1Darray=None,
                                      serverWorldRank = serverWorldRank)
 
+    @Timing.timecall(timingDict=timingdict)
+    def serverWorkersSendTimeParallel(self, counter, serverWorldRank):
+        return self.xCorrBase.serverWorkersSendTimeParallel(counter, detectorData1Darray=None,
+                                                            serverWorldRank = serverWorldRank)
+
     @Timing.timecall(timingDict=timingdict)
     def storeNewWorkerData(self, counter):
         self.xCorrBase.storeNewWorkerData(counter = counter)
 
     @Timing.timecall(timingDict=timingdict)
     def viewerWorkersUpdate(self, lastTime):
-        self.xCorrBase.viewerWorkersUpdate(lastTime = lastTime)
+        self.xCorrBase.viewerWorkersUpdate(lastTime = lastTime, reduced = self.reducedFullUpdate)
+
+    @Timing.timecall(timingDict=timingdict)
+    def viewerWorkersLightUpdate(self, lastTime):
+        self.xCorrBase.viewerWorkersUpdate(lastTime = lastTime, reduced = True)
+
+    @Timing.timecall(timingDict=timingdict)
+    def writeCheckpoint(self, checkpointNumber):
+        self.xCorrBase.workerCheckpoint(checkpointNumber)
+        # tells the master this worker is done
+        self.masterWorkersComm.gather(self.xCorrBase.mp.rank, root=self.masterRankInMasterWorkersComm)
+
+    @Timing.timecall(timingDict=timingdict)
+    def rebalance(self):
+        busyTime = self.xCorrBase.workerBusyTimeSinceLastCheck()
+        self.masterWorkersComm.gather((self.xCorrBase.mp.rank, busyTime), 
+                                      root=self.masterRankInMasterWorkersComm)
+        workerCounts = np.zeros(self.xCorrBase.mp.numWorkers, np.int64)
+        self.masterWorkersComm.Bcast([workerCounts, MPI.INT64_T],
+                                     root=self.masterRankInMasterWorkersComm)
+        if list(workerCounts) != self.xCorrBase.mp.workerCounts():
+            self.xCorrBase.workerRepartition(workerCounts)
 
     def run(self):
         lastTime = {'sec':0, 'nsec':0, 'fiducials':0, 'counter':0}
@@ -862,15 +1263,31 @@ class RunWorker(object):
                 if self.logger.isEnabledFor(logging.DEBUG):
                     self.logger.debug("CommSystem.run: after Bcast from master. EVT server=%2d counter=%d" % \
                                       (serverWithData, lastTime['counter']))
-                self.serverWorkersScatter(serverWorldRank = serverWithData)
-                self.storeNewWorkerData(counter = lastTime['counter'])
+                if self.xCorrBase.timeParallel:
+                    # only the workers that store this time receive it
+                    if self.serverWorkersSendTimeParallel(lastTime['counter'], serverWorldRank = serverWithData):
+                        self.storeNewWorkerData(counter = lastTime['counter'])
+                else:
+                    self.serverWorkersScatter(serverWorldRank = serverWithData)
+                    self.storeNewWorkerData(counter = lastTime['counter'])
+                self.xCorrBase.workerProgressAsyncGather()
 
             elif self.msgBuffer.isUpdate():
                 self.logger.debug("CommSystem.run: after Bcast from master - UPDATE")
                 self.viewerWorkersUpdate(lastTime = lastTime)
                 self.logger.debug("CommSystem.run: returned from viewer workers update")
+            elif self.msgBuffer.isLightUpdate():
+                self.logger.debug("CommSystem.run: after Bcast from master - LIGHT_UPDATE")
+                self.viewerWorkersLightUpdate(lastTime = lastTime)
+            elif self.msgBuffer.isRebalance():
+                self.logger.debug("CommSystem.run: after Bcast from master - REBALANCE")
+                self.rebalance()
+            elif self.msgBuffer.isCheckpoint():
+                self.logger.debug("CommSystem.run: after Bcast from master - CHECKPOINT")
+                self.writeCheckpoint(self.msgBuffer.getCounter())
             elif self.msgBuffer.isEnd():
                 self.logger.debug("CommSystem.run: after Bcast from master - END. quiting")
+                self.xCorrBase.workerFinishAsyncGather()
                 break
             else:
                 raise Exception("unknown msgtag")
@@ -883,6 +1300,9 @@ class RunViewer(object):
         self.logger = logger
         self.xCorrBase = xCorrBase
         self.msgbuffer = MVW_MsgBuffer()
+        self.reducedFullUpdate = xCorrBase.reducedFullUpdate()
+        self.asyncUpdate = xCorrBase.asyncUpdate
+        self.updateMaxFraction = CommSystemUtil.getOptionalSystemParam(xCorrBase.system_params, 'updateMaxFraction')
 
     @Timing.timecall(timingDict=timingdict)
     def waitForMasterMessage(self):
@@ -892,7 +1312,19 @@ class RunViewer(object):
 
     @Timing.timecall(timingDict=timingdict)
     def viewerWorkersUpdate(self, lastTime):
-        self.xCorrBase.viewerWorkersUpdate(lastTime)
+        self.xCorrBase.viewerWorkersUpdate(lastTime, reduced = self.reducedFullUpdate)
+
+    @Timing.timecall(timingDict=timingdict)
+    def viewerWorkersLightUpdate(self, lastTime):
+        self.xCorrBase.viewerWorkersUpdate(lastTime, reduced = True)
+
+    def receiveWorkerCountsFromMaster(self):
+        workerCounts = np.zeros(self.xCorrBase.mp.numWorkers, np.int64)
+        self.worldComm.Recv([workerCounts, MPI.INT64_T], source=self.masterRank)
+        self.xCorrBase.viewerRepartition(workerCounts)
+
+    def sendUpdateDoneToMaster(self, updateSeconds):
+        self.worldComm.Send([np.array([updateSeconds], np.float64), MPI.DOUBLE], dest=self.masterRank)
 
     def run(self):
         while True:
@@ -903,14 +1335,68 @@ class RunViewer(object):
                 lastTime = self.msgbuffer.getTime()
                 if self.logger.isEnabledFor(logging.DEBUG):
                     self.logger.debug('CommSystem.run: after Recv from master. get UPDATE: counter=%d' % lastTime['counter'])
+                t0 = time.time()
                 self.viewerWorkersUpdate(lastTime = lastTime)
+                if viewerReportsUpdateDone(self.asyncUpdate, self.updateMaxFraction, light=False):
+                    self.sendUpdateDoneToMaster(time.time()-t0)
+            elif self.msgbuffer.isLightUpdate():
+                lastTime = self.msgbuffer.getTime()
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('CommSystem.run: after Recv from master. get LIGHT_UPDATE: counter=%d' % lastTime['counter'])
+                t0 = time.time()
+                self.viewerWorkersLightUpdate(lastTime = lastTime)
+                if viewerReportsUpdateDone(self.asyncUpdate, self.updateMaxFraction, light=True):
+                    self.sendUpdateDoneToMaster(time.time()-t0)
+            elif self.msgbuffer.isRebalance():
+                self.logger.debug('CommSystem.run: after Recv from master. get REBALANCE')
+                self.receiveWorkerCountsFromMaster()
             elif self.msgbuffer.isEnd():
                 self.logger.debug('CommSystem.run: after Recv from master. get END. quiting.')
+                self.xCorrBase.viewerInformHelpers(('END',))
                 break
             else:
                 raise Exception("unknown msgtag")
         self.xCorrBase.shutdown_viewer()
 
+class RunHelperViewer(object):
+    '''runs the viewers other than the first, when system_params['numViewers'] > 1.
+
+    The master only talks to the first viewer. It passes updates and worker rebalancing on to 
+    the helper viewers, see XCorrBase.viewerInformHelpers.
+    '''
+    def __init__(self, viewersComm, xCorrBase, logger):
+        self.viewersComm = viewersComm
+        self.xCorrBase = xCorrBase
+        self.logger = logger
+
+    @Timing.timecall(timingDict=timingdict)
+    def waitForViewerMessage(self):
+        # the first viewer is rank 0 in viewersComm
+        return self.viewersComm.bcast(None, root=0)
+
+    @Timing.timecall(timingDict=timingdict)
+    def helperViewerUpdate(self, lastTime, counts, int8changed, int8values):
+        self.xCorrBase.helperViewerUpdate(lastTime, counts, int8changed, int8values)
+
+    def run(self):
+        while True:
+            self.logger.debug('CommSystem.run: before bcast from first viewer')
+            msg = self.waitForViewerMessage()
+            if msg[0] == 'UPDATE':
+                lastTime = msg[1]
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('CommSystem.run: after bcast from first viewer. get UPDATE: counter=%d' % lastTime['counter'])
+                self.helperViewerUpdate(*msg[1:])
+            elif msg[0] == 'REBALANCE':
+                self.logger.debug('CommSystem.run: after bcast from first viewer. get REBALANCE')
+                self.xCorrBase.viewerRepartition(msg[1])
+            elif msg[0] == 'END':
+                self.logger.debug('CommSystem.run: after bcast from first viewer. get END. quiting.')
+                break
+            else:
+                raise Exception("unknown message from first viewer: %s" % msg[0])
+        self.xCorrBase.shutdown_viewer()
+
 def runTestAlt(mp, xCorrBase):
     xCorrBase.serverInit()
     xCorrBase.workerInit()
@@ -920,9 +1406,16 @@ def runTestAlt(mp, xCorrBase):
     allData = []
     mp.logInfo("Starting to read through data for test_alt")
     for datum in eventIter.dataGenerator():
-        maskedData = datum.dataArray[mp.maskNdarrayCoords]
-        maskedData = maskedData.flatten().copy()
-        xCorrBase.userObj.workerAdjustData(maskedData)
+        maskedData = mp.maskedFlat(datum.dataArray)
+        if xCorrBase.sparse:
+            # the dense photon counts, what the workers store in the sparse mode
+            pixels, photons = CommSystemUtil.photonize(maskedData, xCorrBase.photonADU, xCorrBase.photonThreshold)
+            if hasattr(xCorrBase.userObj, 'workerAdjustSparseData'):
+                xCorrBase.userObj.workerAdjustSparseData(pixels, photons)
+            maskedData = np.zeros(len(maskedData), np.float32)
+            maskedData[pixels] = photons
+        else:
+            xCorrBase.userObj.workerAdjustData(maskedData)
 
         eventIds.append((datum.sec, datum.nsec, datum.fiducials))
         allData.append(maskedData)
@@ -983,9 +1476,25 @@ def runCommSystem(mp, updateInterval, xCorrBase, hostmsg, serversRoundRobin, tes
                 timingNode = 'FIRST SERVER'
 
         elif mp.isMaster:
+            system_params = xCorrBase.system_params
+            resumeState = None
+            if xCorrBase.resume:
+                resumeState = readCheckpointMaster(xCorrBase.checkpoint)
             runMaster = RunMaster(mp.comm, mp.masterRank, mp.viewerRank, mp.serverRanks, serversRoundRobin,
                                   mp.masterWorkersComm, mp.masterRankInMasterWorkersComm,
-                                  updateInterval, hostmsg, logger)
+                                  updateInterval, hostmsg, logger,
+                                  workerRanks=mp.workerRanks,
+                                  workerCounts=mp.workerCounts(),
+                                  rebalanceInterval=CommSystemUtil.getOptionalSystemParam(system_params, 'rebalanceInterval'),
+                                  rebalanceThreshold=CommSystemUtil.getOptionalSystemParam(system_params, 'rebalanceThreshold'),
+                                  rebalanceChecks=CommSystemUtil.getOptionalSystemParam(system_params, 'rebalanceChecks'),
+                                  fullUpdateIntervalEvents=CommSystemUtil.getOptionalSystemParam(system_params, 'fullUpdate'),
+                                  asyncUpdate=xCorrBase.asyncUpdate,
+                                  updateMaxFraction=CommSystemUtil.getOptionalSystemParam(system_params, 'updateMaxFraction'),
+                                  checkpoint=xCorrBase.checkpoint,
+                                  checkpointInterval=xCorrBase.checkpointInterval,
+                                  numTimes=system_params['times'],
+                                  resumeState=resumeState)
             runMaster.run()
             reportTiming = True
             timingNode = 'MASTER'
@@ -996,12 +1505,20 @@ def runCommSystem(mp, updateInterval, xCorrBase, hostmsg, serversRoundRobin, tes
             runViewer.run()
             reportTiming = True
             timingNode = 'VIEWER'
+            if xCorrBase.h5writer is not None:
+                timingdict.update(xCorrBase.h5writer.timingDict)
+
+        elif mp.isHelperViewer:
+            xCorrBase.viewerInit()
+            runHelperViewer = RunHelperViewer(mp.viewersComm, xCorrBase, logger)
+            runHelperViewer.run()
 
         elif mp.isWorker:
             xCorrBase.workerInit()
             runWorker = RunWorker(mp.masterWorkersComm, mp.masterRankInMasterWorkersComm,
                                   xCorrBase, logger, mp.isFirstWorker)
             runWorker.run()
+            xCorrBase.shutdown_worker()
             if mp.isFirstWorker:
                 reportTiming = True
                 timingNode = 'FIRST WORKER'
@@ -1034,7 +1551,7 @@ def isNoneOrListOfStrings(arg):
     return isListOfStrings(arg)
 
 class CommSystemFramework(object):
-    def __init__(self, system_params, user_params, test_alt=False):
+    def __init__(self, system_params, user_params, test_alt=False, resume=False):
         CommSystemUtil.checkParams(system_params, user_params)
         numServers = int(system_params['numServers'])
         dataset = system_params['dataset']
@@ -1054,7 +1571,8 @@ class CommSystemFramework(object):
                                                        serverHosts,
                                                        excludeRank0=True)
             # set mpi paramemeters for framework
-            mp = identifyCommSubsystems(serverRanks=serverRanks, worldComm=MPI.COMM_WORLD)
+            mp = identifyCommSubsystems(serverRanks=serverRanks, worldComm=MPI.COMM_WORLD,
+                                        numViewers=CommSystemUtil.getOptionalSystemParam(system_params, 'numViewers'))
 
         self.hostmsg = hostmsg
         verbosity = system_params['verbosity']
@@ -1062,7 +1580,22 @@ class CommSystemFramework(object):
         maskNdarrayCoords_Filename = system_params['maskNdarrayCoords']
         assert os.path.exists(maskNdarrayCoords_Filename), "mask file %s not found" % maskNdarrayCoords_Filename
         maskNdarrayCoords = np.load(maskNdarrayCoords_Filename).astype(np.int8)
-        mp.setMask(maskNdarrayCoords)
+        maskNdarrayCoords = self.restrictMask(mp, maskNdarrayCoords, system_params, user_params)
+        orderLabels = None
+        orderLabelFiles = CommSystemUtil.getOptionalSystemParam(system_params, 'orderPixelsByLabels')
+        if orderLabelFiles is not None:
+            if isinstance(orderLabelFiles, str):
+                orderLabelFiles = [orderLabelFiles]
+            orderLabels = []
+            for orderLabelFile in orderLabelFiles:
+                assert os.path.exists(orderLabelFile), "orderPixelsByLabels file %s not found" % orderLabelFile
+                orderLabels.append(np.load(orderLabelFile).astype(np.int32))
+        delayGroups = 1
+        if not test_alt:
+            delayGroups = CommSystemUtil.getOptionalSystemParam(system_params, 'delayGroups')
+            assert mp.numWorkers % delayGroups == 0, "system_params['delayGroups']=%d does not divide the %d workers" % \
+                (delayGroups, mp.numWorkers)
+        mp.setMask(maskNdarrayCoords, orderLabels, delayGroups)
         srcString = system_params['src']
         numEvents = system_params['numEvents']
         maxTimes = system_params['times']
@@ -1077,12 +1610,42 @@ class CommSystemFramework(object):
                               maxTimes, 
                               system_params, 
                               user_params,
-                              test_alt)
+                              test_alt,
+                              resume)
         self.mp = mp
         self.xcorrBase = xcorrBase
         self.maxTimes = maxTimes
         self.updateInterval = system_params['update']
-        
+
+    def restrictMask(self, mp, maskNdarrayCoords, system_params, user_params):
+        '''applies system_params maskDropColorZero and excludePixelFiles to the mask, before
+        the pixels are divided among the workers. Logs how many pixels are removed.
+        '''
+        colorNdarrayCoords = None
+        if CommSystemUtil.getOptionalSystemParam(system_params, 'maskDropColorZero'):
+            assert 'colorNdarrayCoords' in user_params, "system_params maskDropColorZero is True, but there is no user_params['colorNdarrayCoords']"
+            colorFile = user_params['colorNdarrayCoords']
+            assert os.path.exists(colorFile), "color file %s not found" % colorFile
+            colorNdarrayCoords = np.load(colorFile).astype(np.int32)
+        excludePixels = []
+        excludePixelFiles = CommSystemUtil.getOptionalSystemParam(system_params, 'excludePixelFiles')
+        if excludePixelFiles is not None:
+            if isinstance(excludePixelFiles, str):
+                excludePixelFiles = [excludePixelFiles]
+            for excludePixelFile in excludePixelFiles:
+                assert os.path.exists(excludePixelFile), "excludePixelFiles file %s not found" % excludePixelFile
+                excludePixels.append(np.load(excludePixelFile))
+        if colorNdarrayCoords is None and len(excludePixels) == 0:
+            return maskNdarrayCoords
+        numBefore = int(np.sum(maskNdarrayCoords == 1))
+        restricted = CommSystemUtil.restrictMask(maskNdarrayCoords, colorNdarrayCoords, excludePixels)
+        numAfter = int(np.sum(restricted == 1))
+        assert numAfter > 0, "maskDropColorZero and excludePixelFiles removed every pixel in the mask"
+        # the time workers spend storing and correlating goes with the number of pixels
+        mp.logInfo("restrictMask: removed %d of %d mask pixels (%.1f%%), expected worker speedup %.2fx" % \
+                   (numBefore - numAfter, numBefore, 100.0*(numBefore - numAfter)/float(numBefore), numBefore/float(numAfter)))
+        return restricted
+
     def run(self):
         return runCommSystem(self.mp, self.updateInterval, self.xcorrBase, self.hostmsg, self.serversRoundRobin, self.test_alt)
 
@@ -99,6 +99,171 @@ def divideAmongWorkers(dataLength, numWorkers):
     checkCountsOffsets(counts, offsets, dataLength)
     return offsets, counts
 
+def divideAmongDelayGroups(dataLength, numWorkers, delayGroups):
+    '''partition the data among groups of delayGroups workers. Worker w is in pixel group 
+    w // delayGroups and delay group w % delayGroups. The first worker of each pixel group gets the
+    pixels of the group, the other workers in the group get a count of 0.
+
+    Examples:
+      >>> divideAmongDelayGroups(11,6,2)
+      returns offsets=[0,4,4,8,8,11]
+              counts=[4,0,4,0,3,0]
+    '''
+    assert delayGroups > 0, "divideAmongDelayGroups - delayGroups is <= 0"
+    assert numWorkers % delayGroups == 0, "divideAmongDelayGroups - numWorkers=%d is not a multiple of delayGroups=%d" % \
+        (numWorkers, delayGroups)
+    groupOffsets, groupCounts = divideAmongWorkers(dataLength, numWorkers // delayGroups)
+    offsets=[]
+    counts=[]
+    for groupOffset, groupCount in zip(groupOffsets, groupCounts):
+        offsets.append(groupOffset)
+        counts.append(groupCount)
+        for delayGroup in range(1, delayGroups):
+            offsets.append(groupOffset + groupCount)
+            counts.append(0)
+    checkCountsOffsets(counts, offsets, dataLength)
+    return offsets, counts
+
+def viewerDelayBlocks(numDelays, numViewers, viewerDelayBlock):
+    '''divides the delays among the viewers, and the delays of each viewer into the blocks it
+    gathers. Each viewer gets a contiguous range of the delays, the first viewer the first delays.
+    A viewer gathers all its delays at once, or viewerDelayBlock at a time if that is > 0.
+
+    Returns:
+      numGatherDelays - the most delays gathered at once
+      blocks          - for each viewer, a list of (blockStart, blockEnd) delay indices
+
+    Examples:
+      >>> viewerDelayBlocks(7,2,3)
+      returns numGatherDelays=3
+              blocks=[[(0,3),(3,4)], [(4,7)]]
+    '''
+    viewerDelayOffsets, viewerDelayCounts = divideAmongWorkers(numDelays, numViewers)
+    numGatherDelays = max(viewerDelayCounts)
+    if viewerDelayBlock > 0:
+        numGatherDelays = min(viewerDelayBlock, numGatherDelays)
+    blocks = []
+    for viewerOffset, viewerCount in zip(viewerDelayOffsets, viewerDelayCounts):
+        viewerEnd = viewerOffset + viewerCount
+        blocks.append([(blockStart, min(viewerEnd, blockStart + numGatherDelays)) \
+                       for blockStart in range(viewerOffset, viewerEnd, numGatherDelays)])
+    return numGatherDelays, blocks
+
+def delayGroupIndices(numDelays, delayGroups, delayGroup):
+    '''returns the indices of the delays that a worker in delayGroup computes. The delays are
+    dealt round robin, so each group gets short and long delays.
+
+    Examples:
+      >>> delayGroupIndices(5,2,1)
+      [1, 3]
+    '''
+    assert delayGroup >= 0 and delayGroup < delayGroups, "delayGroup=%d not in [0,%d)" % (delayGroup, delayGroups)
+    return list(range(delayGroup, numDelays, delayGroups))
+
+def identifyStraggler(busyTimes, threshold):
+    '''identifies a worker that is significantly slower than the others.
+
+    Args:
+      busyTimes (list): seconds each worker spent processing its pixels over the same events
+      threshold (float): a worker is a straggler if its busy time is more than threshold times
+                         the median busy time
+
+    Return:
+      index of the slowest worker if it is a straggler, otherwise None
+
+    Examples:
+      >>> identifyStraggler([1.0, 1.1, 2.5, 0.9], 1.5)
+      2
+    '''
+    if len(busyTimes) < 2:
+        return None
+    medianBusy = np.median(busyTimes)
+    if medianBusy <= 0.0:
+        return None
+    slowest = int(np.argmax(busyTimes))
+    if busyTimes[slowest] > threshold * medianBusy:
+        return slowest
+    return None
+
+def migrateFromStraggler(counts, busyTimes, straggler, threshold):
+    '''returns new worker counts that move pixels from a straggler to its neighbors.
+
+    Pixels are assigned to workers in contiguous ranges, so the straggler gives the pixels
+    at the edges of its range to the workers on either side of it. The number of pixels moved
+    is estimated so the straggler would finish in the median busy time. At most half of the
+    straggler's pixels are moved at once, and neighbors that are themselves slower than
+    threshold times the median do not receive pixels.
+
+    Args:
+      counts (list): current number of pixels for each worker, in worker order
+      busyTimes (list): busy time for each worker, same order as counts
+      straggler (int): index of straggler, as returned by identifyStraggler
+      threshold (float): same threshold passed to identifyStraggler
+
+    Return:
+      list of new counts, the same as counts if nothing can be moved.
+
+    Examples:
+      >>> migrateFromStraggler([10,10,10], [1.0, 2.0, 1.0], 1, 1.5)
+      [12, 5, 13]
+    '''
+    newCounts = [int(c) for c in counts]
+    medianBusy = np.median(busyTimes)
+    slowCount = newCounts[straggler]
+    if slowCount < 2 or busyTimes[straggler] <= 0.0:
+        return newCounts
+    target = int(math.floor(slowCount * medianBusy / busyTimes[straggler]))
+    target = max(target, slowCount - slowCount//2)
+    excess = slowCount - target
+    neighbors = [idx for idx in [straggler-1, straggler+1] \
+                 if idx >= 0 and idx < len(newCounts) and busyTimes[idx] <= threshold * medianBusy]
+    if excess <= 0 or len(neighbors)==0:
+        return newCounts
+    newCounts[straggler] -= excess
+    if len(neighbors)==1:
+        newCounts[neighbors[0]] += excess
+    else:
+        newCounts[neighbors[0]] += excess//2
+        newCounts[neighbors[1]] += excess - excess//2
+    assert sum(newCounts)==sum(counts), "migrateFromStraggler: internal error, counts not preserved"
+    return newCounts
+
+def migrationCountsOffsets(oldCounts, newCounts, workerIdx):
+    '''For moving contiguous ranges of pixels between workers, computes the send and receive
+    counts and offsets for one worker.
+
+    Both oldCounts and newCounts partition the same pixels into contiguous ranges, in worker
+    order. The worker sends the part of its old range that falls in each worker's new range,
+    and receives the part of each worker's old range that falls in its new range. Counts and
+    offsets are in pixels, relative to the start of the workers old range (for sending) or new
+    range (for receiving).
+
+    Return:
+      sendCounts, sendOffsets, recvCounts, recvOffsets - each a list with one entry per worker
+
+    Examples:
+      >>> migrationCountsOffsets([4,4], [3,5], 0)
+      ([3, 1], [0, 3], [3, 0], [0, 3])
+    '''
+    assert sum(oldCounts)==sum(newCounts), "migrationCountsOffsets: old and new counts do not partition the same pixels"
+    oldOffsets = [0] + list(np.cumsum(oldCounts)[0:-1])
+    newOffsets = [0] + list(np.cumsum(newCounts)[0:-1])
+
+    def overlap(startA, countA, startB, countB):
+        start = max(startA, startB)
+        end = min(startA + countA, startB + countB)
+        return start, max(0, end - start)
+
+    sendCounts, sendOffsets, recvCounts, recvOffsets = [], [], [], []
+    for other in range(len(oldCounts)):
+        start, count = overlap(oldOffsets[workerIdx], oldCounts[workerIdx], newOffsets[other], newCounts[other])
+        sendCounts.append(int(count))
+        sendOffsets.append(int(start - oldOffsets[workerIdx]) if count > 0 else int(sum(sendCounts[0:-1])))
+        start, count = overlap(oldOffsets[other], oldCounts[other], newOffsets[workerIdx], newCounts[workerIdx])
+        recvCounts.append(int(count))
+        recvOffsets.append(int(start - newOffsets[workerIdx]) if count > 0 else int(sum(recvCounts[0:-1])))
+    return sendCounts, sendOffsets, recvCounts, recvOffsets
+
 loggers = {}
 
 def makeLogger(isTestMode, isMaster, isViewer, isServer, rank, lvl='INFO', propagate=False):
@@ -157,6 +322,140 @@ def makeLogger(isTestMode, isMaster, isViewer, isServer, rank, lvl='INFO', propa
     loggers[loggerName]=logger
     return logger
 
+# keys in system_params that are optional, and the value the framework uses when they are not given
+optionalSystemKeyDefaults = {'rebalanceInterval':0,
+                             'rebalanceThreshold':1.5,
+                             'rebalanceChecks':2,
+                             'orderPixelsByLabels':None,
+                             'workerReduce':False,
+                             'fullUpdate':0,
+                             'asyncUpdate':False,
+                             'viewerDelayBlock':0,
+                             'updateMaxFraction':0.0,
+                             'numViewers':1,
+                             'h5maskedFlat':False,
+                             'h5writerQueue':0,
+                             'h5parallel':False,
+                             'checkpoint':None,
+                             'checkpointInterval':0,
+                             'workerStoreDir':None,
+                             'workerBlockTimes':0,
+                             'workerStoreLayout':'time',
+                             'workerInsertBlock':0,
+                             'sparsePhotonADU':None,
+                             'sparsePhotonThreshold':0.5,
+                             'maskDropColorZero':False,
+                             'excludePixelFiles':None,
+                             'timeParallel':False,
+                             'delayGroups':1}
+
+def timeBlockOwners(counter, blockCounters, numWorkers, halo):
+    '''For the time parallel decomposition, returns the workers that store the event at counter.
+
+    The counters are divided into blocks of blockCounters, worker b % numWorkers owns block b. A
+    worker also stores the halo counters after its block, to pair them with the end of the block.
+
+    ARGS:
+      counter       - 120hz counter of the event
+      blockCounters - counters in a block
+      numWorkers    - number of workers
+      halo          - counters after a block that its owner stores, max(delays)
+
+    Return:
+      list of worker indices, the owner of the block of counter first
+
+    Examples:
+      >>> timeBlockOwners(12, 10, 3, 5)
+      [1, 0]
+    '''
+    owners = []
+    block = counter // blockCounters
+    while block >= 0 and counter < (block + 1) * blockCounters + halo and len(owners) < numWorkers:
+        owner = int(block % numWorkers)
+        if owner not in owners:
+            owners.append(owner)
+        block -= 1
+    return owners
+
+def restrictMask(maskNdarrayCoords, colorNdarrayCoords=None, excludePixels=None):
+    '''returns a copy of the mask with fewer pixels turned on.
+
+    ARGS:
+      maskNdarrayCoords  - 0/1 mask
+      colorNdarrayCoords - if not None, pixels with color 0 are turned off
+      excludePixels      - list of arrays of pixels to turn off. An array with the shape of the mask 
+                           turns off the pixels where it is nonzero, otherwise it is a list of flat 
+                           indices into the mask.
+    Return:
+      the new mask, same dtype as maskNdarrayCoords
+
+    Examples:
+      >>> restrictMask(np.array([1,1,1,0]), np.array([0,2,1,1]), [np.array([2])])
+      array([0, 1, 0, 0])
+    '''
+    mask = maskNdarrayCoords.copy()
+    if colorNdarrayCoords is not None:
+        assert colorNdarrayCoords.shape == mask.shape, "restrictMask: color shape=%s != mask shape=%s" % (colorNdarrayCoords.shape, mask.shape)
+        mask[colorNdarrayCoords < 1] = 0
+    if excludePixels is None:
+        excludePixels = []
+    for exclude in excludePixels:
+        if exclude.shape == mask.shape:
+            mask[exclude != 0] = 0
+        else:
+            flatIndices = np.asarray(exclude, dtype=np.int64).flatten()
+            assert np.all((flatIndices >= 0) & (flatIndices < mask.size)), "restrictMask: pixel indices outside of the mask"
+            mask.flat[flatIndices] = 0
+    return mask
+
+def photonize(data, photonADU, threshold=0.5):
+    '''converts detector data to photon counts, for the sparse photon mode.
+
+    A value is counted as n photons when it is at least n-1+threshold photons worth of ADU.
+    With threshold=0.5 this is rounding to the nearest number of photons.
+
+    ARGS:
+      data       - 1D array of detector data
+      photonADU  - ADU of one photon
+      threshold  - fraction of a photon to count as a photon
+
+    Return:
+      pixels, photons - np.int32 arrays, the sorted indices into data with photons, and the counts
+
+    Examples:
+      >>> photonize(np.array([0.2, 1.6, 0.0, 30.9]), 10.0)
+      (array([3], dtype=int32), array([3], dtype=int32))
+    '''
+    assert photonADU > 0, "photonize: photonADU=%r must be > 0" % photonADU
+    photons = np.floor(np.asarray(data, dtype=np.float64) / photonADU + (1.0 - threshold))
+    pixels = np.flatnonzero(photons > 0).astype(np.int32)
+    return pixels, photons[pixels].astype(np.int32)
+
+def adaptUpdateInterval(intervalEvents, updateSeconds, cycleSeconds, maxFraction, minEvents, maxEvents):
+    '''returns a new number of events between updates, so that updates take about maxFraction
+    of the time. 
+
+    ARGS:
+      intervalEvents - current number of events between updates
+      updateSeconds  - how long the last update took
+      cycleSeconds   - time from the start of the last update to the start of the next one
+      maxFraction    - fraction of the time to spend in updates
+      minEvents, maxEvents - bounds for the returned interval
+    RETURN:
+      new interval, changes by at most a factor of 2 from intervalEvents
+    '''
+    if cycleSeconds <= 0.0:
+        return intervalEvents
+    scale = (updateSeconds / cycleSeconds) / maxFraction
+    scale = min(2.0, max(0.5, scale))
+    return int(min(maxEvents, max(minEvents, round(intervalEvents * scale))))
+
+def getOptionalSystemParam(system_params, key):
+    '''returns value of optional key in system_params, or its default if not present
+    '''
+    assert key in optionalSystemKeyDefaults, "%s is not an optional key in system_params" % key
+    return system_params.get(key, optionalSystemKeyDefaults[key])
+
 def checkParams(system_params, user_params, checkUserParams=False):
     '''Checks for correct keys in system_params. Optionally checks userParams.
 
@@ -192,7 +491,7 @@ def checkParams(system_params, user_params, checkUserParams=False):
                               'testNumEvents'])
 
     undefinedSystemKeys = expectedSystemKeys.difference(set(system_params.keys()))
-    newSystemKeys = set(system_params.keys()).difference(expectedSystemKeys)
+    newSystemKeys = set(system_params.keys()).difference(expectedSystemKeys).difference(set(optionalSystemKeyDefaults.keys()))
     assert len(undefinedSystemKeys)==0, "Required keys are not in system_params: %r" % \
         (undefinedSystemKeys,)
     if len(newSystemKeys)>0 and MPI.COMM_WORLD.Get_rank()==0:
@@ -229,7 +528,8 @@ def checkParams(system_params, user_params, checkUserParams=False):
         masked_color = mask * color
         pixel_waste =  np.sum(masked_color <= 0)
         pixels_on = np.sum(masked_color > 0)
-        if pixel_waste > 0 and MPI.COMM_WORLD.Get_rank() == 0:
+        dropped = getOptionalSystemParam(system_params, 'maskDropColorZero')
+        if pixel_waste > 0 and (not dropped) and MPI.COMM_WORLD.Get_rank() == 0:
             sys.stderr.write(("Warning: there are %d or %.1f%% pixels that are 0 or < 0 in the color file: "+
                              "%s that are not 0 in the mask file: %s. These pixels will still be "+
                               "procssed by workers, but not the viewer. Consider turning them off in the " +
@@ -298,4 +598,61 @@ def replaceSubsetsWithAverage(A, labels, label2total=None):
     avgA.resize(A.shape)
     return avgA
 
+class PixelLabels(object):
+    '''Precomputed pixel -> label map of a label ndarray, for forming the sums over the
+    labels of many arrays, for instance the same kind of array at all the delays.
+
+    Sums are done with np.bincount over the flattened arrays, so they are the same as what
+    replaceSubsetsWithAverage computes. Label 0 is taken to be unlabeled pixels.
+
+    Attributes:
+      flatLabels - the labels, flattened, as the index type np.bincount wants
+      numBins    - length of the arrays returned by labelSums, one more than the max label
+      labels     - the labels > 0 that are present, sorted
+      totals     - number of pixels with each label in labels
+      binTotals  - number of pixels for each bin, 1 for bins that are not in labels
+    '''
+    def __init__(self, labels):
+        self.shape = labels.shape
+        self.flatLabels = labels.flatten().astype(np.intp)
+        self.binCounts = np.bincount(self.flatLabels, minlength=1)
+        self.numBins = len(self.binCounts)
+        self.setLabelsFromBinCounts()
+
+    def setLabelsFromBinCounts(self):
+        self.labels = np.flatnonzero(self.binCounts[1:]) + 1
+        self.totals = self.binCounts[self.labels]
+        self.binTotals = np.ones(self.numBins, np.float64)
+        self.binTotals[self.labels] = self.totals
+
+    def removePixels(self, flatIndices):
+        '''sets the label of the given pixels to 0. Only looks at those pixels.
+        '''
+        removedLabels = self.flatLabels[flatIndices]
+        self.binCounts -= np.bincount(removedLabels, minlength=self.numBins)
+        self.binCounts[0] += len(removedLabels)
+        self.flatLabels[flatIndices] = 0
+        self.setLabelsFromBinCounts()
+
+    def labelSums(self, A, out=None):
+        '''returns float64 sums of A over each label. Put in out if it is given.
+        '''
+        assert A.shape == self.shape, "labelSums: A.shape=%s != labels shape=%s" % (A.shape, self.shape)
+        sums = np.bincount(self.flatLabels, A.reshape(-1), minlength=self.numBins)
+        if out is None:
+            return sums
+        out[:] = sums
+        return out
+
+    def labelAverages(self, labelSums):
+        '''divides sums from labelSums by the pixel totals. labelSums can be 2D, (n x numBins),
+        to do many at once. Bins that are not in labels are left as the sum.
+        '''
+        return labelSums / self.binTotals
+
+    def toPixels(self, labelValues):
+        '''returns ndarray with each pixel set to the value for its label
+        '''
+        return np.take(labelValues, self.flatLabels).reshape(self.shape)
+
 # EOF
@@ -57,6 +57,8 @@ class EventIter(object):
         ndarrayShape - the expected shape of the detector NDArray
         logger
         numEvents   - set to non zero to stop early
+        skipThrough - None, or (sec, nsec). When resuming from a checkpoint, events up to and including
+                      this time were processed before, and are skipped
 
         rank and servers are used to distribute the events. 
         EventIter is run on  each server.
@@ -68,11 +70,14 @@ class EventIter(object):
           # wortk with datum.sec, nsec and dataArray
     '''
     def __init__(self,dataSourceString, rank, servers, 
-                 userObj, system_params, ndarrayShape, logger, numEvents=None):
+                 userObj, system_params, ndarrayShape, logger, numEvents=None, skipThrough=None):
 
         if numEvents is None:
             numEvents = 0
         self.numEvents = numEvents
+        self.skipThrough = skipThrough
+        self.skippedEvents = 0
+        self.loggedSkipped = False
         assert rank in servers, "serverRank=%d not in servers=%s" % (rank, servers)
         self.serverNumber = servers.index(rank)
         self.servers = servers
@@ -187,7 +192,23 @@ class EventIter(object):
     def abortFromMaster(self):
         pass
 
+    def alreadyProcessed(self, evt):
+        '''returns True for events that were processed before the checkpoint being resumed from.
+        '''
+        if self.skipThrough is None:
+            return False
+        sec, nsec = evt.get(psana.EventId).time()
+        if (sec, nsec) <= self.skipThrough:
+            self.skippedEvents += 1
+            return True
+        if not self.loggedSkipped:
+            self.logger.info("EventIter: skipped %d events processed before the checkpoint" % self.skippedEvents)
+            self.loggedSkipped = True
+        return False
+
     def getEventDataToYield(self, evt):
+        if self.alreadyProcessed(evt):
+            return None
         if not self.eventOk(evt):
             return None
         dataArray = self.getDataArray(evt)
@@ -229,6 +250,11 @@ class EventIter(object):
                 for tmIdx in range(evtStart, len(times), evtStride):
                     if tmIdx >= numEvents:
                         break
+                    if (self.skipThrough is not None) and \
+                       ((times[tmIdx].seconds(), times[tmIdx].nanoseconds()) <= self.skipThrough):
+                        # in index mode, skip without reading the event
+                        self.skippedEvents += 1
+                        continue
                     evt = run.event(times[tmIdx])
                     eventDataToYield = self.getEventDataToYield(evt)
                     if eventDataToYield is not None:
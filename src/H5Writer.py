@@ -0,0 +1,72 @@
+'''Writes to the h5output file from a background thread on the viewer.
+
+Writing the results of an update to the h5output file can take the viewer longer than
+the rest of the update, in particular on a slow filesystem (see tips). With an H5Writer,
+the viewer queues the writes and goes on. One thread does all the writes, in the order they
+were queued, so writes may depend on earlier ones, i.e, create a group and then write into it.
+
+The queue is bounded. When it is full, submit waits for the thread to catch up, so the viewer
+does not hold onto more than maxQueued updates worth of results.
+
+Whatever is passed to submit must not be changed afterwards, copy buffers that are reused.
+'''
+from __future__ import absolute_import
+from future import standard_library
+standard_library.install_aliases()
+import threading
+import queue
+import time
+
+
+class H5Writer(object):
+    '''runs queued h5 writes in a thread.
+
+    timingDict has the time spent writing, and the time submit waited for room in the queue,
+    in the same format as ParCorAna.Timing, so it can be added to the timing summary.
+    '''
+    def __init__(self, maxQueued):
+        assert maxQueued > 0, "H5Writer maxQueued must be > 0"
+        self.writeQueue = queue.Queue(maxsize=maxQueued)
+        self.error = None
+        self.timingDict = {'h5writerWrite':[0.0, 0, 1e-3, 'ms'],
+                           'h5writerSubmitWait':[0.0, 0, 1e-3, 'ms']}
+        self.thread = threading.Thread(target=self.writeLoop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def writeLoop(self):
+        while True:
+            item = self.writeQueue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # after an error, drop the remaining writes
+                continue
+            writeFunction, args = item
+            t0 = time.time()
+            try:
+                writeFunction(*args)
+            except Exception as exp:
+                self.error = exp
+            self.timingDict['h5writerWrite'][0] += time.time()-t0
+            self.timingDict['h5writerWrite'][1] += 1
+
+    def checkError(self):
+        if self.error is not None:
+            raise Exception("H5Writer: a write in the writer thread failed: %r" % self.error)
+
+    def submit(self, writeFunction, *args):
+        '''queues writeFunction(*args) to be called in the writer thread. Waits if the queue is full.
+        '''
+        self.checkError()
+        t0 = time.time()
+        self.writeQueue.put((writeFunction, args))
+        self.timingDict['h5writerSubmitWait'][0] += time.time()-t0
+        self.timingDict['h5writerSubmitWait'][1] += 1
+
+    def close(self):
+        '''waits for the queued writes to be done, and stops the thread.
+        '''
+        self.writeQueue.put(None)
+        self.thread.join()
+        self.checkError()
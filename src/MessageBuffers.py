@@ -5,20 +5,22 @@ class SM_MsgBuffer(object):
     '''interface for buffer for server/master messages. 
 
     Provides interface so client does not need to know how implemented. 
-    The implementation is 5 int32 with [msgtag, serverrank, seconds, nanoseconds, fiducials]
+    The implementation is 6 int32 with [msgtag, serverrank, seconds, nanoseconds, fiducials, counter]
     '''
     SERVER_TO_MASTER_EVT = 1
     SERVER_TO_MASTER_END = 2
     MASTER_TO_SERVER_SEND_TO_WORKERS = 3
     MASTER_TO_SERVER_ABORT = 4
+    MASTER_TO_SERVER_REPARTITION = 5
     IDX_MSGTAG = 0
     IDX_RANK = 1
     IDX_SEC = 2
     IDX_NSEC = 3
     IDX_FIDUCIALS = 4
+    IDX_COUNTER = 5
     MPI_TYPE = MPI.INT32_T
     def __init__(self, msgtag=None, rank=None, sec=None, nsec=None, fiducials=None):
-        self.msgbuffer = np.zeros(5, np.int32)
+        self.msgbuffer = np.zeros(6, np.int32)
         if msgtag != None: self.msgbuffer[SM_MsgBuffer.IDX_MSGTAG]=np.int32(msgtag)
         if rank != None: self.msgbuffer[SM_MsgBuffer.IDX_RANK]=np.int32(rank)
         if sec != None: self.msgbuffer[SM_MsgBuffer.IDX_SEC]=np.int32(sec)
@@ -69,6 +71,14 @@ class SM_MsgBuffer(object):
         self.msgbuffer[SM_MsgBuffer.IDX_MSGTAG] = \
                         np.int32(SM_MsgBuffer.SERVER_TO_MASTER_EVT)
 
+    def isRepartition(self):
+        return self.msgbuffer[SM_MsgBuffer.IDX_MSGTAG] == \
+            np.int32(SM_MsgBuffer.MASTER_TO_SERVER_REPARTITION)
+
+    def setRepartition(self):
+        self.msgbuffer[SM_MsgBuffer.IDX_MSGTAG] = \
+            np.int32(SM_MsgBuffer.MASTER_TO_SERVER_REPARTITION)
+
     def setEventId(self, sec, nsec, fiducials):
         self.msgbuffer[SM_MsgBuffer.IDX_SEC]=np.int32(sec)
         self.msgbuffer[SM_MsgBuffer.IDX_NSEC]=np.int32(nsec)
@@ -86,6 +96,12 @@ class SM_MsgBuffer(object):
     def getFiducials(self):
         return int(self.msgbuffer[SM_MsgBuffer.IDX_FIDUCIALS])
 
+    def setCounter(self, counter):
+        self.msgbuffer[SM_MsgBuffer.IDX_COUNTER]=np.int32(counter)
+
+    def getCounter(self):
+        return int(self.msgbuffer[SM_MsgBuffer.IDX_COUNTER])
+
 class MWV_MPI_Type(object):
     '''returns MPI Type for MVW_MsgBuffer in master/viewer/worker communications.
 
@@ -153,6 +169,9 @@ class MVW_MsgBuffer(object):
     EVT = 10
     END = 20
     UPDATE = 30
+    REBALANCE = 40
+    LIGHT_UPDATE = 50
+    CHECKPOINT = 60
 
     MPI_Type = MWV_MPI_Type()
 
@@ -162,7 +181,10 @@ class MVW_MsgBuffer(object):
         if msgtag is not None:
             assert msgtag in [MVW_MsgBuffer.EVT, 
                               MVW_MsgBuffer.END,
-                              MVW_MsgBuffer.UPDATE], "unknown message tag: %r" % msgtag
+                              MVW_MsgBuffer.UPDATE,
+                              MVW_MsgBuffer.REBALANCE,
+                              MVW_MsgBuffer.LIGHT_UPDATE,
+                              MVW_MsgBuffer.CHECKPOINT], "unknown message tag: %r" % msgtag
             self.msgbuffer[0]['msgtag'] = msgtag
         if rank is not None:
             self.msgbuffer[0]['rank']=rank
@@ -190,6 +212,15 @@ class MVW_MsgBuffer(object):
     def isUpdate(self):
         return self.msgbuffer[0]['msgtag'] == MVW_MsgBuffer.UPDATE
 
+    def isRebalance(self):
+        return self.msgbuffer[0]['msgtag'] == MVW_MsgBuffer.REBALANCE
+
+    def isLightUpdate(self):
+        return self.msgbuffer[0]['msgtag'] == MVW_MsgBuffer.LIGHT_UPDATE
+
+    def isCheckpoint(self):
+        return self.msgbuffer[0]['msgtag'] == MVW_MsgBuffer.CHECKPOINT
+
     def setEvt(self):
         self.msgbuffer[0]['msgtag'] = MVW_MsgBuffer.EVT
 
@@ -199,6 +230,15 @@ class MVW_MsgBuffer(object):
     def setUpdate(self):
         self.msgbuffer[0]['msgtag'] = MVW_MsgBuffer.UPDATE
 
+    def setRebalance(self):
+        self.msgbuffer[0]['msgtag'] = MVW_MsgBuffer.REBALANCE
+
+    def setLightUpdate(self):
+        self.msgbuffer[0]['msgtag'] = MVW_MsgBuffer.LIGHT_UPDATE
+
+    def setCheckpoint(self):
+        self.msgbuffer[0]['msgtag'] = MVW_MsgBuffer.CHECKPOINT
+
     def setCounter(self, counter):
         self.msgbuffer[0]['counter'] = np.int64(counter)
         
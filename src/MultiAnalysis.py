@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+import numpy as np
+
+class MultiAnalysis(object):
+    '''runs several user classes on one pass of the data (system_params['userClass'] is a list).
+
+    The framework only sees this object. The data is read and scattered once, and stored once
+    in the WorkerData, the callbacks are passed on to each analysis in the order of the list.
+
+    * array names are prefixed with the class name, i.e, G2atEnd_G2, so each analysis gets back
+      the names of its own fwArrayNames
+    * the counts are a 2D array, a row of delay counts for each analysis
+    * the int8array the framework gathers is the maximum of the ones the analyses return
+    * each analysis writes to its own subgroup, named after the class, of the user h5 group
+    * the workers store the largest workerHistoryNeeded of the analyses, all the times if one
+      of them does not implement it, or returns None
+    * an event is processed if all the analyses serverEventOk accept it. workerAdjustData and
+      serverFinalDataArray are applied in order to the one copy of the data
+    * analyses with setPlotTopicPrefix get the class name, so their psmon topics differ, i.e,
+      G2atEnd_MULTI. UserG2 initializes psmon once for all of them
+    * viewerSetH5Writer is passed on to the analyses that implement it, the others write their
+      h5 groups in viewerPublish
+
+    The callbacks for rebalancing, checkpoints, workerReduce, viewer delay blocks and several
+    viewers are not passed on, those modes can not be used.
+    '''
+    def __init__(self, userClasses, user_params, system_params, mpiParams, testAlternate):
+        assert len(userClasses) > 0, "system_params userClass is an empty list"
+        self.mp = mpiParams
+        self.numDelays = len(system_params['delays'])
+        self.prefixes = [userClass.__name__ for userClass in userClasses]
+        assert len(set(self.prefixes)) == len(self.prefixes), "system_params userClass list has a class more than once: %s" % \
+            self.prefixes
+        self.analyses = [userClass(user_params, system_params, mpiParams, testAlternate) for userClass in userClasses]
+        for prefix, analysis in zip(self.prefixes, self.analyses):
+            if hasattr(analysis, 'setPlotTopicPrefix'):
+                analysis.setPlotTopicPrefix(prefix)
+        # for each analysis, pairs of its array name and the name the framework uses
+        self.analysisArrayNames = []
+        for prefix, analysis in zip(self.prefixes, self.analyses):
+            self.analysisArrayNames.append([(nm, '%s_%s' % (prefix, nm)) for nm in analysis.fwArrayNames()])
+        self.h5Groups = [None for analysis in self.analyses]
+
+    def analysisName2array(self, idx, name2array):
+        '''returns the arrays of analysis idx from the framework arrays, with its own names
+        '''
+        return dict([(nm, name2array[fwName]) for nm, fwName in self.analysisArrayNames[idx]])
+
+    def fwArrayNames(self):
+        return [fwName for arrayNames in self.analysisArrayNames for nm, fwName in arrayNames]
+
+    #### SERVER CALLBACKS #####
+    def serverInit(self):
+        for analysis in self.analyses:
+            analysis.serverInit()
+
+    def serverEventOk(self, evt):
+        return all([analysis.serverEventOk(evt) for analysis in self.analyses])
+
+    def serverFinalDataArray(self, dataArray, evt):
+        for analysis in self.analyses:
+            dataArray = analysis.serverFinalDataArray(dataArray, evt)
+            if dataArray is None:
+                return None
+        return dataArray
+
+    #### WORKER CALLBACKS #####
+    def workerInit(self, numElementsWorker):
+        for analysis in self.analyses:
+            analysis.workerInit(numElementsWorker)
+
+    def workerHistoryNeeded(self):
+        '''the most any analysis needs, None if one of them needs all the times
+        '''
+        historyNeeded = []
+        for analysis in self.analyses:
+            if not hasattr(analysis, 'workerHistoryNeeded'):
+                return None
+            analysisHistoryNeeded = analysis.workerHistoryNeeded()
+            if analysisHistoryNeeded is None:
+                return None
+            historyNeeded.append(analysisHistoryNeeded)
+        return max(historyNeeded)
+
+    def workerSetDelayIndices(self, delayIndices):
+        for prefix, analysis in zip(self.prefixes, self.analyses):
+            assert hasattr(analysis, 'workerSetDelayIndices'), "system_params delayGroups > 1, but user class %s does not implement workerSetDelayIndices" % prefix
+            analysis.workerSetDelayIndices(delayIndices)
+
+    def workerAdjustData(self, data):
+        for analysis in self.analyses:
+            analysis.workerAdjustData(data)
+
+    def workerAdjustSparseData(self, pixels, photons):
+        for analysis in self.analyses:
+            if hasattr(analysis, 'workerAdjustSparseData'):
+                analysis.workerAdjustSparseData(pixels, photons)
+
+    def workerBeforeDataRemove(self, tm, xInd, workerData):
+        for analysis in self.analyses:
+            analysis.workerBeforeDataRemove(tm, xInd, workerData)
+
+    def workerAfterDataInsert(self, tm, xInd, workerData):
+        for analysis in self.analyses:
+            analysis.workerAfterDataInsert(tm, xInd, workerData)
+
+    def workerCalc(self, workerData):
+        name2array = {}
+        counts = np.zeros((len(self.analyses), self.numDelays), np.int64)
+        int8array = None
+        for idx, analysis in enumerate(self.analyses):
+            analysisName2array, analysisCounts, analysisInt8array = analysis.workerCalc(workerData)
+            for nm, fwName in self.analysisArrayNames[idx]:
+                name2array[fwName] = analysisName2array[nm]
+            counts[idx,:] = analysisCounts
+            if int8array is None:
+                int8array = analysisInt8array.copy()
+            else:
+                int8array = np.maximum(int8array, analysisInt8array)
+        return name2array, counts, int8array
+
+    def workerH5Arrays(self, name2array, counts):
+        h5Arrays = {}
+        for idx, analysis in enumerate(self.analyses):
+            analysisName2array = self.analysisName2array(idx, name2array)
+            if hasattr(analysis, 'workerH5Arrays'):
+                analysisName2array = analysis.workerH5Arrays(analysisName2array, counts[idx])
+            for nm, fwName in self.analysisArrayNames[idx]:
+                h5Arrays[fwName] = analysisName2array[nm]
+        return h5Arrays
+
+    #### VIEWER CALLBACKS #####
+    def viewerInit(self, maskNdarrayCoords, h5GroupUser):
+        for idx, analysis in enumerate(self.analyses):
+            if h5GroupUser is not None:
+                self.h5Groups[idx] = h5GroupUser.create_group(self.prefixes[idx])
+            analysis.viewerInit(maskNdarrayCoords, self.h5Groups[idx])
+
+    def viewerSetH5Writer(self, h5writer):
+        for analysis in self.analyses:
+            if hasattr(analysis, 'viewerSetH5Writer'):
+                analysis.viewerSetH5Writer(h5writer)
+
+    def viewerPublish(self, counts, lastEventTime, name2delay2ndarray, int8ndarray, h5GroupUser):
+        for idx, analysis in enumerate(self.analyses):
+            analysis.viewerPublish(counts[idx], lastEventTime, self.analysisName2array(idx, name2delay2ndarray),
+                                   int8ndarray, self.h5Groups[idx])
+
+    def viewerShutdown(self):
+        for analysis in self.analyses:
+            if hasattr(analysis, 'viewerShutdown'):
+                analysis.viewerShutdown()
+
+    def calcAndPublishForTestAlt(self, sortedEventIds, sortedData, h5GroupUser):
+        for idx, analysis in enumerate(self.analyses):
+            analysis.calcAndPublishForTestAlt(sortedEventIds, sortedData, self.h5Groups[idx])
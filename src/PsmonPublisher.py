@@ -0,0 +1,119 @@
+'''Publishes psmon plots from a helper process.
+
+Building the psmon plot objects and sending them can take the viewer longer than
+the rest of an update, while the master and workers wait for it. With a PsmonPublisher,
+the viewer puts plot descriptions - plain python and numpy data - on a queue and goes on.
+The helper process builds the MultiPlot, XYPlot and Image objects and sends them.
+If the helper is still busy with an earlier update when new ones arrive, it only
+publishes the latest update for each topic, stale ones are dropped. The queue is
+bounded, if it is full when the viewer sends, the oldest queued update is dropped
+to make room, so the viewer never waits on the helper and memory does not grow.
+
+The helper is started with multiprocessing, which forks the viewer rank after MPI is
+initialized. Some MPI implementations (for instance openmpi over infiniband) do not
+support fork, and can print warnings or hang. The helper does not call MPI, but if
+the MPI in use does not allow fork, leave user_params['psmon_process'] False.
+
+A plot description is a tuple, one of
+
+  ('XYPlot', title, x, y, kwargs)  - kwargs is a dict of keyword arguments for psmon XYPlot
+  ('Image', title, image)
+'''
+from __future__ import absolute_import
+from future import standard_library
+standard_library.install_aliases()
+import multiprocessing
+import queue
+
+
+def buildMultiPlot(counter, topic, ncols, plots):
+    '''returns a psmon MultiPlot for the given plot descriptions
+    '''
+    import psmon.plots as psmonPlots
+    multi = psmonPlots.MultiPlot(counter, topic, ncols=ncols)
+    for plot in plots:
+        if plot[0] == 'XYPlot':
+            title, x, y, kwargs = plot[1:]
+            multi.add(psmonPlots.XYPlot(counter, title, x, y, **kwargs))
+        elif plot[0] == 'Image':
+            title, image = plot[1:]
+            multi.add(psmonPlots.Image(counter, title, image))
+        else:
+            raise ValueError("unknown plot type=%s in plot description" % plot[0])
+    return multi
+
+
+def takeLatest(plotQueue):
+    '''waits for an update, then takes all that are queued, keeping the latest for each topic.
+
+    Returns:
+      topic2latest - dict of topic -> (topic, counter, ncols, plots)
+      done         - True if the None that stops the helper was taken
+    '''
+    topic2latest = {}
+    item = plotQueue.get()
+    while True:
+        if item is None:
+            return topic2latest, True
+        topic2latest[item[0]] = item
+        try:
+            item = plotQueue.get_nowait()
+        except queue.Empty:
+            return topic2latest, False
+
+
+def publishLoop(plotQueue):
+    '''run by the helper process. Publishes what is put on the plotQueue until it gets None.
+    '''
+    import psmon.publish as psmonPublish
+    psmonPublish.init()
+    done = False
+    while not done:
+        topic2latest, done = takeLatest(plotQueue)
+        for topic, counter, ncols, plots in topic2latest.values():
+            psmonPublish.send(topic, buildMultiPlot(counter, topic, ncols, plots))
+
+
+class PsmonPublisher(object):
+    '''starts the helper process, and sends it plot descriptions to publish.
+
+    The helper process is forked from the viewer, and does not use MPI (see the fork
+    caveat above). At most maxQueued updates wait on the queue.
+    '''
+    def __init__(self, maxQueued=4):
+        self.plotQueue = multiprocessing.Queue(maxsize=maxQueued)
+        self.numDropped = 0
+        self.process = multiprocessing.Process(target=publishLoop, args=(self.plotQueue,))
+        self.process.daemon = True
+        self.process.start()
+
+    def send(self, topic, counter, ncols, plots):
+        '''queue plots to publish as a MultiPlot with the given topic. Returns right away.
+
+        If the queue is full, drops the oldest queued update, or this one if the queue is
+        still full after that. Dropped updates are counted in numDropped.
+        '''
+        item = (topic, counter, ncols, plots)
+        try:
+            self.plotQueue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        try:
+            self.plotQueue.get_nowait()
+            self.numDropped += 1
+        except queue.Empty:
+            pass
+        try:
+            self.plotQueue.put_nowait(item)
+        except queue.Full:
+            self.numDropped += 1
+
+    def close(self, timeout=30):
+        '''waits for the helper process to publish what is queued, and stop.
+        '''
+        try:
+            self.plotQueue.put(None, True, timeout)
+        except queue.Full:
+            self.process.terminate()
+        self.process.join(timeout)
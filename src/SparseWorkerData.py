@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+import numpy as np
+from .WorkerData import WorkerData
+
+class SparseWorkerData(WorkerData):
+    '''WorkerData for the sparse photon mode (system_params['sparsePhotonADU']).
+
+    Rather than a dense row of X for each time, stores the pixels that have photons, and
+    their counts. pixels[xInd] and photons[xInd] are np.int32 arrays, pixels[xInd] is
+    sorted, and is relative to the first element of this worker. The rows are kept in the
+    same ring as WorkerData, so memory goes with the number of photons, not the number
+    of pixels.
+
+    New rows are passed to addData as a (pixels, photons) tuple. workerAdjustData is not called,
+    if the callback object has workerAdjustSparseData, it is called with the pixels and photons
+    instead. Moving pixels between workers, and checkpoints, are not supported.
+    '''
+    sparse = True
+
+    def __init__(self, logger, isFirstWorker, numTimes, numDataPointsThisWorker,
+                 addRemoveCallbackObject=None):
+        self.numDataPoints = numDataPointsThisWorker
+        super(SparseWorkerData, self).__init__(logger, isFirstWorker, numTimes, numDataPointsThisWorker,
+                                               addRemoveCallbackObject=addRemoveCallbackObject)
+
+    def _setStore(self, shape, dtype):
+        self.X = None
+        empty = np.zeros(0, np.int32)
+        self.pixels = [empty] * shape[0]
+        self.photons = [empty] * shape[0]
+
+    def _adjustNewRow(self, newXrow):
+        if hasattr(self.addRemoveCallbackObject, 'workerAdjustSparseData'):
+            pixels, photons = newXrow
+            self.addRemoveCallbackObject.workerAdjustSparseData(pixels, photons)
+
+    def _storeRow(self, xInd, newXrow):
+        pixels, photons = newXrow
+        assert len(pixels) == len(photons), "SparseWorkerData: %d pixels but %d photon counts" % (len(pixels), len(photons))
+        assert len(pixels) == 0 or (pixels[0] >= 0 and pixels[-1] < self.numDataPoints), \
+            "SparseWorkerData: pixels are not in [0,%d)" % self.numDataPoints
+        self.pixels[xInd] = np.array(pixels, dtype=np.int32)
+        self.photons[xInd] = np.array(photons, dtype=np.int32)
+
+    def denseRow(self, xInd):
+        '''returns the row for xInd as a dense np.float32 array
+        '''
+        row = np.zeros(self.numDataPoints, np.float32)
+        row[self.pixels[xInd]] = self.photons[xInd]
+        return row
+
+    def concatenatedRows(self, xInds):
+        '''returns the pixels and photons of the rows xInds, one after the other, and for each
+        photon count, its position in xInds. Within a row, the pixels are sorted.
+        '''
+        pixels = [self.pixels[xInd] for xInd in xInds]
+        photons = [self.photons[xInd] for xInd in xInds]
+        rows = np.repeat(np.arange(len(xInds), dtype=np.int64), [len(rowPixels) for rowPixels in pixels])
+        return np.concatenate(pixels), np.concatenate(photons), rows
+
+    def numPhotonsStored(self):
+        return sum([len(pixels) for pixels in self.pixels])
+
+    def storedTimesAndData(self):
+        raise Exception("SparseWorkerData does not support checkpoints")
+
+    def restoreData(self, times, Xrows):
+        raise Exception("SparseWorkerData does not support checkpoints")
+
+    def setPixelData(self, X):
+        raise Exception("SparseWorkerData does not support moving pixels between workers")
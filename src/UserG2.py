@@ -20,9 +20,36 @@ import psana
 import logging
 import psmon.config as psmonConfig
 import psmon.publish as psmonPublish
-import psmon.plots as psmonPlots
 
 
+# psmon is initialized once per process. With a list of user classes, the analyses share it,
+# the last to stop closes the publishing process, see startPsmon and stopPsmon
+_psmon = {'users':0, 'publisher':None}
+
+def startPsmon(usePublisherProcess):
+    '''initializes psmon, or starts the publishing process, if this is the first user.
+    Returns the ParCorAna.PsmonPublisher, or None if the viewer publishes itself.
+    '''
+    if _psmon['users'] == 0:
+        if usePublisherProcess:
+            _psmon['publisher'] = ParCorAna.PsmonPublisher.PsmonPublisher()
+        else:
+            psmonPublish.init()
+    _psmon['users'] += 1
+    return _psmon['publisher']
+
+def stopPsmon():
+    '''returns the publisher once the last user stops, after closing it, otherwise None
+    '''
+    assert _psmon['users'] > 0, "stopPsmon called more times than startPsmon"
+    _psmon['users'] -= 1
+    publisher = None
+    if _psmon['users'] == 0 and _psmon['publisher'] is not None:
+        publisher = _psmon['publisher']
+        publisher.close()
+        _psmon['publisher'] = None
+    return publisher
+
 def sumColoredPixels(colorNdarr):
     binCountVector = np.bincount(colorNdarr.flatten())
     color2total = {}
@@ -80,8 +107,13 @@ class G2Common(object):
 
         self.delays = system_params['delays']
         self.numDelays = len(self.delays)
+        # (delayIdx, delay) pairs this worker computes, see workerSetDelayIndices
+        self.workerDelays = list(enumerate(self.delays))
 
         self.debugPlot = self.user_params['debug_plot']
+        # prefix of the psmon topics, set by setPlotTopicPrefix when running in a list of user classes
+        self.plotTopicPrefix = ''
+        self.psmonStarted = False
         self.maskNdarrayCoords = self.mp.maskNdarrayCoords
         assert self.maskNdarrayCoords.dtype == np.bool
         assert os.path.exists(self.user_params['colorNdarrayCoords']), "color file: %s doesn't exist" % self.user_params['colorNdarrayCoords']
@@ -107,7 +139,8 @@ class G2Common(object):
             assert self.iX.shape == self.debugMask.shape, "loaded iX shape=%s != mask shape=%s" % (self.iX.shape, self.debugMask.shape)
             assert self.iY.shape == self.debugMask.shape, "loaded iY shape=%s != mask shape=%s" % (self.iY.shape, self.debugMask.shape)
             self.fullImageShape, self.debugPlotImageBounds = ParCorAna.imgBoundBox(self.iX, self.iY, self.debugMask)
-
+        self.h5writer = None
+        self.publishGroup = None
 
     def logInfo(self, msg, allWorkers=False):
         self.mp.logInfo(msg, allWorkers)
@@ -216,6 +249,47 @@ class G2Common(object):
 
         self.saturatedValue = self.user_params['saturatedValue']
         self.notzero = self.user_params['notzero']
+        photonADU = ParCorAna.getOptionalSystemParam(self.system_params, 'sparsePhotonADU')
+        if photonADU is not None:
+            # in the sparse mode, a saturated value becomes at least this many photons
+            saturatedPhotons = ParCorAna.photonize(np.array([self.saturatedValue]), photonADU,
+                                                   ParCorAna.getOptionalSystemParam(self.system_params, 'sparsePhotonThreshold'))[1]
+            self.saturatedPhotons = max([1] + list(saturatedPhotons))
+
+        # workerReduce is called for each update with workerReduce, and for the light updates with fullUpdate
+        self.workerReduceColors = ParCorAna.getOptionalSystemParam(self.system_params, 'workerReduce') or \
+                                  ParCorAna.getOptionalSystemParam(self.system_params, 'fullUpdate') > 0
+        if self.workerReduceColors:
+            # color labels for the masked elements, in the order workers process them
+            MaxColor = 1<<14
+            color_ndarrayCoords = loadColorFile(self.user_params['colorNdarrayCoords'],
+                                                self.maskNdarrayCoords, MaxColor)[0]
+            finecolor_ndarrayCoords = loadColorFile(self.user_params['colorFineNdarrayCoords'],
+                                                    self.maskNdarrayCoords, MaxColor)[0]
+            self.maskedColor = self.mp.maskedFlat(color_ndarrayCoords)
+            self.maskedFineColor = self.mp.maskedFlat(finecolor_ndarrayCoords)
+            self.numColorLabels = int(np.max(self.maskedColor)) + 1
+            self.numFineColorLabels = int(np.max(self.maskedFineColor)) + 1
+            self.workerSetColorLabels()
+
+    def workerSetColorLabels(self):
+        '''sets the color and finecolor labels for the elements this worker processes.
+        '''
+        workerOffset = self.mp.workerWorldRankToOffset[self.mp.rank]
+        if self.mp.delayGroups > 1:
+            # the workers in a pixel group process the pixels of its first worker
+            firstRankInGroup = self.mp.workerPixelGroup(self.mp.rank)[2]
+            workerOffset = self.mp.workerWorldRankToOffset[firstRankInGroup]
+        workerSlice = slice(workerOffset, workerOffset + self.numElementsWorker)
+        self.workerColor = self.maskedColor[workerSlice]
+        self.workerFineColor = self.maskedFineColor[workerSlice]
+
+    def workerSetDelayIndices(self, delayIndices):
+        '''for system_params['delayGroups'] > 1, only compute the given delays. The other 
+        entries of G2, IP, IF and counts stay 0, the framework sums them over the workers
+        that share the pixels.
+        '''
+        self.workerDelays = [(delayIdx, self.delays[delayIdx]) for delayIdx in delayIndices]
 
     def workerBeforeDataRemove(self, tm, xInd, workerData):
         '''called right before data is being overwritten
@@ -262,6 +336,85 @@ class G2Common(object):
             self.logDebug("G2Common.workerAdjustData: set %d negative values to %r, identified %d saturated pixels" % \
                              (numNeg, self.notzero, numSaturated))
 
+    def workerAdjustSparseData(self, pixels, photons):
+        '''the sparse photon mode version of workerAdjustData, called before the photons are stored.
+        Identifies saturated pixels from the photon counts, a pixel is saturated if it has at least 
+        as many photons as saturatedValue converts to. This can also flag values a fraction of a 
+        photon below saturatedValue.
+
+        Args:
+          pixels, photons: np.int32 arrays, the pixels with photons and their counts. Not modified.
+        '''
+        indexOfSaturated = photons >= self.saturatedPhotons
+        self.saturatedElements[pixels[indexOfSaturated]] = 1
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logDebug("G2Common.workerAdjustSparseData: identified %d saturated pixels" % np.sum(indexOfSaturated))
+
+    def workerSparsePair(self, delayIdx, workerData, xIndEarlier, xIndLater, sign=1):
+        '''adds (sign=1) or removes (sign=-1) the pair of times to G2, IP and IF for the sparse 
+        photon mode. Only the pixels with photons are touched, for G2 the pixels with photons at 
+        both times. Does not change counts. Used by the incremental classes, G2atEnd goes through
+        all the pairs for a delay at once in workerCalcSparse.
+        '''
+        pixelsEarlier = workerData.pixels[xIndEarlier]
+        photonsEarlier = workerData.photons[xIndEarlier]
+        pixelsLater = workerData.pixels[xIndLater]
+        photonsLater = workerData.photons[xIndLater]
+        self.IP[delayIdx, pixelsEarlier] += sign * photonsEarlier
+        self.IF[delayIdx, pixelsLater] += sign * photonsLater
+        if len(pixelsEarlier) == 0 or len(pixelsLater) == 0:
+            return
+        # pixels are sorted and unique, find the pixels in both
+        posLater = np.minimum(np.searchsorted(pixelsLater, pixelsEarlier), len(pixelsLater)-1)
+        inBoth = pixelsLater[posLater] == pixelsEarlier
+        self.G2[delayIdx, pixelsEarlier[inBoth]] += sign * photonsEarlier[inBoth] * photonsLater[posLater[inBoth]]
+
+    def workerPixelArrays(self):
+        '''returns the worker arrays that have a value for each element of this worker.
+
+        Only needed when system_params['rebalanceInterval'] > 0, or checkpoints are used. The framework 
+        moves these arrays, along with the stored data, when pixels are moved between workers, and 
+        writes them to the checkpoint files.
+
+        Return:
+          dict: names to ndarrays, the last dimension of each array is numElementsWorker
+        '''
+        return {'G2':self.G2, 'IP':self.IP, 'IF':self.IF,
+                'saturatedElements':self.saturatedElements}
+
+    def workerSetPixelArrays(self, name2array, numElementsWorker):
+        '''called after pixels have been moved between workers, or when resuming from a checkpoint.
+
+        Args:
+          name2array (dict): the same names as returned by workerPixelArrays, with arrays
+                             for the new elements of this worker
+          numElementsWorker (int): new number of elements this worker processes
+        '''
+        self.numElementsWorker = numElementsWorker
+        self.G2 = name2array['G2']
+        self.IP = name2array['IP']
+        self.IF = name2array['IF']
+        self.saturatedElements = name2array['saturatedElements']
+        if self.workerReduceColors:
+            self.workerSetColorLabels()
+
+    def workerCheckpointArrays(self):
+        '''returns the other worker arrays needed to resume from a checkpoint, besides those from
+        workerPixelArrays. 
+
+        Only needed when system_params['checkpoint'] is used. These must not depend on the elements 
+        of the worker, as the elements may be divided differently when resuming.
+        '''
+        return {'counts':self.counts}
+
+    def workerSetCheckpointArrays(self, name2array):
+        '''called when resuming from a checkpoint, after workerSetPixelArrays.
+
+        Args:
+          name2array (dict): the same names as returned by workerCheckpointArrays
+        '''
+        self.counts = name2array['counts']
+
     def workerCalc(self, workerData):
         '''Must be implemented, returns all output arrays.
 
@@ -288,6 +441,65 @@ class G2Common(object):
         '''
         raise Exception("G2Common.workerCalc not implemented, use sub class")
 
+    def workerReduce(self, name2array, counts, int8array, allreduce):
+        '''Only called when system_params['workerReduce'] is True, or fullUpdate > 0 (light updates). 
+        Reduces the output of workerCalc to small arrays that are summed over the workers and sent to the viewer.
+
+        Args:
+          name2array, counts, int8array: what workerCalc returned
+          allreduce: function that takes a np.float64 array and returns the sum of it over all
+                     the workers. Every worker must call it the same number of times.
+
+        Return:
+          dict: names to np.float64 arrays, the same names and shapes on all workers.
+                For G2Common, 'colorSums' is D x numColors, the sum of the normalized G2 over 
+                the pixels of each color, and 'colorTotals' is the number of pixels in each color.
+        '''
+        numDelays = len(counts)
+        goodPixels = int8array == 0
+        fineColor = self.workerFineColor * goodPixels
+        color = self.workerColor * goodPixels
+
+        def delayBincount(labels, numLabels, array):
+            # bincount for all delays at once, each delay has its own range of bins
+            delayLabels = labels + numLabels * np.arange(numDelays)[:,np.newaxis]
+            return np.bincount(delayLabels.flatten(), array.flatten(), 
+                               minlength=numDelays*numLabels).reshape(numDelays, numLabels)
+
+        # the finecolor averages of IP and IF need the pixels of all the workers
+        fineColorSums = np.zeros((2*numDelays + 1, self.numFineColorLabels), np.float64)
+        fineColorSums[0,:] = np.bincount(fineColor, minlength=self.numFineColorLabels)
+        fineColorSums[1:numDelays+1,:] = delayBincount(fineColor, self.numFineColorLabels, name2array['IP'])
+        fineColorSums[numDelays+1:,:] = delayBincount(fineColor, self.numFineColorLabels, name2array['IF'])
+        fineColorSums = allreduce(fineColorSums)
+        fineColorTotals = fineColorSums[0,:]
+        fineColorTotals[fineColorTotals == 0] = 1.0
+
+        final = np.zeros((numDelays, self.numElementsWorker), np.float64)
+        for delayIdx, delayCount in enumerate(counts):
+            if delayCount <= 0:
+                continue
+            # dividing the sums by the delay count and pixel count gives the averages
+            fineColorAvg_IP = fineColorSums[1+delayIdx,:] / (delayCount * fineColorTotals)
+            fineColorAvg_IF = fineColorSums[1+numDelays+delayIdx,:] / (delayCount * fineColorTotals)
+            G2 = name2array['G2'][delayIdx,:] / np.float64(delayCount)
+            final[delayIdx,:] = G2 / (fineColorAvg_IP[fineColor] * fineColorAvg_IF[fineColor])
+        final[:,color == 0] = 0.0
+
+        colorSums = delayBincount(color, self.numColorLabels, final)
+        colorTotals = np.bincount(color, minlength=self.numColorLabels).astype(np.float64)
+        return {'colorSums':colorSums, 'colorTotals':colorTotals}
+
+    def workerH5Arrays(self, name2array, counts):
+        '''Only called when system_params['h5parallel'] is True. Returns what the worker writes
+        to the workers h5 file, G2, IF and IP divided by the delay counts, as the viewer writes them.
+
+        Args:
+          name2array, counts: what workerCalc returned, they are not modified
+        '''
+        delayCounts = np.maximum(counts, 1).astype(np.float32)[:,np.newaxis]
+        return dict([(nm, name2array[nm] / delayCounts) for nm in self._arrayNames])
+
 
 
     def calcAndPublishForTestAlt(self,sortedEventIds, sortedData, h5GroupUser):
@@ -358,11 +570,9 @@ class G2Common(object):
         for nm,delay2masked in zip(['G2','IF','IP'],[G2,IF,IP]):
             name2delay2ndarray[nm] = {}
             for delay,masked in delay2masked.items():
-                name2delay2ndarray[nm][delay]=np.zeros(self.maskNdarrayCoords.shape, np.float32)
-                name2delay2ndarray[nm][delay][self.maskNdarrayCoords] = masked[:]
+                name2delay2ndarray[nm][delay] = self.mp.maskedFlatToNdarray(masked, np.float32)
 
-        saturatedElements = np.zeros(self.maskNdarrayCoords.shape, np.int8)
-        saturatedElements[self.maskNdarrayCoords] = self.saturatedElements[:]
+        saturatedElements = self.mp.maskedFlatToNdarray(self.saturatedElements, np.int8)
 
         lastEventTime = {'sec':sortedEventIds[-1]['sec'],
                          'nsec':sortedEventIds[-1]['nsec'],
@@ -410,14 +620,36 @@ class G2Common(object):
         self.mp.logInfo("UserG2.viewerInit: mask included pixels contain finecolors: %s with counts: %s" % \
                         (self.finecolors, [self.finecolor2total[c] for c in self.finecolors]))
 
+        self.viewerSetColorLabels()
+        # pixels that have been taken out of the color labeling, because they saturated
+        self.excludedPixels = np.zeros(self.color_ndarrayCoords.size, np.bool)
+
+        self.h5layout = self.user_params.get('h5layout', 'groups')
+        assert self.h5layout in ['groups', 'appended'], "user_params['h5layout'] must be 'groups' or 'appended', it is %s" % self.h5layout
+        self.h5compression = self.user_params.get('h5compression', None)
+        # with system_params['h5parallel'] the workers write the G2, IF, IP arrays, see workerH5Arrays
+        self.h5parallel = ParCorAna.getOptionalSystemParam(self.system_params, 'h5parallel') and not self.testAlternate
+        self.h5FlatIndices = None
+        if ParCorAna.getOptionalSystemParam(self.system_params, 'h5maskedFlat'):
+            self.h5FlatIndices = self.mp.maskedFlatIndices
+        # the colors before any are dropped for saturated pixels, the color axis of the appended delay curves
+        self.h5Colors = list(self.colors)
+        self.h5UpdateIndex = None
+
         self.plot = self.user_params['psmon_plot']
-        if self.plot or self.debugPlot:
+        self.psmonPublisher = None
+        # with system_params['numViewers'] > 1, only the first viewer plots
+        if (self.plot or self.debugPlot) and self.mp.isViewer:
             hostname = os.environ.get('HOSTNAME','*UNKNOWN*')
             port = self.user_params.get('psmon_port',psmonConfig.APP_PORT)
-            psmonPublish.init()
-            self.mp.logInfo("Initialized psmon. viewer host is: %s" % hostname)
-            psplotCmd = 'psplot --logx -s %s -p %s MULTI' % (hostname, port)
-            debugPlotCmd = 'psplot -s %s -p %s DEBUG' % (hostname, port)
+            self.psmonPublisher = startPsmon(self.user_params.get('psmon_process', False))
+            self.psmonStarted = True
+            if self.psmonPublisher is not None:
+                self.mp.logInfo("psmon publishing process is running. viewer host is: %s" % hostname)
+            else:
+                self.mp.logInfo("Initialized psmon. viewer host is: %s" % hostname)
+            psplotCmd = 'psplot --logx -s %s -p %s %s' % (hostname, port, self.plotTopic('MULTI'))
+            debugPlotCmd = 'psplot -s %s -p %s %s' % (hostname, port, self.plotTopic('DEBUG'))
             self.logInfo("*********** PSPLOT CMD *************")
             if self.plot:
                 self.logInfo("Run cmd: %s" % psplotCmd)
@@ -454,7 +686,19 @@ class G2Common(object):
          int8ndarray: gathered int8 array from all the workers, the pixels they found to be saturated.
          h5GroupUser: either None, or a valid h5py Group to write results into the h5file
         '''
+        self.viewerPublishStart(counts, lastEventTime, int8ndarray, h5GroupUser)
+        self.viewerPublishDelays(counts, lastEventTime, list(range(len(self.delays))), 
+                                 name2delay2ndarray, h5GroupUser)
+        self.viewerPublishEnd(counts, lastEventTime, h5GroupUser)
+
+    def viewerPublishStart(self, counts, lastEventTime, int8ndarray, h5GroupUser):
+        '''Only called when system_params['viewerDelayBlock'] > 0. Then the framework calls 
+        viewerPublishStart, viewerPublishDelays for each block of delays, and viewerPublishEnd
+        instead of viewerPublish. G2Common implements viewerPublish with these three callbacks.
 
+        Args:
+         counts, lastEventTime, int8ndarray, h5GroupUser: the same as for viewerPublish
+        '''
         assert len(counts) == len(self.delays), "UserG2.viewerPublish: len(counts)=%d != len(delays)=%d" % \
             (len(counts), len(self.delays))
 
@@ -464,25 +708,43 @@ class G2Common(object):
 
         self.changeColorDataIfNewSaturated(saturated_ndarrayCoords)
 
-        delayCurves = {}
+        self.delayCurves = {}
         for color in self.colors:
-            delayCurves[color] = np.zeros(len(counts), np.float32)
+            self.delayCurves[color] = np.zeros(len(counts), np.float32)
 
+        if h5GroupUser is not None:
+            self.h5Write(self.h5StartResults, h5GroupUser, lastEventTime['counter'], counts.copy())
+
+    def viewerPublishDelays(self, counts, lastEventTime, delayIndices, name2delay2ndarray, h5GroupUser):
+        '''Only called when system_params['viewerDelayBlock'] > 0, see viewerPublishStart.
+
+        Args:
+         counts, lastEventTime, h5GroupUser: the same as for viewerPublish
+         delayIndices (list): indices into the delays for this block
+         name2delay2ndarray: like viewerPublish, but only has the delays for this block. The
+                             ndarrays may be reused by the framework for the next block.
+        '''
         ndarrayShape = self.color_ndarrayCoords.shape
 
 #        eps = 1e-6 # protect from division by zero
 
         counter120hz = lastEventTime['counter']
 
-        if self.debugPlot:
+        debugPlotDelays = [self.delays[delayIdx] for delayIdx in delayIndices if delayIdx < 2]
+        if self.debugPlot and self.mp.isViewer and len(debugPlotDelays) > 0:
             # you can pick other delays or matricies to plot here, or do this after
             # dividing by delayCount below
-            self.doDebugPlot(counter120hz, delaysToPlot=self.delays[0:2],
+            self.doDebugPlot(counter120hz, delaysToPlot=debugPlotDelays,
                              namesToPlot=['IF','G2'], name2delay2ndarray=name2delay2ndarray)
 
-        for delayIdx, delayCount in enumerate(counts):
-            if delayCount <= 0:
-                continue
+        delayIndices = [delayIdx for delayIdx in delayIndices if counts[delayIdx] > 0]
+
+        # sums of IF and IP over the finecolors, for all the delays
+        fineColorSums_IF = np.empty((len(delayIndices), self.fineColorLabels.numBins), np.float64)
+        fineColorSums_IP = np.empty((len(delayIndices), self.fineColorLabels.numBins), np.float64)
+
+        for row, delayIdx in enumerate(delayIndices):
+            delayCount = counts[delayIdx]
             delay = self.delays[delayIdx]
             G2 = name2delay2ndarray['G2'][delay]
             IF = name2delay2ndarray['IF'][delay]
@@ -498,69 +760,197 @@ class G2Common(object):
             IF /= np.float32(delayCount)
             IP /= np.float32(delayCount)
 
-            fineColorAvg_IF = ParCorAna.replaceSubsetsWithAverage(IF, self.finecolor_ndarrayCoords, self.finecolor2total)
-            fineColorAvg_IP = ParCorAna.replaceSubsetsWithAverage(IP, self.finecolor_ndarrayCoords, self.finecolor2total)
+            self.fineColorLabels.labelSums(IF, out=fineColorSums_IF[row])
+            self.fineColorLabels.labelSums(IP, out=fineColorSums_IP[row])
 
-#            fineColorAvg_IF[fineColorAvg_IF<=eps]=eps
-#            fineColorAvg_IP[fineColorAvg_IP<=eps]=eps
+        fineColorAvg_IF = self.fineColorLabels.labelAverages(fineColorSums_IF).astype(np.float32)
+        fineColorAvg_IP = self.fineColorLabels.labelAverages(fineColorSums_IP).astype(np.float32)
 
-            final = G2 / (fineColorAvg_IP * fineColorAvg_IF)
+#        fineColorAvg_IF[fineColorAvg_IF<=eps]=eps
+#        fineColorAvg_IP[fineColorAvg_IP<=eps]=eps
 
-            finalColorSums = np.bincount(self.color_ndarrayCoords.flatten(), final.flatten())
+        fineColorAvgProduct = fineColorAvg_IP * fineColorAvg_IF
+        # uncolored pixels do not go into the delay curves, keep them from dividing by zero
+        fineColorAvgProduct[:,0] = 1.0
 
-            for color, colorTotal  in self.color2total.iteritems():
-                delayCurves[color][delayIdx] = finalColorSums[color]/np.float32(colorTotal)
+        finalColorSums = np.empty((len(delayIndices), self.colorLabels.numBins), np.float64)
+        for row, delayIdx in enumerate(delayIndices):
+            G2 = name2delay2ndarray['G2'][self.delays[delayIdx]]
+            final = G2 / self.fineColorLabels.toPixels(fineColorAvgProduct[row])
+            self.colorLabels.labelSums(final, out=finalColorSums[row])
 
+        for color, colorTotal in zip(self.colorLabels.labels, self.colorLabels.totals):
+            self.delayCurves[color][delayIndices] = finalColorSums[:,color]/np.float32(colorTotal)
 
-        if self.printDelayCurves:
-            for color in self.color2total.keys():
-                self.logInfo("evt=%5d color=%2d delayCurve=%s ..." % \
-                             (counter120hz, color, ', '.join(map(str,delayCurves[color][0:10]))))
+        if (h5GroupUser is not None) and (not self.h5parallel):
+            if self.h5writer is not None:
+                # the framework reuses these buffers for the next block or update
+                name2delay2ndarray = dict([(nm, dict([(delay, ndarray.copy()) for delay, ndarray in delay2ndarray.items()])) \
+                                           for nm, delay2ndarray in name2delay2ndarray.items()])
+            self.h5Write(self.h5WriteArrays, name2delay2ndarray)
 
+    def viewerPublishEnd(self, counts, lastEventTime, h5GroupUser):
+        '''Only called when system_params['viewerDelayBlock'] > 0, see viewerPublishStart.
+        '''
+        counter120hz = lastEventTime['counter']
+        self.logDelayCurves(counter120hz, self.delayCurves)
+        if h5GroupUser is not None:
+            self.h5Write(self.h5EndResults, counts.copy(), self.delayCurves)
+        self.plotDelayCurves(counter120hz, counts, self.delayCurves)
 
-        groupName = 'G2_results_at_%6.6d' % counter120hz
+    def viewerDelayResults(self):
+        '''Only called when system_params['numViewers'] > 1. Then each viewer calls viewerPublishStart
+        and viewerPublishDelays for its own delays. Returns the delay curves for these delays, 0 for
+        the other delays. The framework sums them over the viewers for viewerMergeDelayResults.
+        '''
+        return {'delayCurves':np.array([self.delayCurves[color] for color in self.colors], np.float64)}
+
+    def viewerMergeDelayResults(self, name2summed):
+        '''Only called when system_params['numViewers'] > 1, on the first viewer before viewerPublishEnd.
+        Gets the delay curves for all the delays from the sum of what viewerDelayResults returned.
+        '''
+        for row, color in enumerate(self.colors):
+            self.delayCurves[color][:] = name2summed['delayCurves'][row]
 
+    def viewerPublishReduced(self, counts, lastEventTime, name2reduced, h5GroupUser):
+        '''Only called when system_params['workerReduce'] is True, or fullUpdate > 0 (light updates). 
+        Receives the reduced arrays from workerReduce, summed over all the workers.
+
+        Args:
+         counts (array): the same as for viewerPublish
+         lastEventTime (dict): the same as for viewerPublish
+         name2reduced (dict): the arrays returned by workerReduce, summed over the workers
+         h5GroupUser: either None, or a valid h5py Group to write results into the h5file
+        '''
+        colorSums = name2reduced['colorSums']
+        colorTotals = name2reduced['colorTotals']
+        delayCurves = {}
+        for color in self.colors:
+            if colorTotals[color] <= 0:
+                # all the pixels of this color are saturated
+                continue
+            delayCurves[color] = (colorSums[:,color] / colorTotals[color]).astype(np.float32)
+        counter120hz = lastEventTime['counter']
+        self.logDelayCurves(counter120hz, delayCurves)
         if h5GroupUser is not None:
-            createdGroup = False
-            try:
-                group = h5GroupUser.create_group(groupName)
-                createdGroup = True
-            except ValueError:
-                pass
-            if not createdGroup:
-                self.mp.logError("Cannot create group  h5 %s. Is viewer update is to frequent?" % groupName)
-            else:
-                delay_ds = group.create_dataset('delays',(len(self.delays),), dtype='i8')
-                delay_ds[:] = self.delays[:]
-                delay_counts_ds = group.create_dataset('delay_counts',(len(counts),), dtype='i8')
-                delay_counts_ds[:] = counts[:]
+            self.h5Write(self.h5StartResults, h5GroupUser, counter120hz, counts.copy())
+            self.h5Write(self.h5EndResults, counts.copy(), delayCurves)
+        self.plotDelayCurves(counter120hz, counts, delayCurves)
+
+    def viewerSetH5Writer(self, h5writer):
+        '''Only called when system_params['h5writerQueue'] > 0, before viewerInit. All the
+        h5 writes then go through the h5writer thread, see h5Write.
+        '''
+        self.h5writer = h5writer
+
+    ######## VIEWER HELPERS (NOT CALLBACKS, JUST USER CODE) ##########
+    def h5Write(self, writeFunction, *args):
+        '''calls writeFunction(*args), or has the h5writer thread call it. The h5 write functions
+        below run in order, and keep the group for the current update in self.publishGroup. 
+        When there is a writer thread, only it uses self.publishGroup and self.h5UpdateIndex.
+        '''
+        if self.h5writer is not None:
+            self.h5writer.submit(writeFunction, *args)
+        else:
+            writeFunction(*args)
+
+    def h5StartResults(self, h5GroupUser, counter120hz, counts):
+        self.publishGroup = self.createResultsGroup(h5GroupUser, counter120hz, counts)
 
-                for color in self.colors:
-                    if color not in delayCurves: continue
-                    delay_curve_color = group.create_dataset('delay_curve_color_%d' % color,
-                                                             (len(counts),),
-                                                             dtype='f8')
-                    delay_curve_color[:] = delayCurves[color][:]
+    def h5WriteArrays(self, name2delay2ndarray):
+        if self.publishGroup is None or self.h5parallel:
+            return
+        # write out the G2, IF, IP matrices using framework helper function
+        if self.h5layout == 'appended':
+            ParCorAna.appendToH5Datasets(self.publishGroup, name2delay2ndarray, self.delays,
+                                         self.h5UpdateIndex, self.h5compression, self.h5FlatIndices)
+        else:
+            ParCorAna.writeToH5Group(self.publishGroup, name2delay2ndarray, self.h5compression,
+                                     self.h5FlatIndices)
+
+    def h5EndResults(self, counts, delayCurves):
+        if self.publishGroup is not None:
+            self.writeDelayCurves(self.publishGroup, counts, delayCurves)
+        self.publishGroup = None
+
+    def createResultsGroup(self, h5GroupUser, counter120hz, counts):
+        '''creates the h5 group for the results of an update, and writes the delays and counts.
+        Returns None if there is no h5 output, or the group could not be created.
+        '''
+        if h5GroupUser is None:
+            return None
+        if self.h5layout == 'appended':
+            return self.appendResultsUpdate(h5GroupUser, counter120hz, counts)
+        groupName = 'G2_results_at_%6.6d' % counter120hz
+        try:
+            group = h5GroupUser.create_group(groupName)
+        except ValueError:
+            self.mp.logError("Cannot create group  h5 %s. Is viewer update is to frequent?" % groupName)
+            return None
+        delay_ds = group.create_dataset('delays',(len(self.delays),), dtype='i8')
+        delay_ds[:] = self.delays[:]
+        delay_counts_ds = group.create_dataset('delay_counts',(len(counts),), dtype='i8')
+        delay_counts_ds[:] = counts[:]
+        return group
+
+    def appendResultsUpdate(self, h5GroupUser, counter120hz, counts):
+        '''for user_params['h5layout'] = 'appended'. All updates go in the group G2_results, with
+        one dataset for each of G2, IF, IP shaped (update, delay, ndarray shape), see 
+        ParCorAna.appendToH5Datasets, and delay_curves shaped (update, color, delay). Creates the group 
+        the first time, adds an update, and writes the counter and counts for it. Returns the group.
+        '''
+        numDelays = len(self.delays)
+        numColors = len(self.h5Colors)
+        if 'G2_results' not in h5GroupUser:
+            group = h5GroupUser.create_group('G2_results')
+            group['delays'] = np.array(self.delays, np.int64)
+            group['colors'] = np.array(self.h5Colors, np.int64)
+            group.create_dataset('counter', (0,), dtype='i8', maxshape=(None,))
+            group.create_dataset('delay_counts', (0, numDelays), dtype='i8', maxshape=(None, numDelays))
+            # colors dropped for saturated pixels read back as NaN
+            group.create_dataset('delay_curves', (0, numColors, numDelays), dtype='f8', 
+                                 maxshape=(None, numColors, numDelays), chunks=(1, numColors, numDelays),
+                                 fillvalue=np.nan)
+        group = h5GroupUser['G2_results']
+        self.h5UpdateIndex = group['counter'].shape[0]
+        for dsetName in ['counter', 'delay_counts', 'delay_curves']:
+            group[dsetName].resize(self.h5UpdateIndex + 1, axis=0)
+        group['counter'][self.h5UpdateIndex] = counter120hz
+        group['delay_counts'][self.h5UpdateIndex] = counts
+        return group
+
+    def writeDelayCurves(self, group, counts, delayCurves):
+        # may run in the h5writer thread, so use the colors of delayCurves rather than self.colors
+        colors = sorted(delayCurves.keys())
+        if self.h5layout == 'appended':
+            for color in colors:
+                group['delay_curves'][self.h5UpdateIndex, self.h5Colors.index(color)] = delayCurves[color]
+            return
+        for color in colors:
+            delay_curve_color = group.create_dataset('delay_curve_color_%d' % color,
+                                                     (len(counts),),
+                                                     dtype='f8')
+            delay_curve_color[:] = delayCurves[color][:]
 
-                # write out the G2, IF, IP matrices using framework helper function
-                ParCorAna.writeToH5Group(group, name2delay2ndarray)
+    def logDelayCurves(self, counter120hz, delayCurves):
+        if self.printDelayCurves:
+            for color in delayCurves.keys():
+                self.logInfo("evt=%5d color=%2d delayCurve=%s ..." % \
+                             (counter120hz, color, ', '.join(map(str,delayCurves[color][0:10]))))
 
+    def plotDelayCurves(self, counter120hz, counts, delayCurves):
         if self.plot:
             goodDelays = counts > 0
-            multi = psmonPlots.MultiPlot(counter120hz, 'MULTI', ncols=3)
+            plots = []
             for color in self.colors:
                 if color not in delayCurves: continue
                 if (self.plotColors is not None) and (not (color in self.plotColors)):
                     continue
-                thisPlot = psmonPlots.XYPlot(counter120hz, 'color/bin=%d' % color,
-                                             [d/120.0 for d in self.delays[goodDelays]], delayCurves[color][goodDelays],
-                                             xlabel='tau (sec)', ylabel='G2', formats='bs-')
-                multi.add(thisPlot)
-            psmonPublish.send('MULTI', multi)
-
+                plots.append(('XYPlot', 'color/bin=%d' % color,
+                              [d/120.0 for d in self.delays[goodDelays]], delayCurves[color][goodDelays],
+                              {'xlabel':'tau (sec)', 'ylabel':'G2', 'formats':'bs-'}))
+            self.publishPlots('MULTI', counter120hz, 3, plots)
 
-
-    ######## VIEWER HELPERS (NOT CALLBACKS, JUST USER CODE) ##########
     def doDebugPlot(self, counter120hz, delaysToPlot, namesToPlot, name2delay2ndarray):
         '''makes a multi plot with given delays, and matrix names.
         '''
@@ -569,7 +959,7 @@ class G2Common(object):
         colA = self.debugPlotImageBounds['colA']
         colB = self.debugPlotImageBounds['colB']
 
-        debugPlot = psmonPlots.MultiPlot(counter120hz, 'DEBUG', ncols=3)
+        plots = []
         for nm in namesToPlot:
             for delay in delaysToPlot:
                 ndarr = name2delay2ndarray[nm][delay]
@@ -577,20 +967,52 @@ class G2Common(object):
                 fullImage[self.iX.flatten(), self.iY.flatten()] = ndarr.flatten()[:]
                 image = fullImage[rowA:rowB,colA:colB]
                 title = "cntr=%d %s dly=%d" % (counter120hz, nm, delay)
-                imagePlot = psmonPlots.Image(counter120hz, title, image)
-                debugPlot.add(imagePlot)
+                plots.append(('Image', title, image))
                 stats = getStats(image.flatten())
                 self.logInfo("%s: cntr=%d min=%5.3f 5=%5.3f 10=%5.3f 25=%5.3f med=%5.3f 75=%5.3f 90=%5.3f 95=%5.3f max=%5.3f" % \
                              (title, counter120hz, stats['min'], stats['5'], stats['10'], stats['25'],
                               stats['med'], stats['75'], stats['90'], stats['95'], stats['max']))
-        psmonPublish.send('DEBUG', debugPlot)
+        self.publishPlots('DEBUG', counter120hz, 3, plots)
+
+    def setPlotTopicPrefix(self, prefix):
+        '''called by ParCorAna.MultiAnalysis, so the analyses in a list publish to different psmon topics,
+        i.e, G2atEnd_MULTI
+        '''
+        self.plotTopicPrefix = prefix
+
+    def plotTopic(self, topic):
+        if self.plotTopicPrefix:
+            return '%s_%s' % (self.plotTopicPrefix, topic)
+        return topic
+
+    def publishPlots(self, topic, counter120hz, ncols, plots):
+        '''publishes the plot descriptions (see ParCorAna.PsmonPublisher) as a psmon MultiPlot.
+        With user_params['psmon_process'] this is done by a separate process.
+        '''
+        topic = self.plotTopic(topic)
+        if self.psmonPublisher is not None:
+            self.psmonPublisher.send(topic, counter120hz, ncols, plots)
+        else:
+            psmonPublish.send(topic, ParCorAna.PsmonPublisher.buildMultiPlot(counter120hz, topic, ncols, plots))
+
+    def viewerShutdown(self):
+        '''called when the viewer is done. Waits for the psmon publishing process, if there is one
+        and no other analysis in the list still uses it.
+        '''
+        if self.psmonStarted:
+            publisher = stopPsmon()
+            if publisher is not None and publisher.numDropped > 0:
+                self.logInfo("psmon publishing process dropped %d stale plot updates" % publisher.numDropped)
+            self.psmonPublisher = None
+            self.psmonStarted = False
 
 
     def changeColorDataIfNewSaturated(self, newSaturated):
         '''update color data based on new saturated pixels. Get new saturated
         pixels out of the color and finecolor label ndarray, update the total
         color/finecolors counts for average, and possibly remove a color if its
-        count went to 0.
+        count went to 0. Only the pixels that were not already excluded are looked
+        at, the labeling and totals are updated for just those pixels.
 
         Args:
           saturated_ndarrayCoords: an int8 with the detector ndarray shape.
@@ -598,64 +1020,55 @@ class G2Common(object):
         Output:
           possibly modifies all color and finecolor data members
         '''
-
-        def getNewColorData(goodPixels, oldColorLabeling):
-            assert goodPixels.dtype == np.bool
-            newColorLabeling = goodPixels * oldColorLabeling
-            newColor2total = sumColoredPixels(newColorLabeling)
-            newColors = list(newColor2total.keys())
-            newColors.sort()
-            return newColorLabeling, newColor2total, newColors
-
-        def calcDropedPixels(oldColor2total, newColor2total):
-            oldColors = list(oldColor2total.keys())
-            newColors = list(newColor2total.keys())
-            numberDroppedPixels = 0
-            droppedColors = set(oldColors).difference(set(newColors))
-            for color in droppedColors:
-                numberDroppedPixels += oldColor2total[color]
-            for color in newColors:
-                assert color in oldColor2total, "unexpected: newcolor=%d not in oldColors?" % color
-                numberDropedThisColor = (oldColor2total[color] - newColor2total[color])
-                assert numberDropedThisColor >= 0, "internal error: more pixels of color=%d after excluding saturated pixels than there were before?" % color
-                numberDroppedPixels += numberDropedThisColor
-            return numberDroppedPixels, droppedColors
-
-
-        saturatedIdx = newSaturated > 0
-        if np.sum(saturatedIdx)==0:
-            # no saturated pixels at all
+        def removePixels(labeling, color2total, newSaturatedIdx):
+            flatLabeling = labeling.reshape(-1)
+            labelDecrements = np.bincount(flatLabeling[newSaturatedIdx])
+            flatLabeling[newSaturatedIdx] = 0
+            droppedColors = []
+            for color in np.flatnonzero(labelDecrements[1:]) + 1:
+                color2total[color] -= labelDecrements[color]
+                assert color2total[color] >= 0, "internal error: fewer than 0 pixels of color=%d after excluding saturated pixels?" % color
+                if color2total[color] == 0:
+                    del color2total[color]
+                    droppedColors.append(color)
+            colors = list(color2total.keys())
+            colors.sort()
+            return np.sum(labelDecrements[1:]), droppedColors, colors
+
+        newSaturatedIdx = np.flatnonzero(np.logical_and(newSaturated.reshape(-1) > 0, 
+                                                        np.logical_not(self.excludedPixels)))
+        if len(newSaturatedIdx)==0:
+            # no new saturated pixels
             return
+        self.excludedPixels[newSaturatedIdx] = True
 
-        goodPixels = np.logical_not(saturatedIdx)
-        newColorLabeling, newColor2total, newColors = getNewColorData(goodPixels, self.color_ndarrayCoords)
-
-        numberDroppedPixels, droppedColors = calcDropedPixels(self.color2total, newColor2total)
+        numberDroppedPixels, droppedColors, self.colors = removePixels(self.color_ndarrayCoords, self.color2total, newSaturatedIdx)
+        numberDroppedFinePixels, droppedFineColors, self.finecolors = removePixels(self.finecolor_ndarrayCoords, self.finecolor2total, newSaturatedIdx)
+        self.colorLabels.removePixels(newSaturatedIdx)
+        self.fineColorLabels.removePixels(newSaturatedIdx)
 
         if numberDroppedPixels == 0:
-            # no new saturated pixels
             return
 
-        newFineColorLabeling, newFineColor2total, newFineColors = getNewColorData(goodPixels, self.finecolor_ndarrayCoords)
-
         droppedColorsMsg = ''
         if len(droppedColors) > 0:
             droppedColorsMsg = ". %d colors are being dropped" % len(droppedColors)
 
         self.logInfo("%d new saturated pixels being removed from color labeling%s" % (numberDroppedPixels, droppedColorsMsg))
 
-        self.color_ndarrayCoords[:] = newColorLabeling[:]
-        self.finecolor_ndarrayCoords[:] = newFineColorLabeling[:]
-
-        self.color2total = newColor2total
-        self.finecolor2total = newFineColor2total
-
-        self.colors = newColors
-        self.finecolors = newFineColors
+    def viewerSetColorLabels(self):
+        '''precomputes the color and finecolor pixel to label maps used to form the delay curves.
+        Needs to be called when the color labeling changes.
+        '''
+        self.colorLabels = ParCorAna.PixelLabels(self.color_ndarrayCoords)
+        self.fineColorLabels = ParCorAna.PixelLabels(self.finecolor_ndarrayCoords)
 
 
 
 class G2IncrementalAccumulator(G2Common):
+    # stored times beyond the largest delay, one second at 120hz, for events that arrive out of order
+    HISTORY_MARGIN = 120
+
     def __init__(self, user_params, system_params, mpiParams, testAlternate):
         super(G2IncrementalAccumulator,self).__init__(user_params, system_params, mpiParams, testAlternate)
         # Example of printing output:
@@ -665,14 +1078,23 @@ class G2IncrementalAccumulator(G2Common):
         # worker logs the message. This reduces noise in the output.
         # Pass allWorkers=True to have all workers log the message.
         # it is a good idea to include the class and method at the start of log messages
+        assert ParCorAna.getOptionalSystemParam(system_params, 'workerInsertBlock') == 0, \
+            "G2IncrementalAccumulator/Windowed read the new data in workerAfterDataInsert, workerInsertBlock must be 0"
+        assert not ParCorAna.getOptionalSystemParam(system_params, 'timeParallel'), \
+            "G2IncrementalAccumulator/Windowed pair each new time as it arrives, timeParallel is only for G2atEnd"
         self.mp.logInfo("G2IncrementalAccumulator: object initialized")
 
+    def workerHistoryNeeded(self):
+        '''a new time is only paired with stored times at most max(delays) before or after it.
+        '''
+        return max(self.delays) + 1 + self.HISTORY_MARGIN
+
     def workerBeforeDataRemove(self, tm, xInd, workerData):
         pass
 
     def workerAfterDataInsert(self, tm, xInd, workerData):
         maxStoredTime = workerData.maxTimeForStoredData()
-        for delayIdx, delay in enumerate(self.delays):
+        for delayIdx, delay in self.workerDelays:
             if delay > maxStoredTime: break
             tmEarlier = tm - delay
             xIndEarlier = workerData.tm2idx(tmEarlier)
@@ -685,11 +1107,14 @@ class G2IncrementalAccumulator(G2Common):
                 earlierLaterPairs.append((xInd, xIndLater, tm, tmLater))
             for earlierLaterPair in earlierLaterPairs:
                 idxEarlier, idxLater, tmEarlier, tmLater = earlierLaterPair
-                intensitiesFirstTime = workerData.X[idxEarlier,:]
-                intensitiesLaterTime = workerData.X[idxLater,:]
-                self.G2[delayIdx,:] += intensitiesFirstTime * intensitiesLaterTime
-                self.IP[delayIdx,:] += intensitiesFirstTime
-                self.IF[delayIdx,:] += intensitiesLaterTime
+                if workerData.sparse:
+                    self.workerSparsePair(delayIdx, workerData, idxEarlier, idxLater)
+                else:
+                    intensitiesFirstTime = workerData.X[idxEarlier,:]
+                    intensitiesLaterTime = workerData.X[idxLater,:]
+                    self.G2[delayIdx,:] += intensitiesFirstTime * intensitiesLaterTime
+                    self.IP[delayIdx,:] += intensitiesFirstTime
+                    self.IF[delayIdx,:] += intensitiesLaterTime
                 self.counts[delayIdx] += 1
                 if self.logger.isEnabledFor(logging.DEBUG):
                     self.logDebug(" workerAfterDataInsert updated dly=%d with pair=(%d,%d) new cnt=%d" % (delay, tmEarlier, tmLater, self.counts[delayIdx]))
@@ -697,7 +1122,7 @@ class G2IncrementalAccumulator(G2Common):
 #            self.mp.logInfo("tm=%s delay=%d G2.min=%.1f G2.avg=%.1f G2.max=%.1f" % (tm, delay, np.min(self.G2[delayIdx,:]), np.average(self.G2[delayIdx,:]), np.max(self.G2[delayIdx,:])), allWorkers=True)
 #            self.mp.logInfo("tm=%s delay=%d IF.min=%.1f IF.avg=%.1f IF.max=%.1f" % (tm, delay, np.min(self.IF[delayIdx,:]), np.average(self.IF[delayIdx,:]), np.max(self.IF[delayIdx,:])), allWorkers=True)
 #            self.mp.logInfo("tm=%s delay=%d IP.min=%.1f IP.avg=%.1f IP.max=%.1f" % (tm, delay, np.min(self.IP[delayIdx,:]), np.average(self.IP[delayIdx,:]), np.max(self.IP[delayIdx,:])), allWorkers=True)
-        if self.logger.isEnabledFor(logging.DEBUG):
+        if self.logger.isEnabledFor(logging.DEBUG) and not workerData.sparse:
             cntsStr = ' '.join(map(str,self.counts))
             self.logDebug("workerAfterDataInsert tm=%d xInd=%s new worker data avg: %.2f cnts=%s" % \
                           (tm, xInd, np.average(workerData.X[xInd]), cntsStr), allWorkers=True)
@@ -714,12 +1139,17 @@ class G2IncrementalWindowed(G2IncrementalAccumulator):
         super(G2IncrementalWindowed,self).__init__(user_params, system_params, mpiParams, testAlternate)
         self.mp.logInfo("G2IncrementalWindowed: initialized base (Accumulator) and now Windowed object initialized")
 
+    def workerHistoryNeeded(self):
+        '''the window is system_params['times'], all of it is needed
+        '''
+        return None
+
     def workerBeforeDataRemove(self, tm, xInd, workerData):
         maxStoredTime = workerData.maxTimeForStoredData()
-        if self.logger.isEnabledFor(logging.DEBUG):
+        if self.logger.isEnabledFor(logging.DEBUG) and not workerData.sparse:
             self.logDebug("workerBeforeDataRemove tm=%d xInd=%s old worker data avg: %.2f maxStoredTime=%d" % \
                           (tm, xInd, np.average(workerData.X[xInd]), maxStoredTime), allWorkers=True)
-        for delayIdx, delay in enumerate(self.delays):
+        for delayIdx, delay in self.workerDelays:
             if delay > maxStoredTime: break
             earlierLaterPairs = []
             tmEarlier = tm - delay
@@ -732,8 +1162,6 @@ class G2IncrementalWindowed(G2IncrementalAccumulator):
                 earlierLaterPairs.append((xInd, xIndLater, tm, tmLater))
             for earlierLaterPair in earlierLaterPairs:
                 idxEarlier, idxLater, tmEarlier, tmLater = earlierLaterPair
-                intensitiesEarlier = workerData.X[idxEarlier,:]
-                intensitiesLater = workerData.X[idxLater,:]
                 if self.logger.isEnabledFor(logging.DEBUG):
                     self.logDebug(" workerAfterDataRemove before update to dly=%d with pair=(%d,%d) current cnt=%d" % (delay, tmEarlier, tmLater, self.counts[delayIdx]))
 
@@ -743,6 +1171,11 @@ class G2IncrementalWindowed(G2IncrementalAccumulator):
                                                    "matching pair is tmEarlier=%d xIndEarlier=%d tmLater=%d xIndLater=%d")  % \
                     (delay, tm, xInd, tmEarlier, idxEarlier, tmLater, idxLater)
                 self.counts[delayIdx] -= 1
+                if workerData.sparse:
+                    self.workerSparsePair(delayIdx, workerData, idxEarlier, idxLater, sign=-1)
+                    continue
+                intensitiesEarlier = workerData.X[idxEarlier,:]
+                intensitiesLater = workerData.X[idxLater,:]
                 self.G2[delayIdx,:] -= intensitiesEarlier * intensitiesLater
                 self.IP[delayIdx,:] -= intensitiesEarlier
                 self.IF[delayIdx,:] -= intensitiesLater
@@ -757,6 +1190,9 @@ class G2IncrementalWindowed(G2IncrementalAccumulator):
 class G2atEnd(G2Common):
     def __init__(self, user_params, system_params, mpiParams, testAlternate):
         super(G2atEnd,self).__init__(user_params, system_params, mpiParams, testAlternate)
+        self.blockTimes = ParCorAna.getOptionalSystemParam(system_params, 'workerBlockTimes')
+        self.pixelLayout = ParCorAna.getOptionalSystemParam(system_params, 'workerStoreLayout') == 'pixel'
+        self.timeParallel = ParCorAna.getOptionalSystemParam(system_params, 'timeParallel')
         self.mp.logInfo("G2atEnd: object initialized")
 
     def workerBeforeDataRemove(self, tm, xInd, workerData):
@@ -767,9 +1203,15 @@ class G2atEnd(G2Common):
 
     def workerCalc(self, workerData):
         assert not workerData.empty(), "UserG2.workerCalc called on empty data"
+        if workerData.sparse:
+            return self.workerCalcSparse(workerData)
+        if self.pixelLayout:
+            return self.workerCalcPixelMajor(workerData)
+        if self.blockTimes > 0 or self.timeParallel:
+            return self.workerCalcBlocked(workerData)
         maxStoredTime = workerData.maxTimeForStoredData()
 
-        for delayIdx, delay in enumerate(self.delays):
+        for delayIdx, delay in self.workerDelays:
             if delay > maxStoredTime: break
             for tmA, xIdxA in workerData.timesDataIndexes():
                 tmB = tmA + delay
@@ -786,6 +1228,108 @@ class G2atEnd(G2Common):
 
         return {'G2':self.G2, 'IP':self.IP, 'IF':self.IF}, self.counts, self.saturatedElements
 
+    def workerCalcBlocked(self, workerData):
+        '''same as workerCalc, but goes through the stored data by blocks of system_params['workerBlockTimes'] 
+        times. For each block, the earlier times are read once, and for each delay, the later times are 
+        a block that follows it. When X is on disk (system_params['workerStoreDir']), this reads it 
+        sequentially. In the time parallel mode, only the earlier times this worker owns are used,
+        the blocks are all the stored times unless workerBlockTimes is set.
+        '''
+        maxStoredTime = workerData.maxTimeForStoredData()
+        blockTimes = self.blockTimes
+        if blockTimes == 0:
+            blockTimes = workerData.numRows
+        for timesA, xIndsA in workerData.timeBlocks(blockTimes):
+            owned = workerData.ownsTimes(timesA)
+            timesA, xIndsA = timesA[owned], xIndsA[owned]
+            if len(timesA) == 0: continue
+            intensities_A = workerData.X[xIndsA,:]
+            for delayIdx, delay in self.workerDelays:
+                if delay > maxStoredTime: break
+                xIndsB = workerData.tms2idx(timesA + delay)
+                timeStored = xIndsB != workerData.INVALID_INDEX
+                numPairs = np.sum(timeStored)
+                if numPairs == 0: continue
+                pairs_A = intensities_A[timeStored,:]
+                intensities_B = workerData.X[xIndsB[timeStored],:]
+                self.counts[delayIdx] += numPairs
+                self.G2[delayIdx,:] += np.sum(pairs_A * intensities_B, axis=0)
+                self.IP[delayIdx,:] += np.sum(pairs_A, axis=0)
+                self.IF[delayIdx,:] += np.sum(intensities_B, axis=0)
+
+        return {'G2':self.G2, 'IP':self.IP, 'IF':self.IF}, self.counts, self.saturatedElements
+
+    def workerCalcSparse(self, workerData):
+        '''same as workerCalc, for the sparse photon mode (system_params['sparsePhotonADU']). 
+        The work goes with the number of photons in each pair of times, not the number of pixels.
+        For each delay, the photons of all the pairs are concatenated, and the pixels with photons 
+        at both times of a pair are matched on (pair, pixel) keys.
+        '''
+        maxStoredTime = workerData.maxTimeForStoredData()
+        numElements = self.G2.shape[1]
+        for timesA, xIndsA in workerData.timeBlocks(workerData.numRows):
+            for delayIdx, delay in self.workerDelays:
+                if delay > maxStoredTime: break
+                xIndsB = workerData.tms2idx(timesA + delay)
+                timeStored = xIndsB != workerData.INVALID_INDEX
+                numPairs = np.sum(timeStored)
+                if numPairs == 0: continue
+                pixelsA, photonsA, pairsA = workerData.concatenatedRows(xIndsA[timeStored])
+                pixelsB, photonsB, pairsB = workerData.concatenatedRows(xIndsB[timeStored])
+                self.counts[delayIdx] += numPairs
+                self.IP[delayIdx,:] += np.bincount(pixelsA, weights=photonsA, minlength=numElements)
+                self.IF[delayIdx,:] += np.bincount(pixelsB, weights=photonsB, minlength=numElements)
+                if len(pixelsA) == 0 or len(pixelsB) == 0: continue
+                # keys are sorted, as the pairs are in order and the pixels are sorted within a pair
+                keysA = pairsA * numElements + pixelsA
+                keysB = pairsB * numElements + pixelsB
+                posB = np.minimum(np.searchsorted(keysB, keysA), len(keysB)-1)
+                inBoth = keysB[posB] == keysA
+                self.G2[delayIdx,:] += np.bincount(pixelsA[inBoth], weights=photonsA[inBoth] * photonsB[posB[inBoth]],
+                                                   minlength=numElements)
+
+        return {'G2':self.G2, 'IP':self.IP, 'IF':self.IF}, self.counts, self.saturatedElements
+
+    def workerCalcPixelMajor(self, workerData):
+        '''same as workerCalc, for system_params['workerStoreLayout']='pixel'. Finds the pairs of
+        stored times for each delay first, then goes through the pixels in blocks, correlating the
+        contiguous time series of each pixel with itself.
+        '''
+        maxStoredTime = workerData.maxTimeForStoredData()
+        times = np.zeros(0, dtype=np.int64)
+        xInds = np.zeros(0, dtype=np.int64)
+        for timesBlock, xIndsBlock in workerData.timeBlocks(workerData.X.shape[0]):
+            owned = workerData.ownsTimes(timesBlock)
+            times = np.concatenate((times, timesBlock[owned]))
+            xInds = np.concatenate((xInds, xIndsBlock[owned]))
+        delayPairs = []
+        for delayIdx, delay in self.workerDelays:
+            if delay > maxStoredTime: break
+            xIndsB = workerData.tms2idx(times + delay)
+            timeStored = xIndsB != workerData.INVALID_INDEX
+            numPairs = np.sum(timeStored)
+            if numPairs == 0: continue
+            self.counts[delayIdx] += numPairs
+            delayPairs.append((delayIdx, xInds[timeStored], xIndsB[timeStored]))
+        if len(delayPairs) == 0:
+            return {'G2':self.G2, 'IP':self.IP, 'IF':self.IF}, self.counts, self.saturatedElements
+
+        XT = workerData.pixelSeries()
+        numPixels = XT.shape[0]
+        # about 2 million stored values per block of pixels
+        pixelsInBlock = max(1, (2 << 20) // max(1, len(xInds)))
+        for pixelStart in range(0, numPixels, pixelsInBlock):
+            pixelEnd = min(numPixels, pixelStart + pixelsInBlock)
+            seriesBlock = np.array(XT[pixelStart:pixelEnd,:])
+            for delayIdx, xIndsA, xIndsB in delayPairs:
+                intensities_A = seriesBlock[:,xIndsA]
+                intensities_B = seriesBlock[:,xIndsB]
+                self.G2[delayIdx,pixelStart:pixelEnd] += np.sum(intensities_A * intensities_B, axis=1)
+                self.IP[delayIdx,pixelStart:pixelEnd] += np.sum(intensities_A, axis=1)
+                self.IF[delayIdx,pixelStart:pixelEnd] += np.sum(intensities_B, axis=1)
+
+        return {'G2':self.G2, 'IP':self.IP, 'IF':self.IF}, self.counts, self.saturatedElements
+
     def calcAndPublishForTestAlt(self, sortedEventIds, sortedData, h5GroupUser):
         times = self.system_params['times']
         startIdx = max(0, len(sortedData)-times)
@@ -3,6 +3,8 @@ import numpy as np
 from . import Exceptions
 import logging
 import math
+import os
+import tempfile
 
 class WorkerData(object):
     '''provide access to worker data.
@@ -11,22 +13,49 @@ class WorkerData(object):
     need to efficiently access data based on time. Keeping the data
     itself sorted could be costly. This class keeps the times sorted
     and maintains indicies into the data.
+
+    If storeDir is given, X is a np.memmap in a file in that directory, rather than 
+    in memory. The file is removed as soon as it is mapped, the space is freed when
+    the process ends.
+
+    With layout='pixel', the data is stored pixel major, XT[pixel,:] is the time series for
+    a pixel, in the order of the X rows, and contiguous. X is then the transposed view of XT, 
+    X[xInd,:] works as before but is strided. With insertBlock > 0, new rows are kept in a 
+    buffer and written into XT a block at a time, which is much faster than writing them one
+    by one. Rows in the buffer are not in X until flush is called, or the buffer fills up, so 
+    the callbacks must not read them.
     '''
     TIME_COLUMN = 0
     X_COLUMN = 1
     INVALID_INDEX = -1
+    # SparseWorkerData stores photons rather than X
+    sparse = False
 
     def __init__(self, logger, isFirstWorker, numTimes, numDataPointsThisWorker, 
-                 storeDtype=np.float32, addRemoveCallbackObject=None):
+                 storeDtype=np.float32, addRemoveCallbackObject=None, storeDir=None,
+                 layout='time', insertBlock=0):
         self.numTimes = numTimes
         self.isFirstWorker = isFirstWorker
+        self.storeDir = storeDir
+        assert layout in ['time', 'pixel'], "WorkerData layout=%s must be 'time' or 'pixel'" % layout
+        self.layout = layout
+        assert insertBlock == 0 or layout == 'pixel', "WorkerData insertBlock > 0 is only for the pixel layout"
+        assert insertBlock <= numTimes, "WorkerData insertBlock=%d is more than numTimes=%d" % (insertBlock, numTimes)
+        self.insertBlock = insertBlock
 
         numWorkerEventsToStore = numTimes
         numTimesToInitiallyStore = 2*numTimes
+        self.numRows = numWorkerEventsToStore
+        self._timeOwner = None
 
         # public data clients will work with
-        self.X = np.empty((numWorkerEventsToStore,numDataPointsThisWorker), 
-                          dtype=storeDtype)
+        self._setStore((numWorkerEventsToStore,numDataPointsThisWorker), storeDtype)
+
+        # rows waiting to be written into XT, and the X rows they go to
+        self._insertBuffer = None
+        self._insertXInds = []
+        if self.insertBlock > 0:
+            self._insertBuffer = np.empty((self.insertBlock, numDataPointsThisWorker), dtype=storeDtype)
 
         # for going from a time to the data
         # _timesXInds is private, it may be resized which would brake references to it
@@ -43,9 +72,66 @@ class WorkerData(object):
         self.addRemoveCallbackObject = addRemoveCallbackObject
         if self.isFirstWorker: self.logger.debug(self.dumpStr())
 
+    def _setStore(self, shape, dtype):
+        '''makes X (and XT for the pixel layout) with shape (times, pixels)
+        '''
+        if self.layout == 'pixel':
+            self.XT = self._newStore((shape[1], shape[0]), dtype)
+            self.X = self.XT.T
+        else:
+            self.X = self._newStore(shape, dtype)
+
+    def setTimeOwner(self, blockCounters, numWorkers, workerIdx):
+        '''for the time parallel decomposition, see CommSystemUtil.timeBlockOwners. The worker 
+        stores its blocks, and the halo after them, but only owns the times in its blocks.
+        '''
+        self._timeOwner = (blockCounters, numWorkers, workerIdx)
+
+    def ownsTimes(self, tms):
+        '''returns a bool array, True for the times this worker owns. All True unless setTimeOwner was called.
+        '''
+        tms = np.asarray(tms, dtype=np.int64)
+        if self._timeOwner is None:
+            return np.ones(tms.shape, np.bool_)
+        blockCounters, numWorkers, workerIdx = self._timeOwner
+        return (tms // blockCounters) % numWorkers == workerIdx
+
+    def pixelSeries(self):
+        '''for the pixel layout, returns XT, XT[pixel,:] is the time series for a pixel, in the 
+        order of the X rows. Use timesDataIndexes, or tms2idx, to get the columns for times.
+        '''
+        assert self.layout == 'pixel', "pixelSeries: WorkerData layout is not 'pixel'"
+        return self.XT
+
+    def flush(self):
+        '''writes the rows buffered by addData into XT. Call before reading X, the framework does 
+        before workerCalc.
+        '''
+        numRows = len(self._insertXInds)
+        if numRows == 0:
+            return
+        firstXInd = self._insertXInds[0]
+        if self._insertXInds == list(range(firstXInd, firstXInd + numRows)):
+            # the usual case, the rows go to consecutive times in XT
+            self.XT[:, firstXInd:(firstXInd + numRows)] = self._insertBuffer[0:numRows,:].T
+        else:
+            self.XT[:, self._insertXInds] = self._insertBuffer[0:numRows,:].T
+        self._insertXInds = []
+
+    def _newStore(self, shape, dtype):
+        if self.storeDir is None:
+            return np.empty(shape, dtype=dtype)
+        fd, fname = tempfile.mkstemp(prefix='ParCorAna_WorkerData_', suffix='.dat', dir=self.storeDir)
+        try:
+            X = np.memmap(fname, dtype=dtype, mode='w+', shape=shape)
+        finally:
+            os.close(fd)
+            os.unlink(fname)
+        return X
+
     def dumpStr(self, long=False):
-        res = "WorkerData tmStart=%d tmAfterEnd=%d nextX=%d filledX=%d numOutOfOrder=%d numDupTimes=%d X.shape=%r _timesXInds.shape=%r" % \
-              (self._timeStartIdx, self._timeAfterEndIdx, self._nextXIdx, self.filledX(), self.numOutOfOrder, self.numDupTimes, self.X.shape, self._timesXInds.shape)
+        res = "WorkerData tmStart=%d tmAfterEnd=%d nextX=%d filledX=%d numOutOfOrder=%d numDupTimes=%d numRows=%d _timesXInds.shape=%r" % \
+              (self._timeStartIdx, self._timeAfterEndIdx, self._nextXIdx, self.filledX(), self.numOutOfOrder, self.numDupTimes, self.numRows, self._timesXInds.shape)
         if long:
             maxwidth = 2
             def fmt(x):
@@ -87,6 +173,37 @@ class WorkerData(object):
             return None
         return xInd
 
+    def tms2idx(self, tms):
+        '''tm2idx for an array of times.
+
+        Return:
+          (ndarray): of np.int64, the X row for each time, or INVALID_INDEX for times not stored
+        '''
+        tms = np.asarray(tms, np.int64)
+        xInds = np.empty(len(tms), np.int64)
+        xInds[:] = WorkerData.INVALID_INDEX
+        currentFilledTimesView = self._timesXInds[self._timeStartIdx:self._timeAfterEndIdx, WorkerData.TIME_COLUMN]
+        if len(currentFilledTimesView) == 0:
+            return xInds
+        tmIndex = np.minimum(np.searchsorted(currentFilledTimesView, tms), len(currentFilledTimesView)-1)
+        foundTime = currentFilledTimesView[tmIndex] == tms
+        xInds[foundTime] = self._timesXInds[self._timeStartIdx + tmIndex[foundTime], WorkerData.X_COLUMN]
+        return xInds
+
+    def timeBlocks(self, numTimesInBlock):
+        '''iterator over blocks of the stored times, in order. Going through X by blocks of time 
+        reads it sequentially, which matters when X is on disk.
+
+        Return:
+          yields (times, xInds) pairs of np.int64 arrays, at most numTimesInBlock long
+        '''
+        assert numTimesInBlock > 0, "timeBlocks: numTimesInBlock must be > 0"
+        for blockStart in range(self._timeStartIdx, self._timeAfterEndIdx, numTimesInBlock):
+            blockEnd = min(self._timeAfterEndIdx, blockStart + numTimesInBlock)
+            tmsXInds = self._timesXInds[blockStart:blockEnd,:]
+            valid = tmsXInds[:, WorkerData.X_COLUMN] != WorkerData.INVALID_INDEX
+            yield tmsXInds[valid, WorkerData.TIME_COLUMN].copy(), tmsXInds[valid, WorkerData.X_COLUMN].copy()
+
     ## --------- begin helper functions for addData
     def _growTimesIfNeeded(self):
         if self._timeAfterEndIdx + 2 >= self._timesXInds.shape[0]:
@@ -109,6 +226,19 @@ class WorkerData(object):
             raise Exceptions.WorkerDataDuplicateTime(tm)
         return tmIndexInView + self._timeStartIdx
 
+    def _adjustNewRow(self, newXrow):
+        if self.addRemoveCallbackObject is not None:
+            self.addRemoveCallbackObject.workerAdjustData(newXrow)
+
+    def _storeRow(self, xInd, newXrow):
+        if self._insertBuffer is None:
+            self.X[xInd,:] = newXrow[:]
+        else:
+            self._insertBuffer[len(self._insertXInds),:] = newXrow[:]
+            self._insertXInds.append(xInd)
+            if len(self._insertXInds) == self.insertBlock:
+                self.flush()
+
     ## ---------- end helper functions for addData
 
     def addData(self, tm, newXrow):
@@ -145,7 +275,7 @@ class WorkerData(object):
         if self.filledX():
             tmForRemoval = self._timesXInds[self._timeStartIdx, WorkerData.TIME_COLUMN]
             xIndForRemoval = self._timesXInds[self._timeStartIdx, WorkerData.X_COLUMN]
-            assert xIndForRemoval >= 0 and xIndForRemoval < self.X.shape[0], "addData: xInd=%d for removal is bad" % xIndForRemoval
+            assert xIndForRemoval >= 0 and xIndForRemoval < self.numRows, "addData: xInd=%d for removal is bad" % xIndForRemoval
             if self.addRemoveCallbackObject is not None:
                 self.addRemoveCallbackObject.workerBeforeDataRemove(tmForRemoval, xIndForRemoval, self)
             self._timesXInds[self._timeStartIdx, WorkerData.X_COLUMN] = WorkerData.INVALID_INDEX
@@ -154,11 +284,10 @@ class WorkerData(object):
         else:
             xIndForNewData = self._nextXIdx
             self._nextXIdx += 1
-        assert xIndForNewData >= 0 and xIndForNewData < self.X.shape[0], "addData: xIndForNewData=%d is bad" % xIndForNewData
+        assert xIndForNewData >= 0 and xIndForNewData < self.numRows, "addData: xIndForNewData=%d is bad" % xIndForNewData
 
         # let client adjust new data before we store it.
-        if self.addRemoveCallbackObject is not None:
-            self.addRemoveCallbackObject.workerAdjustData(newXrow)
+        self._adjustNewRow(newXrow)
 
         if timeIndForNewData < self._timeAfterEndIdx:
             self.numOutOfOrder += 1
@@ -168,7 +297,7 @@ class WorkerData(object):
             
         # store new time and data
         self._timesXInds[timeIndForNewData,WorkerData.TIME_COLUMN]=tm
-        self.X[xIndForNewData,:] = newXrow[:]
+        self._storeRow(xIndForNewData, newXrow)
         self._timesXInds[timeIndForNewData, WorkerData.X_COLUMN] = xIndForNewData
         
         if self.addRemoveCallbackObject is not None:
@@ -186,7 +315,7 @@ class WorkerData(object):
         return self._timeAfterEndIdx == self._timeStartIdx
 
     def filledX(self):
-        return self._nextXIdx == self.X.shape[0]
+        return self._nextXIdx == self.numRows
 
     def minTimeForStoredData(self):
         assert not self.empty(), "can't ask for min time on empty data. use empty() to check before calling this function"
@@ -196,6 +325,55 @@ class WorkerData(object):
         assert not self.empty(), "can't ask for max time on empty data. use empty() to check before calling this function"
         return self._timesXInds[self._timeAfterEndIdx-1, WorkerData.TIME_COLUMN]
 
+    def setPixelData(self, X):
+        '''replaces X with an array for a different set of pixels.
+
+        The rows of X must correspond to the same times as before. Used when
+        workers move pixels between themselves. Call flush before getting the X to change.
+        '''
+        assert X.shape[0] == self.X.shape[0], "setPixelData: new X has %d rows, but there are %d rows" % (X.shape[0], self.X.shape[0])
+        assert X.dtype == self.X.dtype, "setPixelData: new X has dtype=%s, but X has dtype=%s" % (X.dtype, self.X.dtype)
+        assert len(self._insertXInds) == 0, "setPixelData: there are rows that were not flushed"
+        if (self.storeDir is not None) or (self.layout == 'pixel'):
+            # keep X on disk, or pixel major
+            self._setStore(X.shape, X.dtype)
+            self.X[:] = X
+        else:
+            self.X = X
+        if self._insertBuffer is not None:
+            self._insertBuffer = np.empty((self.insertBlock, X.shape[1]), dtype=X.dtype)
+
+    def storedTimesAndData(self):
+        '''returns the stored times, in order, and a copy of the rows of X for them, in the same order.
+        Used to checkpoint the worker.
+        '''
+        self.flush()
+        timesXInds = list(self.timesDataIndexes())
+        times = np.array([tmXidx[0] for tmXidx in timesXInds], np.int64)
+        xInds = np.array([tmXidx[1] for tmXidx in timesXInds], np.int64)
+        return times, self.X[xInds,:]
+
+    def restoreData(self, times, Xrows):
+        '''replaces all stored data with the given times and rows, as returned by storedTimesAndData.
+
+        The rows are stored at the start of X, the oldest time is the first to be overwritten.
+        No callbacks are called, the client restores its own arrays.
+        '''
+        numStored = len(times)
+        assert numStored <= self.X.shape[0], "restoreData: %d times to restore, but X only has %d rows" % (numStored, self.X.shape[0])
+        assert Xrows.shape == (numStored, self.X.shape[1]), "restoreData: rows shape=%s != %s" % (Xrows.shape, (numStored, self.X.shape[1]))
+        assert np.all(np.diff(times) > 0), "restoreData: times are not strictly increasing"
+        numTimesToStore = max(2*self.numTimes, numStored + 3)
+        self._timesXInds = np.empty((numTimesToStore,2), np.int64)
+        self._timesXInds[:,WorkerData.X_COLUMN] = WorkerData.INVALID_INDEX
+        self._timesXInds[0:numStored, WorkerData.TIME_COLUMN] = times
+        self._timesXInds[0:numStored, WorkerData.X_COLUMN] = np.arange(numStored)
+        self._insertXInds = []
+        self.X[0:numStored,:] = Xrows
+        self._timeStartIdx = 0
+        self._timeAfterEndIdx = numStored
+        self._nextXIdx = numStored
+
     def timesForStoredData(self):
         '''returns sorted copy of times (120hz counters) received thus far by this worker
         
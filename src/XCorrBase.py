@@ -6,6 +6,7 @@ standard_library.install_aliases()
 from mpi4py import MPI
 import numpy as np
 import os
+import math
 import time
 import shutil
 import io
@@ -15,6 +16,9 @@ import logging
 import h5py
 
 from ParCorAna.WorkerData import WorkerData
+from ParCorAna.SparseWorkerData import SparseWorkerData
+from ParCorAna.MultiAnalysis import MultiAnalysis
+from ParCorAna.H5Writer import H5Writer
 import ParCorAna.Timing as Timing
 import ParCorAna.CommSystemUtil as CommSystemUtil
 import ParCorAna as corAna
@@ -94,23 +98,156 @@ def makeDelayList(start, stop, num, spacing, logbase=np.e):
             
 
 
-def writeToH5Group(h5Group, name2delay2ndarray):
+def writeToH5Group(h5Group, name2delay2ndarray, compression=None, flatIndices=None):
     '''This writes the name2delay2ndarray 2D dict that the user module viewerPublish receives
     to an hdf5 group. It creates several subgroups:
 
     h5Group/name/delay/ndarray
 
     That is for each pair that indexes the name2delay2ndarray 2D dict, we write a ndarray.
+    It can be called several times for the same h5Group with different delays.
+    compression is passed on to h5py create_dataset, for example 'gzip' or 'lzf'.
+    If flatIndices is given, only those elements of the flattened ndarrays are written, 
+    see system_params['h5maskedFlat'] and expandMaskedFlat.
     '''
     for nm, delay2ndarrayDict in name2delay2ndarray.items():
-        nmGroup = h5Group.create_group(nm)
+        if nm in h5Group:
+            nmGroup = h5Group[nm]
+        else:
+            nmGroup = h5Group.create_group(nm)
         for delay, ndarray in delay2ndarrayDict.items():
+            if flatIndices is not None:
+                ndarray = np.take(ndarray, flatIndices)
             dataSetName = 'delay_%6.6d' % delay
             dataSetShape = ndarray.shape
             dataSetDType = ndarray.dtype
-            delayDataset = nmGroup.create_dataset(dataSetName, dataSetShape, dataSetDType)
+            delayDataset = nmGroup.create_dataset(dataSetName, dataSetShape, dataSetDType,
+                                                  compression=compression)
             delayDataset[:] = ndarray[:]
 
+def appendToH5Datasets(h5Group, name2delay2ndarray, delays, update, compression=None, flatIndices=None):
+    '''An alternative to writeToH5Group that writes one dataset for each name, shaped
+    (update, delay, ndarray shape):
+
+    h5Group/name[update, delayIndex]
+
+    The datasets are created the first time, and extended along the update axis as needed.
+    They are chunked by one ndarray, so each delay of an update is one chunk, and compressed
+    with compression if given. Elements for updates or delays that were never written read 
+    back as NaN. It can be called several times for the same update with different delays.
+
+    Args:
+      h5Group: h5py group to write the datasets into
+      name2delay2ndarray: the 2D dict that viewerPublish receives
+      delays (list): all the delays, the position of a delay is its index in the datasets
+      update (int): index of the update in the datasets
+      compression: passed on to h5py create_dataset, for example 'gzip' or 'lzf'
+      flatIndices: if given, only these elements of the flattened ndarrays are written,
+                   the datasets are then (update, delay, len(flatIndices))
+    '''
+    delay2index = dict([(delay, idx) for idx, delay in enumerate(delays)])
+    for nm, delay2ndarrayDict in name2delay2ndarray.items():
+        for delay, ndarray in delay2ndarrayDict.items():
+            if flatIndices is not None:
+                ndarray = np.take(ndarray, flatIndices)
+            if nm not in h5Group:
+                fillvalue = 0
+                if ndarray.dtype.kind == 'f':
+                    fillvalue = np.nan
+                h5Group.create_dataset(nm, (0, len(delays)) + ndarray.shape, ndarray.dtype,
+                                       maxshape=(None, len(delays)) + ndarray.shape,
+                                       chunks=(1, 1) + ndarray.shape,
+                                       compression=compression,
+                                       fillvalue=fillvalue)
+            dataset = h5Group[nm]
+            if dataset.shape[0] <= update:
+                dataset.resize(update + 1, axis=0)
+            dataset[update, delay2index[delay]] = ndarray
+
+def expandMaskedFlat(h5file, maskedFlat):
+    '''expands results written with system_params['h5maskedFlat'] back to the detector ndarray shape.
+
+    Args:
+      h5file: the h5output file, an open h5py File
+      maskedFlat: array whose last dimension is over the masked elements, in the order 
+                  of /system/maskedFlatIndices, for example one delay of a G2 dataset.
+
+    Returns:
+      array with the shape maskedFlat.shape[0:-1] + ndarray shape. Elements that are
+      masked out are 0.
+    '''
+    maskedFlatIndices = h5file['system']['maskedFlatIndices'][:]
+    ndarrayShape = h5file['system']['system_params']['maskNdarrayCoords'].shape
+    maskedFlat = np.asarray(maskedFlat)
+    assert maskedFlat.shape[-1] == len(maskedFlatIndices), "expandMaskedFlat: last dimension of maskedFlat=%d != number of masked elements=%d" % \
+        (maskedFlat.shape[-1], len(maskedFlatIndices))
+    leadingShape = maskedFlat.shape[0:-1]
+    ndarrays = np.zeros(leadingShape + (int(np.prod(ndarrayShape)),), maskedFlat.dtype)
+    ndarrays[..., maskedFlatIndices] = maskedFlat
+    return ndarrays.reshape(leadingShape + tuple(ndarrayShape))
+
+def workersH5Name(h5output):
+    '''returns the name of the file the workers write with system_params['h5parallel'].
+    '''
+    root, ext = os.path.splitext(h5output)
+    return root + '_workers' + ext
+
+def viewerH5Name(h5output, viewerIndex):
+    '''returns the name of the file a helper viewer writes its delays to, when
+    system_params['numViewers'] > 1.
+    '''
+    root, ext = os.path.splitext(h5output)
+    return root + ('_viewer%d' % viewerIndex) + ext
+
+def checkpointWorkerName(checkpoint, workerIdx, slot):
+    '''returns the name of a workers checkpoint file for system_params['checkpoint'].
+
+    The workers alternate between two slots, so the files of the last complete checkpoint are
+    not touched while the next one is written.
+    '''
+    root, ext = os.path.splitext(checkpoint)
+    return '%s_worker%d_%d%s' % (root, workerIdx, slot, ext)
+
+def writeCheckpointMaster(checkpoint, state):
+    '''writes the master checkpoint file, a dict of names to values. It is written after the
+    worker files, and moved into place, so it always describes a complete checkpoint.
+    '''
+    inprogress = checkpoint + '.inprogress'
+    h5file = h5py.File(inprogress, 'w')
+    for key, value in state.items():
+        h5file[key] = value
+    h5file.close()
+    shutil.move(inprogress, checkpoint)
+
+def readCheckpointMaster(checkpoint):
+    '''returns the dict written by writeCheckpointMaster.
+    '''
+    assert os.path.exists(checkpoint), "checkpoint file %s does not exist, can't resume" % checkpoint
+    h5file = h5py.File(checkpoint, 'r')
+    state = dict((key, h5file[key][()]) for key in h5file.keys())
+    h5file.close()
+    return state
+
+def checkpointElementsForWorker(workerFlatIndices, checkpointFlatIndices):
+    '''for resuming when the elements are divided differently among the workers than when the
+    checkpoint was written.
+
+    Args:
+      workerFlatIndices:     flat ndarray indices of the elements of this worker, in order
+      checkpointFlatIndices: flat ndarray indices of the elements in one checkpoint file
+
+    Return:
+      selected:  boolean array over the checkpoint elements, True for elements of this worker
+      positions: for the selected elements, their position among the elements of this worker
+    '''
+    maxIndex = max(np.max(workerFlatIndices), np.max(checkpointFlatIndices))
+    flatToWorker = np.empty(maxIndex + 1, np.int64)
+    flatToWorker[:] = -1
+    flatToWorker[workerFlatIndices] = np.arange(len(workerFlatIndices))
+    workerPositions = flatToWorker[checkpointFlatIndices]
+    selected = workerPositions >= 0
+    return selected, workerPositions[selected]
+
 def writeConfig(h5file, system_params, user_params):
     if 'system' in list(h5file.keys()):
         h5Group = h5file['system']
@@ -142,7 +279,7 @@ def writeConfig(h5file, system_params, user_params):
 ###############################
 class XCorrBase(object):
     def __init__(self, mp, dataSourceString, srcString,
-                 numEvents, maxTimes, system_params, user_params, test_alt):
+                 numEvents, maxTimes, system_params, user_params, test_alt, resume=False):
         self.dataSourceString = dataSourceString
         self.srcString = srcString
         self.numEvents = numEvents
@@ -153,20 +290,102 @@ class XCorrBase(object):
         self.logger = mp.logger
         self.isServerOrFirstWorker = self.mp.isServer or self.mp.isFirstWorker
         self.isViewerOrFirstWorker = self.mp.isViewer or self.mp.isFirstWorker
+        self.isAnyViewer = self.mp.isViewer or self.mp.isHelperViewer
         self.delays = self.system_params['delays']
         self.numDelays = len(self.delays)
         userClass = system_params['userClass']
-        self.userObj = userClass(user_params, system_params, mp, test_alt)
+        # the delay counts, with a list of user classes there is a row for each analysis
+        self.countsShape = (self.numDelays,)
+        if isinstance(userClass, list):
+            self.userObj = MultiAnalysis(userClass, user_params, system_params, mp, test_alt)
+            self.countsShape = (len(userClass), self.numDelays)
+        else:
+            self.userObj = userClass(user_params, system_params, mp, test_alt)
         self.arrayNames = self.userObj.fwArrayNames()
         self.totalMaskedElements = np.sum(self.mp.maskNdarrayCoords)
         self.test_alt = test_alt
+        self.workerBusyTime = 0.0
+        self.workerReduce = CommSystemUtil.getOptionalSystemParam(system_params, 'workerReduce')
+        self.fullUpdate = CommSystemUtil.getOptionalSystemParam(system_params, 'fullUpdate')
+        self.asyncUpdate = CommSystemUtil.getOptionalSystemParam(system_params, 'asyncUpdate')
+        if self.asyncUpdate:
+            assert not (self.workerReduce and (self.fullUpdate == 0)), \
+                "system_params asyncUpdate is for gathering the per pixel arrays. It can't be used with workerReduce unless fullUpdate > 0"
+        self.asyncRequests = []
+        self.asyncSnapshot = {}
+        self.viewerDelayBlock = CommSystemUtil.getOptionalSystemParam(system_params, 'viewerDelayBlock')
+        if self.viewerDelayBlock > 0:
+            assert not self.asyncUpdate, "system_params viewerDelayBlock > 0 can't be used with asyncUpdate"
+            for callback in ['viewerPublishStart', 'viewerPublishDelays', 'viewerPublishEnd']:
+                assert hasattr(self.userObj, callback), "system_params viewerDelayBlock > 0 but user class does not implement %s" % callback
+        self.numViewers = self.mp.numViewers
+        if self.numViewers > 1:
+            assert not self.asyncUpdate, "system_params numViewers > 1 can't be used with asyncUpdate"
+            assert self.numViewers <= self.numDelays, "system_params numViewers=%d is more than the number of delays=%d" % \
+                (self.numViewers, self.numDelays)
+            for callback in ['viewerPublishStart', 'viewerPublishDelays', 'viewerPublishEnd',
+                             'viewerDelayResults', 'viewerMergeDelayResults']:
+                assert hasattr(self.userObj, callback), "system_params numViewers > 1 but user class does not implement %s" % callback
+        # for each viewer, the (blockStart, blockEnd) delay indices of the blocks it gathers
+        self.numGatherDelays, self.viewerDelayBlocks = CommSystemUtil.viewerDelayBlocks(self.numDelays, self.numViewers,
+                                                                                       self.viewerDelayBlock)
+        # in test_alt mode there are no workers to write in parallel, the viewer writes as usual
+        self.h5parallel = CommSystemUtil.getOptionalSystemParam(system_params, 'h5parallel') and \
+                          (system_params['h5output'] is not None) and (not test_alt)
+        if self.h5parallel:
+            assert h5py.get_config().mpi, "system_params h5parallel is True but h5py was not built with MPI support"
+        self.checkpoint = CommSystemUtil.getOptionalSystemParam(system_params, 'checkpoint')
+        self.checkpointInterval = CommSystemUtil.getOptionalSystemParam(system_params, 'checkpointInterval')
+        self.resume = resume
+        if self.resume or (self.checkpointInterval > 0):
+            assert self.checkpoint is not None, "resume, or system_params checkpointInterval > 0, but system_params checkpoint is None"
+            assert not test_alt, "checkpoints are not used in test_alt mode"
+            for callback in ['workerPixelArrays', 'workerSetPixelArrays', 
+                             'workerCheckpointArrays', 'workerSetCheckpointArrays']:
+                assert hasattr(self.userObj, callback), "resume, or system_params checkpointInterval > 0, but user class does not implement %s" % callback
+        self.photonADU = CommSystemUtil.getOptionalSystemParam(system_params, 'sparsePhotonADU')
+        self.photonThreshold = CommSystemUtil.getOptionalSystemParam(system_params, 'sparsePhotonThreshold')
+        self.sparse = self.photonADU is not None
+        if self.sparse:
+            assert self.photonADU > 0, "system_params sparsePhotonADU=%r must be > 0" % self.photonADU
+            assert CommSystemUtil.getOptionalSystemParam(system_params, 'rebalanceInterval') == 0, "sparsePhotonADU is set, rebalanceInterval must be 0"
+            assert (not self.resume) and (self.checkpointInterval == 0), "sparsePhotonADU is set, checkpoints are not supported"
+            assert CommSystemUtil.getOptionalSystemParam(system_params, 'workerStoreDir') is None, "sparsePhotonADU is set, workerStoreDir must be None"
+            assert CommSystemUtil.getOptionalSystemParam(system_params, 'workerStoreLayout') == 'time', "sparsePhotonADU is set, workerStoreLayout must be 'time'"
+        # in test_alt mode there is one process, the time parallel mode is not used
+        self.timeParallel = CommSystemUtil.getOptionalSystemParam(system_params, 'timeParallel') and (not test_alt)
+        if self.timeParallel:
+            assert not self.sparse, "system_params timeParallel is True, sparsePhotonADU must be None"
+            assert CommSystemUtil.getOptionalSystemParam(system_params, 'rebalanceInterval') == 0, "system_params timeParallel is True, rebalanceInterval must be 0"
+            assert (not self.resume) and (self.checkpointInterval == 0), "system_params timeParallel is True, checkpoints are not supported"
+            assert (not self.workerReduce) and (self.fullUpdate == 0), "system_params timeParallel is True, workerReduce and fullUpdate are not supported"
+            # each worker owns a block of the times, and stores the largest delay after it
+            self.timeBlockCounters = int(math.ceil(system_params['times'] / float(self.mp.numWorkers)))
+            self.timeHalo = int(max(self.delays))
+        # workers in a pixel group store the same pixels, and split the delays
+        self.delayGroups = self.mp.delayGroups
+        if self.delayGroups > 1:
+            assert not self.sparse, "system_params delayGroups > 1, sparsePhotonADU must be None"
+            assert not self.timeParallel, "system_params delayGroups > 1, timeParallel must be False"
+            assert CommSystemUtil.getOptionalSystemParam(system_params, 'rebalanceInterval') == 0, "system_params delayGroups > 1, rebalanceInterval must be 0"
+            assert (not self.resume) and (self.checkpointInterval == 0), "system_params delayGroups > 1, checkpoints are not supported"
+            assert (not self.workerReduce) and (self.fullUpdate == 0), "system_params delayGroups > 1, workerReduce and fullUpdate are not supported"
+            assert hasattr(self.userObj, 'workerSetDelayIndices'), "system_params delayGroups > 1, but user class does not implement workerSetDelayIndices"
+        if self.fullUpdate > 0:
+            assert system_params['update'] > 0, "system_params fullUpdate > 0 but update is 0. The light updates happen every 'update' events"
+        if self.workerReduce or (self.fullUpdate > 0):
+            for callback in ['workerReduce', 'viewerPublishReduced']:
+                assert hasattr(self.userObj, callback), "system_params workerReduce is True, or fullUpdate > 0, but user class does not implement %s" % callback
 
     def runTestAlt(self):
         self.userObj.runTestAlt()
 
     def makeEventIter(self):
-        self.logger.debug('XCorrBase.makeEventIter returning EventIter(datasource=%s,rank=%s,servers=%s,numEvents=%s)' % \
-                          (self.dataSourceString,self.mp.rank,self.mp.serverRanks,self.numEvents))
+        skipThrough = None
+        if self.resume:
+            skipThrough = self.serverResumeSkipThrough()
+        self.logger.debug('XCorrBase.makeEventIter returning EventIter(datasource=%s,rank=%s,servers=%s,numEvents=%s,skipThrough=%s)' % \
+                          (self.dataSourceString,self.mp.rank,self.mp.serverRanks,self.numEvents,skipThrough))
         return EventIter(self.dataSourceString,
                          self.mp.rank,
                          self.mp.serverRanks,
@@ -174,7 +393,45 @@ class XCorrBase(object):
                          self.system_params,
                          self.mp.maskNdarrayCoords.shape,
                          self.mp.logger,
-                         self.numEvents)
+                         self.numEvents,
+                         skipThrough=skipThrough)
+
+    def serverResumeSkipThrough(self):
+        '''returns the (sec, nsec) of the last event from this server that was given to the workers
+        before the checkpoint, or None if there was none.
+        '''
+        state = readCheckpointMaster(self.checkpoint)
+        assert int(state['numServers']) == len(self.mp.serverRanks), \
+            "checkpoint was written with %d servers, but there are %d. The servers divide the events by their number, resume with the same number of servers" % \
+            (int(state['numServers']), len(self.mp.serverRanks))
+        sec, nsec = [int(x) for x in state['serverLastEventIds'][self.mp.serverRanks.index(self.mp.rank)]]
+        if sec < 0:
+            return None
+        return sec, nsec
+
+    def serverWorkersSendTimeParallel(self, counter, detectorData1Darray = None, serverWorldRank = None):
+        '''time parallel mode version of serverWorkersScatter. The server sends all of the masked
+        elements to the workers that store the event at counter, see CommSystemUtil.timeBlockOwners.
+        The other workers receive nothing. Returns True if this worker received the data.
+        '''
+        if serverWorldRank is None:
+            assert self.mp.isServer, "XCorrBase.serverWorkersSendTimeParallel - no serverRank passed but not called as Server"
+            serverWorldRank = self.mp.rank
+        serverWorkersDict = self.mp.serverWorkers[serverWorldRank]
+        comm = serverWorkersDict['comm']
+        workerRanksInCommDict = serverWorkersDict['workerRanksInCommDict']
+        owners = CommSystemUtil.timeBlockOwners(counter, self.timeBlockCounters, self.mp.numWorkers, self.timeHalo)
+        ownerRanks = [self.mp.workerRanks[owner] for owner in owners]
+        if self.mp.isServer:
+            assert detectorData1Darray is not None, "XCorrBase server expected data but got None"
+            assert len(detectorData1Darray) == self.totalMaskedElements, "time parallel data is not all the masked elements"
+            for ownerRank in ownerRanks:
+                comm.Send([detectorData1Darray, MPI.FLOAT], dest=workerRanksInCommDict[ownerRank])
+            return False
+        if self.mp.rank not in ownerRanks:
+            return False
+        comm.Recv([self.workerScatterReceiveBuffer, MPI.FLOAT], source=serverWorkersDict['serverRankInComm'])
+        return True
 
     def serverWorkersScatter(self, detectorData1Darray = None, serverWorldRank = None):
         '''called from both server and worker ranks for the scattering of the data.
@@ -186,7 +443,12 @@ class XCorrBase(object):
         When called from the worker, args are
         detectorData1Darray  - None
         serverWorldRank      - the server rank, as received from the master in EVT message
+
+        In the sparse photon mode, the server passes a (pixels, photons) tuple, see serverWorkersScatterSparse.
         '''
+        assert not self.timeParallel, "time parallel mode uses serverWorkersSendTimeParallel"
+        if self.sparse:
+            return self.serverWorkersScatterSparse(detectorData1Darray, serverWorldRank)
         if serverWorldRank is None:
             assert self.mp.isServer, "XCorrBase.serverWorkersScatter - no serverRank passed but not called as Server"
             serverWorldRank = self.mp.rank
@@ -210,6 +472,9 @@ class XCorrBase(object):
             sendBuffer = None
             recvBuffer = self.workerScatterReceiveBuffer
             thisWorkerRankInComm = workerRanksInCommDict[self.mp.rank]
+            if self.delayGroups > 1:
+                # only the first worker of a pixel group receives, it broadcasts to the group below
+                recvBuffer = recvBuffer[0:counts[thisWorkerRankInComm]]
             assert len(recvBuffer) == counts[thisWorkerRankInComm], 'recv buffer len != count'
 
         if self.isServerOrFirstWorker and self.logger.isEnabledFor(logging.DEBUG):
@@ -220,6 +485,8 @@ class XCorrBase(object):
                        MPI.FLOAT],
                       recvBuffer,
                       root = serverRankInComm)
+        if self.mp.isWorker and self.delayGroups > 1:
+            self.workerPixelGroupComm.Bcast([self.workerScatterReceiveBuffer, MPI.FLOAT], root=0)
 #        comm.Barrier()
         if self.isServerOrFirstWorker and self.logger.isEnabledFor(logging.DEBUG):
             if self.mp.isServer:
@@ -228,63 +495,343 @@ class XCorrBase(object):
                 self.logger.debug('XCorrBase.serverWorkersScatter: after Scatterv and Barrier. First worker received %r as first element of buffer with dtype=%r' % (recvBuffer[0], recvBuffer.dtype))
 
 
+    def serverWorkersScatterSparse(self, pixelsPhotons=None, serverWorldRank=None):
+        '''sparse photon mode version of serverWorkersScatter. The server sends each worker the
+        (pixel, photons) pairs for its elements. The workers set workerSparseReceived to
+        (pixels, photons), with the pixels relative to the first element of the worker.
+
+        When called from the server, pixelsPhotons are from CommSystemUtil.photonize of the 
+        masked data, the pixels are sorted.
+        '''
+        if serverWorldRank is None:
+            assert self.mp.isServer, "XCorrBase.serverWorkersScatterSparse - no serverRank passed but not called as Server"
+            serverWorldRank = self.mp.rank
+        serverWorkersDict = self.mp.serverWorkers[serverWorldRank]
+        counts = serverWorkersDict['groupScattervCounts']
+        offsets = serverWorkersDict['groupScattervOffsets']
+        comm = serverWorkersDict['comm']
+        serverRankInComm = serverWorkersDict['serverRankInComm']
+        numPairs = np.zeros(len(counts), np.int64)
+        numPairsThisRank = np.zeros(1, np.int64)
+        if self.mp.isServer:
+            assert pixelsPhotons is not None, "XCorrBase server expected (pixels, photons) but got None"
+            pixels, photons = pixelsPhotons
+            assert counts[serverRankInComm] == 0, "server count for scatter is not zero"
+            # the pixels are sorted, the pairs for each rank are contiguous
+            pairStarts = np.searchsorted(pixels, offsets)
+            numPairs[:] = np.searchsorted(pixels, np.array(offsets) + np.array(counts)) - pairStarts
+            pairs = np.empty((len(pixels), 2), np.int32)
+            pairs[:,0] = pixels
+            pairs[:,1] = photons
+            comm.Scatter([numPairs, MPI.INT64_T], [numPairsThisRank, MPI.INT64_T], root=serverRankInComm)
+            comm.Scatterv([pairs,
+                           tuple([2*int(num) for num in numPairs]),
+                           tuple([2*int(start) for start in pairStarts]),
+                           MPI.INT],
+                          [np.zeros(0, np.int32), MPI.INT],
+                          root=serverRankInComm)
+        elif self.mp.isWorker:
+            comm.Scatter(None, [numPairsThisRank, MPI.INT64_T], root=serverRankInComm)
+            pairs = np.empty((int(numPairsThisRank[0]), 2), np.int32)
+            comm.Scatterv(None, [pairs, MPI.INT], root=serverRankInComm)
+            thisWorkerOffset = offsets[serverWorkersDict['workerRanksInCommDict'][self.mp.rank]]
+            self.workerSparseReceived = (pairs[:,0] - np.int32(thisWorkerOffset), pairs[:,1].copy())
+
     def serverInit(self):
         self.serverScatterReceiveBuffer = np.zeros(0,dtype=np.float32)
         self.userObj.serverInit()
 
     def initDelayAndGather(self):
-        gatherOneNDArrayCounts = [self.mp.workerWorldRankToCount[rank] for rank in self.mp.workerRanks]
-        gatherOneNDArrayCounts.insert(self.mp.viewerRankInViewerWorkersComm,0)
+        # counts and offsets to gather one ndarray through each viewers communicator with the workers
+        self.viewerGatherCountsOffsets = []
+        for viewerRankInComm in self.mp.viewerRanksInViewerWorkersComms:
+            viewerGatherCounts = [self.mp.workerWorldRankToCount[rank] for rank in self.mp.workerRanks]
+            viewerGatherCounts.insert(viewerRankInComm, 0)
+            viewerGatherOffsets = [0] + list(np.cumsum(viewerGatherCounts))[0:-1]
+            CommSystemUtil.checkCountsOffsets(viewerGatherCounts, viewerGatherOffsets, self.totalMaskedElements)
+            self.viewerGatherCountsOffsets.append((tuple(viewerGatherCounts), tuple(viewerGatherOffsets)))
+
+        gatherOneNDArrayCounts, gatherOneNDArrayOffsets = self.viewerGatherCountsOffsets[0]
         gatherAllDelayCounts = [c*self.numDelays for c in gatherOneNDArrayCounts]
-        
-        gatherOneNDArrayOffsets = [0] + list(np.cumsum(gatherOneNDArrayCounts))[0:-1]
         gatherAllDelayOffsets = [0] + list(np.cumsum(gatherAllDelayCounts))[0:-1]
 
-        CommSystemUtil.checkCountsOffsets(gatherOneNDArrayCounts, gatherOneNDArrayOffsets, self.totalMaskedElements)
         CommSystemUtil.checkCountsOffsets(gatherAllDelayCounts, gatherAllDelayOffsets, self.numDelays * self.totalMaskedElements)
         
-        self.gatherOneNDArrayCounts = tuple(gatherOneNDArrayCounts)
-        self.gatherOneNDArrayOffsets = tuple(gatherOneNDArrayOffsets)
+        self.gatherOneNDArrayCounts = gatherOneNDArrayCounts
+        self.gatherOneNDArrayOffsets = gatherOneNDArrayOffsets
 
         self.gatherAllDelayCounts = tuple(gatherAllDelayCounts)
         self.gatherAllDelayOffsets = tuple(gatherAllDelayOffsets)
 
+        if self.isAnyViewer:
+            # for each worker, in the order they are gathered, the number of elements and where 
+            # they go in the flattened ndarray
+            self.viewerWorkerSegments = []
+            for workerRank in self.mp.workerRanks:
+                workerCount = self.mp.workerWorldRankToCount[workerRank]
+                workerOffset = self.mp.workerWorldRankToOffset[workerRank]
+                self.viewerWorkerSegments.append((workerCount, 
+                                                  self.mp.maskedFlatIndices[workerOffset:(workerOffset + workerCount)]))
+
     def workerInit(self):
         worldRank = self.mp.rank
         scatterCount = self.mp.workerWorldRankToCount[worldRank]
         thisWorkerStartElement = self.mp.workerWorldRankToOffset[worldRank]
-        self.workerScatterReceiveBuffer = np.zeros(scatterCount,dtype=np.float32)
+        # in the time parallel mode, workers store all the masked elements of their times
+        self.elementsThisWorkerStores = scatterCount
+        if self.timeParallel:
+            self.elementsThisWorkerStores = int(self.totalMaskedElements)
+        elif self.delayGroups > 1:
+            # the workers in a pixel group store the pixels of its first worker
+            pixelGroup, delayGroup, firstRankInGroup = self.mp.workerPixelGroup(worldRank)
+            self.elementsThisWorkerStores = self.mp.workerWorldRankToCount[firstRankInGroup]
+            self.workerPixelGroupComm = self.mp.workersComm.Split(pixelGroup, delayGroup)
+        self.workerScatterReceiveBuffer = np.zeros(self.elementsThisWorkerStores,dtype=np.float32)
         self.initDelayAndGather()
-        self.userObj.workerInit(scatterCount)
+        self.userObj.workerInit(self.elementsThisWorkerStores)
+        if self.delayGroups > 1:
+            delayIndices = CommSystemUtil.delayGroupIndices(self.numDelays, self.delayGroups, delayGroup)
+            self.userObj.workerSetDelayIndices(delayIndices)
+            self.mp.logInfo("workerInit: pixel group=%d delay group=%d computes %d of %d delays" % \
+                            (pixelGroup, delayGroup, len(delayIndices), self.numDelays), allWorkers=True)
         self.elementsThisWorker = scatterCount
-        self.workerData = WorkerData(logger=self.mp.logger, 
-                                     isFirstWorker=self.mp.isFirstWorker,
-                                     numTimes=self.system_params['times'],
-                                     numDataPointsThisWorker=self.elementsThisWorker,
-                                     storeDtype=self.system_params['workerStoreDtype'],
-                                     addRemoveCallbackObject=self.userObj)
+        # what the viewer has for this workers part of the int8array, None means nothing sent yet
+        self.workerSentInt8array = None
+        if CommSystemUtil.getOptionalSystemParam(self.system_params, 'rebalanceInterval') > 0:
+            assert hasattr(self.userObj, 'workerPixelArrays') and hasattr(self.userObj, 'workerSetPixelArrays'), \
+                "rebalanceInterval > 0 but user class does not implement workerPixelArrays and workerSetPixelArrays"
+        storeDir = CommSystemUtil.getOptionalSystemParam(self.system_params, 'workerStoreDir')
+        if storeDir is not None:
+            # allows node local scratch given by an environment variable, i.e, $TMPDIR
+            storeDir = os.path.expandvars(storeDir)
+            assert os.path.isdir(storeDir), "system_params workerStoreDir=%s is not a directory" % storeDir
+        numTimes = self.workerNumTimes()
+        if self.sparse:
+            self.workerSparseReceived = None
+            self.workerData = SparseWorkerData(logger=self.mp.logger,
+                                               isFirstWorker=self.mp.isFirstWorker,
+                                               numTimes=numTimes,
+                                               numDataPointsThisWorker=self.elementsThisWorker,
+                                               addRemoveCallbackObject=self.userObj)
+        else:
+            self.workerData = WorkerData(logger=self.mp.logger, 
+                                         isFirstWorker=self.mp.isFirstWorker,
+                                         numTimes=numTimes,
+                                         numDataPointsThisWorker=self.elementsThisWorkerStores,
+                                         storeDtype=self.system_params['workerStoreDtype'],
+                                         addRemoveCallbackObject=self.userObj,
+                                         storeDir=storeDir,
+                                         layout=CommSystemUtil.getOptionalSystemParam(self.system_params, 'workerStoreLayout'),
+                                         insertBlock=CommSystemUtil.getOptionalSystemParam(self.system_params, 'workerInsertBlock'))
+        if self.timeParallel:
+            self.workerData.setTimeOwner(self.timeBlockCounters, self.mp.numWorkers,
+                                         self.mp.workerRanks.index(self.mp.rank))
+        if self.resume:
+            self.workerRestoreCheckpoint()
+        self.h5parallelFile = None
+        if self.h5parallel:
+            self.workerInitH5Parallel()
+
+    def workerNumTimes(self):
+        '''how many times the workers store. system_params['times'], or less if the user class 
+        implements workerHistoryNeeded and needs fewer. In the time parallel mode, a block and 
+        its halo, so the window is the last numWorkers*ceil(times/numWorkers) counters rather 
+        than the last times events.
+        '''
+        numTimes = self.system_params['times']
+        if self.timeParallel:
+            return min(numTimes, self.timeBlockCounters + self.timeHalo)
+        if not hasattr(self.userObj, 'workerHistoryNeeded'):
+            return numTimes
+        historyNeeded = self.userObj.workerHistoryNeeded()
+        if historyNeeded is None or historyNeeded >= numTimes:
+            return numTimes
+        assert historyNeeded > 0, "user workerHistoryNeeded returned %d, it must be > 0" % historyNeeded
+        bytesPerRow = np.dtype(self.system_params['workerStoreDtype']).itemsize
+        savedRows = numTimes - historyNeeded
+        savedWorker = savedRows * bytesPerRow * self.elementsThisWorkerStores
+        savedJob = savedRows * bytesPerRow * sum(self.mp.workerWorldRankToCount.values())
+        self.mp.logInfo("workerNumTimes: user class needs %d times, not system_params times=%d. Saves %.1f MB on this worker, %.1f MB over all workers" % \
+                        (historyNeeded, numTimes, savedWorker/float(1<<20), savedJob/float(1<<20)))
+        return historyNeeded
+
+    def workerInitH5Parallel(self):
+        '''the workers open their h5 file collectively with the MPI-IO driver, and create
+        a dataset shaped (update, delay, masked element) for each array. The viewer picks the
+        filename, as it may have %T or %C in it.
+        '''
+        h5output = self.mp.viewerWorkersComm.bcast(None, root=self.mp.viewerRankInViewerWorkersComm)
+        self.h5parallelOutput = workersH5Name(h5output)
+        self.h5parallelInprogress = self.h5parallelOutput + '.inprogress'
+        self.h5parallelFile = h5py.File(self.h5parallelInprogress, 'w', driver='mpio', comm=self.mp.workersComm)
+        self.workerCreateH5ParallelDatasets(self.h5parallelFile)
+
+    def workerCreateH5ParallelDatasets(self, h5file):
+        '''creates the system group, and the empty datasets that workerWriteH5Parallel appends to.
+        '''
+        # metadata changes are collective, all workers must create the same objects
+        self.h5parallelUpdate = 0
+        systemGroup = h5file.create_group('system')
+        systemGroup['maskedFlatIndices'] = self.mp.maskedFlatIndices
+        systemGroup['ndarrayShape'] = np.array(self.mp.maskNdarrayCoords.shape, np.int64)
+        numElements = int(self.totalMaskedElements)
+        h5file.create_dataset('counter', (0,), dtype='i8', maxshape=(None,))
+        h5file.create_dataset('delay_counts', (0,) + self.countsShape, dtype='i8', 
+                              maxshape=(None,) + self.countsShape)
+        for nm in self.arrayNames:
+            h5file.create_dataset(nm, (0, self.numDelays, numElements), dtype='f4',
+                                  maxshape=(None, self.numDelays, numElements),
+                                  chunks=(1, 1, numElements))
+
+    def workerWriteH5Parallel(self, counter, name2array, counts):
+        '''each worker writes its elements of the arrays that workerCalc returned for this update. 
+        If the user class implements workerH5Arrays, it can change what is written, i.e, normalize.
+        '''
+        t0 = time.time()
+        if hasattr(self.userObj, 'workerH5Arrays'):
+            name2array = self.userObj.workerH5Arrays(name2array, counts)
+        h5file = self.h5parallelFile
+        update = self.h5parallelUpdate
+        # resizing is collective, all the workers resize to the same number of updates
+        for dsetName in ['counter', 'delay_counts'] + self.arrayNames:
+            h5file[dsetName].resize(update + 1, axis=0)
+        self.h5parallelUpdate += 1
+        workerOffset = self.mp.workerWorldRankToOffset[self.mp.rank]
+        workerCount = self.mp.workerWorldRankToCount[self.mp.rank]
+        for nm in self.arrayNames:
+            h5file[nm][update, :, workerOffset:(workerOffset + workerCount)] = name2array[nm]
+        if self.mp.isFirstWorker:
+            h5file['counter'][update] = counter
+            h5file['delay_counts'][update] = counts
+        writeTime = time.time() - t0
+        self.workerBusyTime += writeTime
+        self.mp.logInfo('XCorrBase.workerWriteH5Parallel: wrote update %d at counter=%s, took %.4f sec' % \
+                        (update, counter, writeTime))
+
+    def shutdown_worker(self):
+        if self.h5parallelFile is not None:
+            # closing is collective
+            self.h5parallelFile.close()
+            self.h5parallelFile = None
+            if self.mp.isFirstWorker:
+                assert not os.path.exists(self.h5parallelOutput), "ERROR: h5 file %s has been created since program started. Cannot move the inprogress file: %s to replace it. Output is in the inprogress file" % \
+                    (self.h5parallelOutput, self.h5parallelInprogress)
+                shutil.move(self.h5parallelInprogress, self.h5parallelOutput)
+
+    def workerCheckpoint(self, checkpointNumber):
+        '''writes this workers checkpoint file: the stored data, and the user arrays. The elements
+        are identified by their flat ndarray index, so that a resume can divide them differently.
+        '''
+        t0 = time.time()
+        workerIdx = self.mp.workerRanks.index(self.mp.rank)
+        checkpointFile = checkpointWorkerName(self.checkpoint, workerIdx, checkpointNumber % 2)
+        inprogress = checkpointFile + '.inprogress'
+        workerOffset = self.mp.workerWorldRankToOffset[self.mp.rank]
+        times, Xrows = self.workerData.storedTimesAndData()
+        h5file = h5py.File(inprogress, 'w')
+        h5file.attrs['checkpointNumber'] = checkpointNumber
+        h5file['maskedFlatIndices'] = self.mp.maskedFlatIndices[workerOffset:(workerOffset + self.elementsThisWorker)]
+        h5file['times'] = times
+        h5file['X'] = Xrows
+        for groupName, name2array in [('pixel', self.userObj.workerPixelArrays()),
+                                      ('other', self.userObj.workerCheckpointArrays())]:
+            h5Group = h5file.create_group(groupName)
+            for nm, array in name2array.items():
+                h5Group[nm] = array
+        h5file.close()
+        shutil.move(inprogress, checkpointFile)
+        self.mp.logInfo('XCorrBase.workerCheckpoint: wrote checkpoint %d with %d times, took %.4f sec' % \
+                        (checkpointNumber, len(times), time.time()-t0))
+
+    def workerRestoreCheckpoint(self):
+        '''reads the stored data and user arrays for the elements of this worker from the checkpoint
+        files of all the workers that wrote the checkpoint. There may have been a different number of them.
+        '''
+        t0 = time.time()
+        state = readCheckpointMaster(self.checkpoint)
+        checkpointNumber = int(state['checkpointNumber'])
+        assert int(state['times']) == self.system_params['times'], \
+            "checkpoint was written with system_params times=%d, but it is %d now" % (int(state['times']), self.system_params['times'])
+        workerOffset = self.mp.workerWorldRankToOffset[self.mp.rank]
+        workerFlatIndices = self.mp.maskedFlatIndices[workerOffset:(workerOffset + self.elementsThisWorker)]
+        times = None
+        Xrows = None
+        name2pixelArray = {}
+        name2otherArray = {}
+        numRestored = 0
+        for checkpointWorker in range(int(state['numWorkers'])):
+            checkpointFile = checkpointWorkerName(self.checkpoint, checkpointWorker, checkpointNumber % 2)
+            assert os.path.exists(checkpointFile), "checkpoint file %s does not exist" % checkpointFile
+            h5file = h5py.File(checkpointFile, 'r')
+            assert h5file.attrs['checkpointNumber'] == checkpointNumber, \
+                "checkpoint file %s is for checkpoint %d, not %d" % (checkpointFile, h5file.attrs['checkpointNumber'], checkpointNumber)
+            if times is None:
+                times = h5file['times'][:]
+                Xrows = np.zeros((len(times), self.elementsThisWorker), self.workerData.X.dtype)
+                for nm, dset in h5file['pixel'].items():
+                    name2pixelArray[nm] = np.zeros(dset.shape[0:-1] + (self.elementsThisWorker,), dset.dtype)
+                for nm, dset in h5file['other'].items():
+                    name2otherArray[nm] = dset[()]
+            else:
+                assert np.all(h5file['times'][:] == times), "checkpoint file %s has different times than the first worker" % checkpointFile
+            selected, positions = checkpointElementsForWorker(workerFlatIndices, h5file['maskedFlatIndices'][:])
+            if len(positions) > 0:
+                Xrows[:, positions] = h5file['X'][:][:, selected]
+                for nm, dset in h5file['pixel'].items():
+                    name2pixelArray[nm][..., positions] = dset[:][..., selected]
+                numRestored += len(positions)
+            h5file.close()
+        assert numRestored == self.elementsThisWorker, \
+            "only found %d of the %d elements of this worker in the checkpoint, was the mask changed?" % \
+            (numRestored, self.elementsThisWorker)
+        self.workerData.restoreData(times, Xrows)
+        self.userObj.workerSetPixelArrays(name2pixelArray, self.elementsThisWorker)
+        self.userObj.workerSetCheckpointArrays(name2otherArray)
+        self.mp.logInfo('XCorrBase.workerRestoreCheckpoint: restored checkpoint %d with %d times, took %.4f sec' % \
+                        (checkpointNumber, len(times), time.time()-t0))
 
     def viewerInit(self):
         self.initDelayAndGather()
 
-        self.gatheredFlatNDArrays = dict((name,np.zeros(self.numDelays*self.totalMaskedElements, np.float32)) \
+        self.gatheredFlatNDArrays = dict((name,np.zeros(self.numGatherDelays*self.totalMaskedElements, np.float32)) \
                                          for name in self.arrayNames)
 
         gatheredMsgParts =['gathered_%s.shape=%s' % (nm, self.gatheredFlatNDArrays[nm].shape) \
                            for nm in self.arrayNames]
         gatheredMsg = ' '.join(gatheredMsgParts)
-        self.logger.debug('XCorrBase.viewerInit: numDelays=%d totalMaskedElements=%d (includes masked out) %s (masked in only)' % \
-                         (self.numDelays, self.totalMaskedElements, gatheredMsg))
+        self.logger.debug('XCorrBase.viewerInit: numDelays=%d numGatherDelays=%d totalMaskedElements=%d (includes masked out) %s (masked in only)' % \
+                         (self.numDelays, self.numGatherDelays, self.totalMaskedElements, gatheredMsg))
         
         for nm in self.arrayNames:
-            assert len(self.gatheredFlatNDArrays[nm]) == sum(self.gatherAllDelayCounts), "gathered_%s length != expected" % nm
+            assert len(self.gatheredFlatNDArrays[nm]) == self.numGatherDelays * sum(self.gatherOneNDArrayCounts), "gathered_%s length != expected" % nm
 
         self.gatheredInt8array = np.zeros(self.totalMaskedElements, np.int8)
         assert len(self.gatheredInt8array) == sum(self.gatherOneNDArrayCounts), "gathered_int8array len != expected"
 
+        # ndarrays passed to the user are formed in these buffers
+        ndarrayShape = self.mp.maskNdarrayCoords.shape
+        self.viewerNDarrays = dict((name, np.zeros((self.numGatherDelays,) + ndarrayShape, np.float32)) \
+                                   for name in self.arrayNames)
+        self.viewerInt8ndarray = np.zeros(ndarrayShape, np.int8)
+        self.viewerDelayViews = {}
+
+        self.viewerInitH5Output()
+        self.userObj.viewerInit(self.mp.maskNdarrayCoords, self.h5GroupUser)
+
+    def viewerInitH5Output(self):
+        '''opens the h5output file, if there is one, and writes the configuration to it. When
+        system_params['numViewers'] > 1, the helper viewers open their own file.
+        '''
         self.h5output = None
+        self.h5writer = None
         if self.system_params['h5output'] is not None:
-            self.h5output = corAna.formatFileName(self.system_params['h5output'])
+            if self.mp.isViewer:
+                self.h5output = corAna.formatFileName(self.system_params['h5output'])
+            if self.numViewers > 1:
+                # the helper viewers write their delays to their own file, named after the first viewers file
+                self.h5output = self.mp.viewersComm.bcast(self.h5output, root=0)
+                if self.mp.isHelperViewer:
+                    self.h5output = viewerH5Name(self.h5output, self.mp.viewerIndex)
             self.h5inprogress = self.h5output + '.inprogress'
             if os.path.exists(self.h5output):
                 if self.system_params['overwrite']:
@@ -296,19 +843,59 @@ class XCorrBase(object):
                     raise Exception("h5output file %s specified but that file exists. Set params overwrite to True to overwrite it." % self.h5output)
             if os.path.exists(self.h5inprogress):
                 raise Exception("inprogress file for given h5output: %s exists. System will not overwrite even with --overwrite. Delete file before running" % self.h5inprogress)
+            if self.h5parallel and self.mp.isViewer:
+                self.viewerInitH5Parallel()
             self.h5file = h5py.File(self.h5inprogress,'w')
-            self.h5GroupFramework = writeConfig(self.h5file,
-                                                self.system_params,
-                                                self.user_params)
+            # the first viewer writes the configuration, and the merged results
+            self.h5GroupFramework = None
+            if self.mp.isViewer:
+                self.h5GroupFramework = writeConfig(self.h5file,
+                                                    self.system_params,
+                                                    self.user_params)
             self.h5GroupUser = self.h5file.create_group('user')
+            h5writerQueue = CommSystemUtil.getOptionalSystemParam(self.system_params, 'h5writerQueue')
+            if h5writerQueue > 0:
+                assert hasattr(self.userObj, 'viewerSetH5Writer'), "system_params h5writerQueue > 0 but user class does not implement viewerSetH5Writer"
+                self.h5writer = H5Writer(h5writerQueue)
+                self.userObj.viewerSetH5Writer(self.h5writer)
+            if self.mp.isViewer and (self.mp.pixelsInLabelOrder or self.h5parallel or \
+               CommSystemUtil.getOptionalSystemParam(self.system_params, 'h5maskedFlat')):
+                # lets readers of the file go from the worker order of the masked elements to the ndarray
+                self.h5file['system']['maskedFlatIndices'] = self.mp.maskedFlatIndices
+            if self.h5parallel and self.mp.isViewer:
+                # the file the workers write, relative to the directory of this file
+                self.h5file['workers'] = h5py.ExternalLink(os.path.basename(workersH5Name(self.h5output)), '/')
+            if self.mp.isViewer:
+                for viewerIndex in range(1, self.numViewers):
+                    self.h5file['viewer%d' % viewerIndex] = h5py.ExternalLink(os.path.basename(viewerH5Name(self.h5output, viewerIndex)), '/')
         else:
             self.h5file = None
             self.h5GroupFramework = None
             self.h5GroupUser = None
 
-        self.userObj.viewerInit(self.mp.maskNdarrayCoords, self.h5GroupUser)
+    def viewerInitH5Parallel(self):
+        '''checks that the workers h5 file can be written, and tells the workers the h5output filename.
+        '''
+        workersOutput = workersH5Name(self.h5output)
+        workersInprogress = workersOutput + '.inprogress'
+        if os.path.exists(workersInprogress):
+            raise Exception("inprogress file for the workers h5 file: %s exists. Delete file before running" % workersInprogress)
+        if os.path.exists(workersOutput):
+            if self.system_params['overwrite']:
+                os.unlink(workersOutput)
+                self.mp.logInfo("overwrite=True, removed file=%s" % workersOutput)
+            else:
+                raise Exception("workers h5 file %s exists. Set params overwrite to True to overwrite it." % workersOutput)
+        self.mp.viewerWorkersComm.bcast(self.h5output, root=self.mp.viewerRankInViewerWorkersComm)
 
     def shutdown_viewer(self):
+        if hasattr(self.userObj, 'viewerShutdown'):
+            self.userObj.viewerShutdown()
+        if self.h5writer is not None:
+            # the queued writes must be in the file before it is closed and renamed
+            t0 = time.time()
+            self.h5writer.close()
+            self.logger.info("XCorrBase.shutdown_viewer: waited %.3f sec for the h5 writer thread to finish" % (time.time()-t0))
         if self.h5file is not None:
             del self.h5GroupUser
             del self.h5GroupFramework
@@ -320,8 +907,73 @@ class XCorrBase(object):
 
     def storeNewWorkerData(self, counter):
         assert self.mp.isWorker, "storeNewWorkerData called for non-worker"
-        self.workerData.addData(counter, 
-                                self.workerScatterReceiveBuffer)
+        t0 = time.time()
+        if self.sparse:
+            self.workerData.addData(counter, self.workerSparseReceived)
+        else:
+            self.workerData.addData(counter, 
+                                    self.workerScatterReceiveBuffer)
+        self.workerBusyTime += time.time() - t0
+
+    def workerBusyTimeSinceLastCheck(self):
+        '''returns seconds this worker spent storing data and in workerCalc since the last call
+        '''
+        busyTime = self.workerBusyTime
+        self.workerBusyTime = 0.0
+        return busyTime
+
+    def exchangePixelColumns(self, array, sendCounts, sendOffsets, recvCounts, recvOffsets):
+        '''exchanges pixels with the other workers. The last dimension of array is the pixels
+        for this worker. Counts and offsets are in pixels. Returns the new array.
+        '''
+        otherShape = array.shape[0:-1]
+        numRows = int(np.prod(otherShape))
+        pixelMajor = np.ascontiguousarray(array.reshape(numRows, array.shape[-1]).T)
+        newCount = sum(recvCounts)
+        received = np.empty((newCount, numRows), dtype=array.dtype)
+        # one MPI element per pixel keeps the counts small for long time histories
+        pixelType = MPI.BYTE.Create_contiguous(max(1, numRows * array.dtype.itemsize)).Commit()
+        self.mp.workersComm.Alltoallv([pixelMajor, (sendCounts, sendOffsets), pixelType],
+                                      [received, (recvCounts, recvOffsets), pixelType])
+        pixelType.Free()
+        return np.ascontiguousarray(received.T).reshape(otherShape + (newCount,))
+
+    def workerRepartition(self, workerCounts):
+        '''called on all workers when the master changes how many pixels each worker has.
+        Moves the stored data, and the user pixel arrays, between neighboring workers.
+        '''
+        assert self.mp.isWorker, "workerRepartition called for non-worker"
+        self.workerFinishAsyncGather()
+        t0 = time.time()
+        oldCounts = self.mp.workerCounts()
+        newCounts = [int(count) for count in workerCounts]
+        workerIdx = self.mp.workerRanks.index(self.mp.rank)
+        countsOffsets = CommSystemUtil.migrationCountsOffsets(oldCounts, newCounts, workerIdx)
+
+        self.workerData.flush()
+        self.workerData.setPixelData(self.exchangePixelColumns(self.workerData.X, *countsOffsets))
+        name2array = self.userObj.workerPixelArrays()
+        newName2array = {}
+        # all workers must exchange the arrays in the same order
+        for nm in sorted(name2array.keys()):
+            newName2array[nm] = self.exchangePixelColumns(name2array[nm], *countsOffsets)
+
+        self.mp.setWorkerCounts(newCounts)
+        self.elementsThisWorker = newCounts[workerIdx]
+        self.workerScatterReceiveBuffer = np.zeros(self.elementsThisWorker, dtype=np.float32)
+        self.initDelayAndGather()
+        self.workerSentInt8array = None
+        self.userObj.workerSetPixelArrays(newName2array, self.elementsThisWorker)
+        self.mp.logInfo('XCorrBase.workerRepartition: worker pixel counts %s -> %s, took %.4f sec' % \
+                        (oldCounts, newCounts, time.time()-t0))
+
+    def viewerRepartition(self, workerCounts):
+        '''called on the viewers when the master changes how many pixels each worker has.
+        '''
+        assert self.isAnyViewer, "viewerRepartition called for non-viewer"
+        self.viewerInformHelpers(('REBALANCE', workerCounts))
+        self.mp.setWorkerCounts([int(count) for count in workerCounts])
+        self.initDelayAndGather()
 
     def checkUserWorkerCalcArgs(self, name2array, counts, int8array):
         assert set(name2array.keys())==set(self.arrayNames), \
@@ -332,15 +984,296 @@ class XCorrBase(object):
                                  (nm, array.shape, (self.elementsThisWorker,))
             assert array.dtype == np.float32, "workerCalc array=%s does not have type np.float32, it is %r" % array.dtype
         assert counts.dtype == np.int64, "user workerCalc counts array does not have dtype=np.int64"
-        assert counts.shape == (self.numDelays,), "user workerCalc counts array shape=%s != (%d,)" % \
-            (counts.shape, (self.numDelays,))
+        assert counts.shape == self.countsShape, "user workerCalc counts array shape=%s != %s" % \
+            (counts.shape, self.countsShape)
         assert int8array.dtype == np.int8, "user workerCalc int8array does not have dtype=np.int8"
         assert int8array.shape == (self.elementsThisWorker,), "user workerCalc int8array counts array shape=%s != (%d,)" % \
             (int8array.shape, (self.elementsThisWorker,))
         
-    def viewerWorkersUpdate(self, lastTime):
+    def reducedFullUpdate(self):
+        '''returns True if the UPDATE message from the master means a reduced update.
+        When there are separate full updates, UPDATE always means the per pixel arrays are 
+        gathered and LIGHT_UPDATE means a reduced update.
+        '''
+        return self.workerReduce and (self.fullUpdate == 0)
+
+    def workerReduceTimeParallel(self, name2array, counts, int8array):
+        '''time parallel mode: workerCalc returned sums over this workers times, for all the masked
+        elements. Sums them over the workers, and returns the part of the elements this worker 
+        gathers to the viewer, like the usual decomposition by elements.
+        '''
+        workerCounts = self.mp.workerCounts()
+        reducedName2array = {}
+        for nm in self.arrayNames:
+            array = name2array[nm]
+            assert array.dtype == np.float32, "workerCalc array=%s does not have type np.float32, it is %r" % (nm, array.dtype)
+            numRows = array.shape[0]
+            # element major, so each workers part is contiguous
+            elementMajor = np.ascontiguousarray(array.T)
+            part = np.empty((self.elementsThisWorker, numRows), np.float32)
+            self.mp.workersComm.Reduce_scatter([elementMajor, MPI.FLOAT], [part, MPI.FLOAT],
+                                               recvcounts=[count * numRows for count in workerCounts], op=MPI.SUM)
+            reducedName2array[nm] = np.ascontiguousarray(part.T)
+        reducedCounts = np.zeros_like(counts)
+        self.mp.workersComm.Allreduce([counts, MPI.INT64_T], [reducedCounts, MPI.INT64_T], op=MPI.SUM)
+        reducedInt8array = np.empty(self.elementsThisWorker, np.int8)
+        self.mp.workersComm.Reduce_scatter([np.ascontiguousarray(int8array), MPI.INT8_T], [reducedInt8array, MPI.INT8_T],
+                                           recvcounts=workerCounts, op=MPI.MAX)
+        return reducedName2array, reducedCounts, reducedInt8array
+
+    def workerReduceDelayGroups(self, name2array, counts, int8array):
+        '''system_params['delayGroups'] > 1: workerCalc returned results for the delays of this 
+        worker, for all the pixels of its pixel group. Sums them onto the first worker of the pixel 
+        group, which gathers them to the viewer. The other workers return arrays with no elements.
+        '''
+        comm = self.workerPixelGroupComm
+        isFirstInGroup = comm.Get_rank() == 0
+        reducedName2array = {}
+        for nm in self.arrayNames:
+            array = np.ascontiguousarray(name2array[nm])
+            assert array.dtype == np.float32, "workerCalc array=%s does not have type np.float32, it is %r" % (nm, array.dtype)
+            if isFirstInGroup:
+                reduced = np.empty_like(array)
+                comm.Reduce([array, MPI.FLOAT], [reduced, MPI.FLOAT], op=MPI.SUM, root=0)
+            else:
+                comm.Reduce([array, MPI.FLOAT], None, op=MPI.SUM, root=0)
+                reduced = np.zeros((array.shape[0], 0), np.float32)
+            reducedName2array[nm] = reduced
+        # each delay is computed by one worker in the group, the sum gives the counts
+        reducedCounts = np.zeros_like(counts)
+        comm.Allreduce([counts, MPI.INT64_T], [reducedCounts, MPI.INT64_T], op=MPI.SUM)
+        int8array = np.ascontiguousarray(int8array)
+        if isFirstInGroup:
+            reducedInt8array = np.empty_like(int8array)
+            comm.Reduce([int8array, MPI.INT8_T], [reducedInt8array, MPI.INT8_T], op=MPI.MAX, root=0)
+        else:
+            comm.Reduce([int8array, MPI.INT8_T], None, op=MPI.MAX, root=0)
+            reducedInt8array = np.zeros(0, np.int8)
+        return reducedName2array, reducedCounts, reducedInt8array
+
+    def workersAllreduce(self, array):
+        '''sums a float64 array over all the workers. Passed to the user workerReduce callback.
+        '''
+        assert self.mp.isWorker, "workersAllreduce called for non-worker"
+        assert array.dtype == np.float64, "workersAllreduce: array must have dtype=np.float64, it is %r" % array.dtype
+        sendBuffer = np.ascontiguousarray(array)
+        receiveBuffer = np.empty_like(sendBuffer)
+        self.mp.workersComm.Allreduce([sendBuffer, MPI.DOUBLE], [receiveBuffer, MPI.DOUBLE], op=MPI.SUM)
+        return receiveBuffer
+
+    def checkUserWorkerReduceArgs(self, name2reduced):
+        for nm, array in name2reduced.items():
+            assert array.dtype == np.float64, "workerReduce array=%s does not have dtype np.float64, it is %r" % (nm, array.dtype)
+
+    def viewerWorkersReduce(self, name2reduced):
+        '''sums the reduced arrays of all the workers at the viewer. Only the first worker
+        tells the viewer the names and shapes of the arrays, they must be the same on all workers.
+
+        Returns the summed arrays on the viewer, None on the workers.
+        '''
+        if self.mp.isFirstWorker:
+            name2shape = dict([(nm, array.shape) for nm, array in name2reduced.items()])
+            self.mp.viewerWorkersComm.send(name2shape, dest=self.mp.viewerRankInViewerWorkersComm)
+        elif self.mp.isViewer:
+            name2shape = self.mp.viewerWorkersComm.recv(source=self.mp.firstWorkerRankInViewerWorkersComm)
+            name2reduced = dict([(nm, np.zeros(shape, np.float64)) for nm, shape in name2shape.items()])
+
+        # all ranks must reduce the arrays in the same order
+        name2summed = {}
+        for nm in sorted(name2reduced.keys()):
+            sendBuffer = np.ascontiguousarray(name2reduced[nm])
+            if self.mp.isViewer:
+                name2summed[nm] = np.zeros(sendBuffer.shape, np.float64)
+                receiveBuffer = [name2summed[nm], MPI.DOUBLE]
+            else:
+                receiveBuffer = None
+            self.mp.viewerWorkersComm.Reduce([sendBuffer, MPI.DOUBLE], receiveBuffer,
+                                             op=MPI.SUM, root=self.mp.viewerRankInViewerWorkersComm)
+        if self.mp.isViewer:
+            return name2summed
+        return None
+
+    def workerProgressAsyncGather(self):
+        '''called by workers between events. Lets MPI progress the gather of the last snapshot.
+        '''
+        if len(self.asyncRequests) > 0 and MPI.Request.Testall(self.asyncRequests):
+            self.asyncRequests = []
+
+    def workerFinishAsyncGather(self):
+        '''waits for the gather of the last snapshot to the viewer to finish.
+        '''
+        if len(self.asyncRequests) > 0:
+            MPI.Request.Waitall(self.asyncRequests)
+            self.asyncRequests = []
+
+    def workerSnapshot(self, name, array):
+        '''copies array into a buffer kept for asynchronous gathers
+        '''
+        snapshot = self.asyncSnapshot.get(name, None)
+        if (snapshot is None) or (snapshot.shape != array.shape) or (snapshot.dtype != array.dtype):
+            snapshot = np.empty_like(array)
+            self.asyncSnapshot[name] = snapshot
+        snapshot[:] = array
+        return snapshot
+
+    def workerStartAsyncGather(self, name2array, counts, int8array):
+        '''snapshots the worker results and starts non-blocking sends of them to the viewer.
+        The worker goes back to storing data while the gather progresses.
+        '''
+        self.workerFinishAsyncGather()
+        viewerRank = self.mp.viewerRankInViewerWorkersComm
+        if self.mp.isFirstWorker:
+            countsSnapshot = self.workerSnapshot('counts', counts)
+            self.asyncRequests.append(self.mp.viewerWorkersComm.Isend([countsSnapshot, MPI.INT64_T], 
+                                                                      dest=viewerRank))
+        for nm in self.arrayNames:
+            snapshot = self.workerSnapshot('array_' + nm, name2array[nm])
+            self.asyncRequests.append(self.mp.viewerWorkersComm.Igatherv(sendbuf=[snapshot, MPI.FLOAT],
+                                                                         recvbuf=None, root=viewerRank))
+        int8snapshot = self.workerSnapshot('int8array', int8array)
+        self.asyncRequests.append(self.mp.viewerWorkersComm.Igatherv(sendbuf=[int8snapshot, MPI.INT8_T],
+                                                                     recvbuf=None, root=viewerRank))
+        self.workerSentInt8array = int8array.copy()
+
+    def viewerAsyncGather(self):
+        '''receives the asynchronous gather started by workerStartAsyncGather. Returns counts.
+        '''
+        counts = np.zeros(self.countsShape, np.int64)
+        self.mp.viewerWorkersComm.Recv([counts, MPI.INT64_T],
+                                       source = self.mp.firstWorkerRankInViewerWorkersComm)
+        requests = []
+        floatSendBuffer = np.zeros(0, np.float32)
+        for nm in self.arrayNames:
+            requests.append(self.mp.viewerWorkersComm.Igatherv(sendbuf=[floatSendBuffer, MPI.FLOAT],
+                                                               recvbuf=[self.gatheredFlatNDArrays[nm],
+                                                                        (self.gatherAllDelayCounts,
+                                                                         self.gatherAllDelayOffsets),
+                                                                        MPI.FLOAT],
+                                                               root = self.mp.viewerRankInViewerWorkersComm))
+        int8SendBuffer = np.zeros(0, np.int8)
+        requests.append(self.mp.viewerWorkersComm.Igatherv(sendbuf=[int8SendBuffer, MPI.INT8_T],
+                                                           recvbuf=[self.gatheredInt8array,
+                                                                    (self.gatherOneNDArrayCounts,
+                                                                     self.gatherOneNDArrayOffsets),
+                                                                    MPI.INT8_T],
+                                                           root = self.mp.viewerRankInViewerWorkersComm))
+        MPI.Request.Waitall(requests)
+        return counts
+
+    def viewerWorkersGatherDelayBlocks(self, lastTime, counts, name2array, int8array):
+        '''gathers the results at the viewer a block of delays at a time, and has the viewer
+        publish each block before gathering the next. This bounds the memory the viewer uses
+        for the gather by the block size. On the workers name2array and int8array are what 
+        workerCalc returned, they are not used on the viewer.
+
+        When there are several viewers, each gathers and publishes its own range of delays, 
+        and the first viewer merges the viewerDelayResults of all of them before viewerPublishEnd.
+        '''
+        # the int8array first, the viewer gets it in viewerPublishStart
+        int8changed = self.viewerWorkersGatherInt8Changes(int8array)
+        if self.mp.isViewer:
+            self.viewerInformHelpers(('UPDATE', lastTime, counts, int8changed, self.gatheredInt8array[int8changed]))
+            self.viewerGatherAndPublishDelays(lastTime, counts, int8changed)
+            if self.numViewers > 1:
+                self.viewersMergeDelayResults()
+            self.userObj.viewerPublishEnd(counts, lastTime, self.h5GroupUser)
+        else:
+            self.workerSendDelayBlocks(name2array)
+
+    def helperViewerUpdate(self, lastTime, counts, int8changed, int8values):
+        '''called on the helper viewers for an update, with what the first viewer received
+        from the workers for the counts and the int8array. Gathers and publishes this viewers delays.
+        '''
+        assert self.mp.isHelperViewer, "helperViewerUpdate called for non helper viewer"
+        self.gatheredInt8array[int8changed] = int8values
+        self.viewerGatherAndPublishDelays(lastTime, counts, int8changed)
+        self.viewersMergeDelayResults()
+
+    def viewerGatherAndPublishDelays(self, lastTime, counts, int8changed):
+        '''called on each viewer. Gathers the blocks of delays for this viewer from the workers, 
+        calling the user viewerPublishDelays for each block.
+        '''
+        viewerIndex = self.mp.viewerIndex
+        comm = self.mp.viewerWorkersComms[viewerIndex]
+        root = self.mp.viewerRanksInViewerWorkersComms[viewerIndex]
+        gatherOneNDArrayCounts, gatherOneNDArrayOffsets = self.viewerGatherCountsOffsets[viewerIndex]
+
+        int8ndarray = self.viewerFormInt8ndarray(int8changed)
+        self.userObj.viewerPublishStart(counts, lastTime, int8ndarray, self.h5GroupUser)
+
+        for blockStart, blockEnd in self.viewerDelayBlocks[viewerIndex]:
+            numBlockDelays = blockEnd - blockStart
+            blockCounts = tuple([count * numBlockDelays for count in gatherOneNDArrayCounts])
+            blockOffsets = tuple([offset * numBlockDelays for offset in gatherOneNDArrayOffsets])
+            for nm in self.arrayNames:
+                receiveBuffer = self.gatheredFlatNDArrays[nm][0:numBlockDelays * self.totalMaskedElements]
+                comm.Gatherv(sendbuf=[np.zeros(0, np.float32), MPI.FLOAT],
+                             recvbuf=[receiveBuffer, (blockCounts, blockOffsets), MPI.FLOAT],
+                             root = root)
+            name2delay2ndarray = self.viewerFormDelayNDarrays(counts, blockStart, blockEnd)
+            self.userObj.viewerPublishDelays(counts, lastTime, list(range(blockStart, blockEnd)),
+                                             name2delay2ndarray, self.h5GroupUser)
+
+    def workerSendDelayBlocks(self, name2array):
+        '''called on the workers, sends the blocks of delays to the viewers that gather them.
+        The workers go through the viewers for each block, so that the viewers publish in parallel.
+        '''
+        maxViewerBlocks = max([len(blocks) for blocks in self.viewerDelayBlocks])
+        for blockIdx in range(maxViewerBlocks):
+            for viewerIndex, blocks in enumerate(self.viewerDelayBlocks):
+                if blockIdx >= len(blocks):
+                    continue
+                blockStart, blockEnd = blocks[blockIdx]
+                comm = self.mp.viewerWorkersComms[viewerIndex]
+                root = self.mp.viewerRanksInViewerWorkersComms[viewerIndex]
+                for nm in self.arrayNames:
+                    # rows of a C ordered array are contiguous
+                    sendBuffer = name2array[nm][blockStart:blockEnd,:]
+                    comm.Gatherv(sendbuf=[sendBuffer, MPI.FLOAT], recvbuf=None, root = root)
+
+    def viewerInformHelpers(self, msg):
+        '''called on the first viewer to pass a message on to the helper viewers, if there are any.
+        A message is a tuple, the first item is 'UPDATE', 'REBALANCE' or 'END'.
+        '''
+        if self.mp.isViewer and self.numViewers > 1:
+            # the first viewer is rank 0 in viewersComm
+            self.mp.viewersComm.bcast(msg, root=0)
+
+    def viewersMergeDelayResults(self):
+        '''sums the arrays from the user viewerDelayResults callback over all the viewers, and 
+        passes them to viewerMergeDelayResults on the first viewer.
+        '''
+        name2results = self.userObj.viewerDelayResults()
+        name2summed = {}
+        # all viewers must reduce the arrays in the same order
+        for nm in sorted(name2results.keys()):
+            sendBuffer = np.ascontiguousarray(name2results[nm])
+            assert sendBuffer.dtype == np.float64, "viewerDelayResults array=%s does not have dtype np.float64, it is %r" % (nm, sendBuffer.dtype)
+            if self.mp.isViewer:
+                name2summed[nm] = np.zeros(sendBuffer.shape, np.float64)
+                receiveBuffer = [name2summed[nm], MPI.DOUBLE]
+            else:
+                receiveBuffer = None
+            self.mp.viewersComm.Reduce([sendBuffer, MPI.DOUBLE], receiveBuffer, op=MPI.SUM, root=0)
+        if self.mp.isViewer:
+            self.userObj.viewerMergeDelayResults(name2summed)
+
+    def viewerWorkersUpdate(self, lastTime, reduced=None):
+        '''workers calculate results and send them to the viewer, which publishes them.
+
+        Args:
+          lastTime (dict): the last event scattered to the workers
+          reduced (bool): if True, workers reduce their results with the user workerReduce callback
+                          and only the sums of the reduced arrays are sent to the viewer. If False, 
+                          all the per pixel arrays are gathered. Defaults to system_params['workerReduce']
+        '''
         assert self.mp.isWorker or self.mp.isViewer, "can only call this function if viewer or worker"
+        if reduced is None:
+            reduced = self.workerReduce
         counter = lastTime['counter']
+        asyncGather = self.asyncUpdate and not reduced
+        if self.mp.isWorker and not asyncGather:
+            self.workerFinishAsyncGather()
         # send the delay counts calculated thus far from one worker to the viewer.
         # The delay counts are the same across all the workers.
 
@@ -348,8 +1281,13 @@ class XCorrBase(object):
         if self.mp.isWorker:
             ## calculate:
             t0 = time.time()
+            self.workerData.flush()
             name2array, counts, int8array = self.userObj.workerCalc(self.workerData)
-            if self.mp.logger.isEnabledFor(logging.DEBUG):
+            if self.timeParallel:
+                name2array, counts, int8array = self.workerReduceTimeParallel(name2array, counts, int8array)
+            elif self.delayGroups > 1:
+                name2array, counts, int8array = self.workerReduceDelayGroups(name2array, counts, int8array)
+            if self.mp.logger.isEnabledFor(logging.DEBUG) and self.elementsThisWorker > 0:
                 for nm in self.arrayNames:
                     for delayIdx, delay in enumerate(self.delays):
                         self.mp.logDebug("lastTime=%s dly=%d nm=%s min=%.1f avg=%.1f max=%.1f" % \
@@ -357,9 +1295,32 @@ class XCorrBase(object):
                                          np.average(name2array[nm][delayIdx,:]),
                                          np.max(name2array[nm][delayIdx,:])), allWorkers = True)
             calcTime = time.time() - t0
+            self.workerBusyTime += calcTime
             self.checkUserWorkerCalcArgs(name2array, counts, int8array)
             self.mp.logInfo('g2worker.calc at 120hz counter=%s took %.4f sec' % \
                             (counter, calcTime))
+            if self.h5parallelFile is not None:
+                self.workerWriteH5Parallel(counter, name2array, counts)
+            if reduced:
+                t0 = time.time()
+                name2reduced = self.userObj.workerReduce(name2array, counts, int8array, self.workersAllreduce)
+                self.workerBusyTime += time.time() - t0
+                self.checkUserWorkerReduceArgs(name2reduced)
+            elif asyncGather:
+                self.workerStartAsyncGather(name2array, counts, int8array)
+                return
+        else:
+            name2array, int8array, name2reduced = None, None, None
+
+        if asyncGather:
+            t0 = time.time()
+            counts = self.viewerAsyncGather()
+            self.logger.info("XCorrBase.viewerWorkersUpdate: viewer asynchronous gather took: %.3f sec" % (time.time()-t0))
+            name2delay2ndarray, int8ndarray = self.viewerFormNDarrays(counts, counter)
+            self.userObj.viewerPublish(counts, lastTime, name2delay2ndarray, 
+                                       int8ndarray, self.h5GroupUser)
+            return
+
         ### begin point to point
         t0 = time.time()
         ## any data the viewer needs that is the same between the workers, send point to point to 
@@ -374,7 +1335,7 @@ class XCorrBase(object):
                                             MPI.INT64_T],
                                            dest = self.mp.viewerRankInViewerWorkersComm)
         elif self.mp.isViewer:
-            counts = np.zeros(self.numDelays, np.int64)
+            counts = np.zeros(self.countsShape, np.int64)
             self.mp.viewerWorkersComm.Recv([counts,
                                             MPI.INT64_T],
                                            source = self.mp.firstWorkerRankInViewerWorkersComm)
@@ -383,6 +1344,20 @@ class XCorrBase(object):
             self.logger.debug('XCorrBase.viewerWorkersUpdate: after point to point Send/Recv for delayCounts from first worker -> viewer and Barrier. counter=%r' % counter)
         #### end point to point
 
+        if (not reduced) and ((self.viewerDelayBlock > 0) or (self.numViewers > 1)):
+            self.viewerWorkersGatherDelayBlocks(lastTime, counts, name2array, int8array)
+            if self.isViewerOrFirstWorker:
+                self.logger.info("XCorrBase.viewerWorkersUpdate: viewer worker gather and publish by delay blocks took: %.3f sec" % (time.time()-t0))
+            return
+
+        if reduced:
+            name2summed = self.viewerWorkersReduce(name2reduced)
+            if self.isViewerOrFirstWorker:
+                self.logger.info("XCorrBase.viewerWorkersUpdate: viewer worker reduce communication took: %.3f sec" % (time.time()-t0))
+            if self.mp.isViewer:
+                self.userObj.viewerPublishReduced(counts, lastTime, name2summed, self.h5GroupUser)
+            return
+
         ### now gather up the results
         if self.isViewerOrFirstWorker: 
             self.logger.debug('XCorrBase.viewerWorkersUpdate: before Gatherv between workers and viewer of results. counter=%r' % counter)
@@ -402,17 +1377,10 @@ class XCorrBase(object):
                 self.mp.viewerWorkersComm.Barrier()
                 self.logger.debug('XCorrBase.viewerWorkersUpdate: after Gatherv and Barrier for %s' % nm)
 
-            # use different counts for the int8array:
-            self.logger.debug('XCorrBase.viewerWorkersUpdate: before Gatherv for gathered int8array: sendbuf.shape=%r sendbuf.dtype=%r recvbuf.shape=%r recvbuf.dtype=%r gatherOneCounts=%r gatherOneOffsets=%r' % \
-                              (sendBuffer.shape, sendBuffer.dtype, self.gatheredInt8array.shape, self.gatheredInt8array.dtype, self.gatherOneNDArrayCounts, self.gatherOneNDArrayOffsets))
-            self.mp.viewerWorkersComm.Gatherv(sendbuf=[sendBuffer, MPI.INT8_T],
-                                              recvbuf=[self.gatheredInt8array,
-                                                       (self.gatherOneNDArrayCounts,
-                                                        self.gatherOneNDArrayOffsets),
-                                                       MPI.INT8_T],
-                                              root = self.mp.viewerRankInViewerWorkersComm)
+            # only the int8array elements that changed since the last update are sent
+            int8changed = self.viewerWorkersGatherInt8Changes(None)
             self.mp.viewerWorkersComm.Barrier()
-            self.logger.debug('XCorrBase.viewerWorkersUpdate: after Gatherv and Barrier for gatheredInt8array')
+            self.logger.debug('XCorrBase.viewerWorkersUpdate: after gather of %d changed int8array elements and Barrier' % len(int8changed))
 
         elif self.mp.isWorker:
             receiveBuffer = np.zeros(0,np.float32)
@@ -428,15 +1396,9 @@ class XCorrBase(object):
                 self.mp.viewerWorkersComm.Barrier()
                 if self.mp.isFirstWorker: self.logger.debug('XCorrBase.viewerWorkersUpdate: after Gatherv for %s and Barrier' % nm)
 
-            sendBuffer = int8array
-            if self.mp.isFirstWorker: self.logger.debug('XCorrBase.viewerWorkersUpdate: before Gatherv for saturated. sendbuf.shape=%r sendbuf.dtype=%r recvbuf.shape=%r recvbuf.dtype=%r' % \
-                                                        (sendBuffer.shape, sendBuffer.dtype, receiveBuffer.shape, receiveBuffer.dtype))
-            self.mp.viewerWorkersComm.Gatherv(sendbuf=[sendBuffer, MPI.INT8_T],
-                                              recvbuf=[receiveBuffer, 
-                                                       MPI.INT8_T],
-                                              root = self.mp.viewerRankInViewerWorkersComm)
+            self.viewerWorkersGatherInt8Changes(int8array)
             self.mp.viewerWorkersComm.Barrier()
-            if self.mp.isFirstWorker: self.logger.debug('XCorrBase.viewerWorkersUpdate: after Gatherv for saturated and Barrier')
+            if self.mp.isFirstWorker: self.logger.debug('XCorrBase.viewerWorkersUpdate: after gather of changed int8array elements and Barrier')
         else:
             raise Exception("viewerWorkersUpdate called but neither worker nor viewer")
 
@@ -446,58 +1408,100 @@ class XCorrBase(object):
 
         if self.mp.isViewer:
             # all results are now gathered into flat 1D arrays
-            name2delay2ndarray, int8ndarray = self.viewerFormNDarrays(counts, counter)
+            name2delay2ndarray, int8ndarray = self.viewerFormNDarrays(counts, counter, int8changed)
             
             self.userObj.viewerPublish(counts, lastTime, name2delay2ndarray, 
                                        int8ndarray, self.h5GroupUser)
             
-    def viewerFormNDarrays(self, counts, counter):
+    def viewerFormNDarrays(self, counts, counter, int8changed=None):
         t0 = time.time()
         assert self.mp.isViewer, "XCorrBase.viewerFormNDarrays: viewerFormNDarrays called, but not viewer"
-        assert len(counts) == self.numDelays, "XCorrBase.viewerFormNDarrays: len(counts)=%d != numDelays=%d" % \
-            (len(counts), self.numDelays)
-        
-        workerStartPositions = [0]
-
-        for workerRank in self.mp.workerRanks[0:-1]:
-            workerCount = self.mp.workerWorldRankToCount[workerRank]
-            lastWorkerStartPosition = workerStartPositions[-1]
-            workerStartPositions.append(lastWorkerStartPosition + workerCount * self.numDelays)
-
-        if self.logger.isEnabledFor(logging.DEBUG):
-            self.logger.info("viewerFormNDArrays: workerStartPositions=%s" % workerStartPositions)
-
-        ndarrayShape = self.mp.maskNdarrayCoords.shape  
+        assert counts.shape == self.countsShape, "XCorrBase.viewerFormNDarrays: counts shape=%s != %s" % \
+            (counts.shape, self.countsShape)
 
-        name2delay2ndarray = dict([(nm,{}) for nm in self.arrayNames])
-
-        # get all the named arrays into name2delay2ndarray
-        for delayIdx, delay in enumerate(self.delays):
-            # for each delay, fill out these flattened arrays of the masked elements
-            for nm in self.arrayNames:
-                name2delay2ndarray[nm][delay] = np.zeros(ndarrayShape, np.float32)
-                flatMaskedFromAllWorkers = np.zeros(self.totalMaskedElements, np.float32)
-
-                for workerIdx, workerRank in enumerate(self.mp.workerRanks):
-                    workerCount = self.mp.workerWorldRankToCount[workerRank]
-                    workerOffset = self.mp.workerWorldRankToOffset[workerRank]
-                    startIdx = workerStartPositions[workerIdx] + delayIdx * workerCount 
-                    endIdx = startIdx + workerCount
-                    flatMaskedThisWorker = self.gatheredFlatNDArrays[nm][startIdx:endIdx]
-                    if self.logger.isEnabledFor(logging.DEBUG) and counts[delayIdx]>0:
-                        self.logger.debug("viewerFormNDarrays dly=%d nm=%s wkr=%d wkrOff=%d wkrCnt=%d startIdx=%d endIdx=%d (numelem=%d) avg=%.0f max=%.0f" % \
-                                          (delay, nm, workerRank, workerOffset, workerCount, startIdx, endIdx, endIdx-startIdx, np.average(flatMaskedThisWorker), np.max(flatMaskedThisWorker)))
-                    flatMaskedFromAllWorkers[workerOffset:(workerOffset+workerCount)] = flatMaskedThisWorker
-
-                name2delay2ndarray[nm][delay][self.mp.maskNdarrayCoords] = flatMaskedFromAllWorkers
+        name2delay2ndarray = self.viewerFormDelayNDarrays(counts, 0, self.numDelays)
 
         # form the ndarray shaped int8 array
-        int8ndarray = np.zeros(ndarrayShape, np.int8)
-        int8ndarray[self.mp.maskNdarrayCoords] = self.gatheredInt8array
+        int8ndarray = self.viewerFormInt8ndarray(int8changed)
 
         t1 = time.time()
         self.logger.info('viewerFormNDarrays took %.3f sec' % (t1-t0,))
 
         return name2delay2ndarray, int8ndarray
 
+    def viewerFormDelayNDarrays(self, counts, blockStart, blockEnd):
+        '''forms the named ndarrays for the delays in [blockStart, blockEnd) from what
+        was gathered for those delays.
+
+        The ndarrays are views into buffers that are reused for each update and block. 
+        Elements that are masked out are always 0.
+        '''
+        numBlockDelays = blockEnd - blockStart
+        for nm in self.arrayNames:
+            flatNDarrays = self.viewerNDarrays[nm].reshape(self.numGatherDelays, -1)
+            gathered = self.gatheredFlatNDArrays[nm]
+            startIdx = 0
+            # each worker sent a (delays x workerCount) array, put all delays of a worker in at once
+            for workerCount, workerFlatIndices in self.viewerWorkerSegments:
+                endIdx = startIdx + numBlockDelays * workerCount
+                flatNDarrays[0:numBlockDelays, workerFlatIndices] = gathered[startIdx:endIdx].reshape(numBlockDelays, workerCount)
+                startIdx = endIdx
+
+        if (blockStart, blockEnd) not in self.viewerDelayViews:
+            self.viewerDelayViews[(blockStart, blockEnd)] = dict([(nm, dict([(self.delays[delayIdx], self.viewerNDarrays[nm][delayIdx - blockStart]) \
+                                                                  for delayIdx in range(blockStart, blockEnd)])) \
+                                                      for nm in self.arrayNames])
+        return self.viewerDelayViews[(blockStart, blockEnd)]
+
+    def viewerFormInt8ndarray(self, int8changed=None):
+        '''puts the gathered int8array into the ndarray shaped buffer. If int8changed is given,
+        only those positions in the gathered int8array changed since the last time.
+        '''
+        if int8changed is None:
+            np.put(self.viewerInt8ndarray, self.mp.maskedFlatIndices, self.gatheredInt8array)
+        else:
+            np.put(self.viewerInt8ndarray, self.mp.maskedFlatIndices[int8changed], self.gatheredInt8array[int8changed])
+        return self.viewerInt8ndarray
+
+    def workerInt8Changes(self, int8array):
+        '''returns the positions in the gathered int8array, and the values, of the elements of
+        int8array that changed since they were last sent to the viewer.
+        '''
+        if self.workerSentInt8array is None:
+            changed = np.arange(len(int8array))
+        else:
+            changed = np.flatnonzero(int8array != self.workerSentInt8array)
+        self.workerSentInt8array = int8array.copy()
+        workerOffset = self.mp.workerWorldRankToOffset[self.mp.rank]
+        return (changed + workerOffset).astype(np.int64), int8array[changed]
+
+    def viewerWorkersGatherInt8Changes(self, int8array):
+        '''workers send the elements of int8array that changed since the last update, the viewer
+        puts them into gatheredInt8array. For results like saturated pixels, only a few elements 
+        change between updates. On the viewer, int8array is not used, and returns the positions 
+        in gatheredInt8array that changed.
+        '''
+        comm = self.mp.viewerWorkersComm
+        root = self.mp.viewerRankInViewerWorkersComm
+        if self.mp.isViewer:
+            numChanged = np.zeros(comm.Get_size(), np.int64)
+            comm.Gather(sendbuf=[np.zeros(1, np.int64), MPI.INT64_T],
+                        recvbuf=[numChanged, MPI.INT64_T], root = root)
+            changedCounts = tuple([int(n) for n in numChanged])
+            changedOffsets = tuple([0] + list(np.cumsum(changedCounts))[0:-1])
+            positions = np.zeros(sum(changedCounts), np.int64)
+            values = np.zeros(sum(changedCounts), np.int8)
+            comm.Gatherv(sendbuf=[np.zeros(0, np.int64), MPI.INT64_T],
+                         recvbuf=[positions, (changedCounts, changedOffsets), MPI.INT64_T], root = root)
+            comm.Gatherv(sendbuf=[np.zeros(0, np.int8), MPI.INT8_T],
+                         recvbuf=[values, (changedCounts, changedOffsets), MPI.INT8_T], root = root)
+            self.gatheredInt8array[positions] = values
+            return positions
+
+        positions, values = self.workerInt8Changes(int8array)
+        comm.Gather(sendbuf=[np.array([len(positions)], np.int64), MPI.INT64_T], recvbuf=None, root = root)
+        comm.Gatherv(sendbuf=[positions, MPI.INT64_T], recvbuf=None, root = root)
+        comm.Gatherv(sendbuf=[values, MPI.INT8_T], recvbuf=None, root = root)
+        return None
+
 
@@ -122,6 +122,8 @@ For the tutorial, We will leave these alone. They specify a collection of 50,000
 events, and a set of 100 logarithmically spaced delays from 1 to 25,000. The user_class
 is where users hook in their worker code. We will be using the example class in the ParCorAna
 package - UserG2 - which does a simplified version of the G2 calculation used in XCS.
+userClass can also be a list of classes, to run several analyses on one pass of the data
+(see ParCorAna.MultiAnalysis).
 
   user_params['colorNdarrayCoords']
 
@@ -215,6 +217,14 @@ UserG2 module writes, for example:
 /user/G2_results_at_539/IP/delay_000001 Dataset {32, 185, 388}
 /user/G2_results_at_539/IP/delay_000002 Dataset {32, 185, 388}
 
+With user_params['h5layout']='appended', all updates go into one group, see appendToH5Datasets:
+
+/user/G2_results/G2 Dataset {update, delay, 32, 185, 388}
+/user/G2_results/delay_curves Dataset {update, color, delay}
+
+With system_params['h5maskedFlat']=True the G2, IF, IP datasets only have the masked in elements,
+expandMaskedFlat goes back to the ndarray shape.
+
 == Configure Framework ==
 
 Here we include more details on the configuration. Recall from the tutorial that the user writes a 
@@ -282,6 +292,8 @@ Here is a summary of the callbacks:
                           name2delay2ndarray['G2'][3] would return the ndarray for delay 3 
                           of the G2 term, gathered from all the workers.
    - int8array:           gathered from all the workers and has the ndarray shape. 
+                          Both int8array and the ndarrays in name2delay2ndarray are reused by the 
+                          framework for the next update, copy them to keep them.
    - counts:              has only been received from the first worker. It is assumed that all 
                           workers produce the same counts array.
 
@@ -304,6 +316,27 @@ Here is a summary of the callbacks:
   of the array.
 * workerAdjustTerms(self, mode, dataIdx, T, X): this allows workers to implement a 'rolling' calculation
   based on knowing when new data is added and replaces the oldest data
+* workerPixelArrays(self) and workerSetPixelArrays(self, name2array, numElementsWorker): only needed 
+  when system_params['rebalanceInterval'] > 0. Lets the framework move the per pixel worker arrays 
+  when it moves pixels from a slow worker to its neighbors. Also needed for checkpoints.
+* workerHistoryNeeded(self): returns how many times the workers need to store, if fewer than 
+  system_params['times'], or None. G2IncrementalAccumulator returns max(delays) plus a margin.
+* workerSetDelayIndices(self, delayIndices): only needed when system_params['delayGroups'] > 1. Called
+  after workerInit with the indices of the delays this worker computes.
+* workerCheckpointArrays(self) and workerSetCheckpointArrays(self, name2array): only needed when
+  system_params['checkpoint'] is used. The worker arrays other than the per pixel ones needed to resume.
+* workerReduce(self, name2array, counts, int8array, allreduce) and viewerPublishReduced(self, counts, 
+  lastEventTime, name2reduced, h5UserGroup): only needed when system_params['workerReduce'] is True.
+  Workers reduce their results to small arrays that are summed at the viewer.
+* viewerShutdown(self): called on the viewer before the h5output file is closed at the end. G2Common
+  uses it to wait for its psmon publishing process.
+* workerH5Arrays(self, name2array, counts): only used when system_params['h5parallel'] is True. Returns
+  what the worker writes to the workers h5 file, defaults to the name2array from workerCalc.
+* viewerSetH5Writer(self, h5writer): only needed when system_params['h5writerQueue'] > 0. Called before
+  viewerInit with a ParCorAna.H5Writer.H5Writer. The user queues its h5 writes with h5writer.submit.
+* viewerDelayResults(self), viewerMergeDelayResults(self, name2summed): only needed when 
+  system_params['numViewers'] > 1. Each viewer publishes its own delays, the small arrays from
+  viewerDelayResults are summed over the viewers and merged on the first viewer.
 
 == launch an MPI job ==
 
@@ -341,6 +374,7 @@ Below we take a top down approach to summarizing the components of the framework
 ** identifyCommSubsystems - splits ranks into servers, workers, viewer, master. 
                      Creates intra-communicators for collective communication between
                           viewer <-> workers
+                          each viewer <-> workers, and the viewers, when numViewers > 1
                           each server <-> workers
 ** loads mask file
 ** Creates XCorrBase - part of the framework. The CommSystem talks to the XCorrBase.
@@ -380,24 +414,34 @@ Below we take a top down approach to summarizing the components of the framework
 '''
 from __future__ import absolute_import
 from .CommSystem import identifyCommSubsystems, identifyServerRanks
-from .CommSystem import RunServer, RunMaster, RunWorker, RunViewer
+from .CommSystem import RunServer, RunMaster, RunWorker, RunViewer, RunHelperViewer
 from .CommSystem import runCommSystem
 from .CommSystem import CommSystemFramework
 from .CommSystemUtil import checkCountsOffsets, divideAmongWorkers, makeLogger
-from .CommSystemUtil import checkParams, formatFileName, imgBoundBox, replaceSubsetsWithAverage
+from .CommSystemUtil import checkParams, formatFileName, imgBoundBox, replaceSubsetsWithAverage, PixelLabels
+from .CommSystemUtil import getOptionalSystemParam, identifyStraggler, migrateFromStraggler, migrationCountsOffsets
+from .CommSystemUtil import adaptUpdateInterval, photonize, restrictMask, timeBlockOwners
+from .CommSystemUtil import divideAmongDelayGroups, delayGroupIndices, viewerDelayBlocks
 from .MessageBuffers import SM_MsgBuffer, MVW_MsgBuffer
 from .PsanaUtil import parseDataSetString, makePsanaOptions, psanaNdArrays
 from .PsanaUtil import getSortedCountersBasedOnSecNsecAtHertz
-from .XCorrBase import makeDelayList, writeToH5Group, XCorrBase, writeConfig
+from .XCorrBase import makeDelayList, writeToH5Group, appendToH5Datasets, expandMaskedFlat, workersH5Name, XCorrBase, writeConfig
+from .XCorrBase import viewerH5Name
+from .XCorrBase import checkpointWorkerName, readCheckpointMaster, checkpointElementsForWorker
 from .WorkerData import WorkerData
+from .SparseWorkerData import SparseWorkerData
+from .MultiAnalysis import MultiAnalysis
 from . import maskColorImgNdarr
+from . import PsmonPublisher
+from . import H5Writer
 from .Exceptions import *
 
 __all__ = ['SM_MsgBuffer', 'MVW_MsgBuffer', 
-           'RunServer', 'RunMaster', 'RunViewer', 'RunWorker',
+           'RunServer', 'RunMaster', 'RunViewer', 'RunWorker', 'RunHelperViewer',
            'identifyCommSubsystems','identifyServerRanks',
-           'runCommSystem', 'CommSystemFramework', 'maskColorImgNdarr',
+           'runCommSystem', 'CommSystemFramework', 'maskColorImgNdarr', 'PsmonPublisher', 'H5Writer',
            'checkCountsOffsets', 'divideAmongWorkers', 'makeLogger',
            'divideAmongWorkers', 'checkCountsOffsets',
-           'WorkerData', 'XCorrBase', 'makeDelayList', 'writeToH5Group',
-            'checkParams', 'formatFileName', 'imgBoundBox', 'replaceSubsetsWithAverage']
+           'WorkerData', 'XCorrBase', 'makeDelayList', 'writeToH5Group', 'appendToH5Datasets', 'expandMaskedFlat', 'workersH5Name', 'viewerH5Name',
+           'checkpointWorkerName', 'readCheckpointMaster', 'checkpointElementsForWorker',
+            'checkParams', 'formatFileName', 'imgBoundBox', 'replaceSubsetsWithAverage', 'PixelLabels']
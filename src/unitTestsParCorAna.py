@@ -8,23 +8,33 @@ import sys
 import os
 import logging
 import tempfile
+import time
+import math
 import unittest
 from io import StringIO
 import numpy as np
 import h5py
 import glob
 import shutil
+import copy
+import threading
+import queue
+import pickle
 
 import psana
+from mpi4py import MPI
 from AppUtils.AppDataPath import AppDataPath
 import psana_test.psanaTestLib as ptl
 
 import ParCorAna as corAna
+import ParCorAna.UserG2 as UserG2
 
 NOCLEAN = os.environ.get('NOCLEAN',False)
 if not NOCLEAN:
     sys.stdout.write("%s: set environment variable NOCLEAN=1 to keep temporary directories and from unit tests" %  __file__)
 
+BENCHMARK = os.environ.get('BENCHMARK',False)
+
 
 def runCmd(cmd, verbose=True):
     o,e,retcode = ptl.cmdTimeOutWithReturnCode(cmd, seconds=10*60)
@@ -50,6 +60,31 @@ def unindent(x):
     minLeadingSpaces = min(allLeadingSpaces)
     return '\n'.join([ln[minLeadingSpaces:] for ln in lns])
 
+def makeTestG2Params(tempDir, mask, color, fineColor):
+    '''returns the user_params and testing MPI object for a UserG2 class. The mask, color and 
+    fineColor arrays are saved in tempDir.
+    '''
+    mp = corAna.CommSystem.getTestingMPIObject()
+    mp.setLogger('WARNING')
+    mp.setMask(np.array(mask, np.int8))
+    colorFile = os.path.join(tempDir, 'color.npy')
+    fineColorFile = os.path.join(tempDir, 'finecolor.npy')
+    np.save(colorFile, np.array(color, np.int32))
+    np.save(fineColorFile, np.array(fineColor, np.int32))
+    user_params = {'colorNdarrayCoords':colorFile,
+                   'colorFineNdarrayCoords':fineColorFile,
+                   'saturatedValue':(1<<15),
+                   'notzero':1E-5,
+                   'debug_plot':False}
+    return user_params, mp
+
+def makeTestG2(tempDir, userClass, system_params, mask, color, fineColor):
+    '''creates a UserG2 class on the testing MPI object, to run the worker callbacks without MPI.
+    The mask, color and fineColor arrays are saved in tempDir.
+    '''
+    user_params, mp = makeTestG2Params(tempDir, mask, color, fineColor)
+    return userClass(user_params, system_params, mp, False)
+
 class FormatFileName( unittest.TestCase ) :
 
     def setUp(self) :
@@ -589,6 +624,1322 @@ class UtilFunctions( unittest.TestCase ) :
         self.assertAlmostEqual(avgA[2,3], 13.0)
         self.assertAlmostEqual(avgA[2,4], 13.0)
 
+    def test_pixelLabels(self):
+        labels = np.array([[0,3,1,3],[1,0,3,1]], np.int32)
+        pixelLabels = corAna.PixelLabels(labels)
+        self.assertEqual(pixelLabels.numBins, 4)
+        self.assertEqual(list(pixelLabels.labels), [1,3])
+        self.assertEqual(list(pixelLabels.totals), [3,3])
+        A = np.arange(16, dtype=np.float32).reshape((2,)+labels.shape)
+        labelSums = np.zeros((2,pixelLabels.numBins), np.float64)
+        for row in range(2):
+            pixelLabels.labelSums(A[row], out=labelSums[row])
+            self.assertTrue(np.all(labelSums[row] == np.bincount(labels.flatten(), A[row].flatten())))
+        labelAverages = pixelLabels.labelAverages(labelSums).astype(np.float32)
+        for row in range(2):
+            avgA = corAna.replaceSubsetsWithAverage(A[row], labels, {1:3, 3:3})
+            self.assertTrue(np.all(avgA == pixelLabels.toPixels(labelAverages[row])))
+        self.assertAlmostEqual(labelAverages[0,1], 13.0/3.0, places=5)
+        self.assertAlmostEqual(labelAverages[0,3], 10.0/3.0, places=5)
+
+    def test_pixelLabelsRemovePixels(self):
+        labels = np.array([[0,3,1,3],[1,0,3,1]], np.int32)
+        pixelLabels = corAna.PixelLabels(labels)
+        # removes a pixel of each label, and one that is already 0
+        pixelLabels.removePixels(np.array([1,2,5]))
+        self.assertEqual(list(pixelLabels.flatLabels), [0,0,0,3,1,0,3,1])
+        self.assertEqual(list(pixelLabels.labels), [1,3])
+        self.assertEqual(list(pixelLabels.totals), [2,2])
+        self.assertEqual(list(pixelLabels.binCounts), [4,2,0,2])
+        # removing all the pixels of a label drops it
+        pixelLabels.removePixels(np.array([3,6]))
+        self.assertEqual(list(pixelLabels.labels), [1])
+        self.assertEqual(list(pixelLabels.totals), [2])
+        self.assertEqual(pixelLabels.binTotals[3], 1.0)
+        fresh = corAna.PixelLabels(pixelLabels.flatLabels.reshape(labels.shape))
+        self.assertEqual(list(fresh.binCounts), list(pixelLabels.binCounts[0:fresh.numBins]))
+        A = np.arange(8, dtype=np.float32).reshape(labels.shape)
+        self.assertEqual(list(pixelLabels.labelSums(A)), [0+1+2+3+5+6, 4+7, 0, 0])
+
+    @unittest.skipUnless(BENCHMARK, "set environment variable BENCHMARK=1 to run")
+    def test_pixelLabelsBenchmark(self):
+        '''compares forming the color delay curves with replaceSubsetsWithAverage to
+        forming them the way G2Common.viewerPublishDelays does with PixelLabels.
+        '''
+        np.random.seed(3)
+        shape = (32,185,388)
+        numDelays = 40
+        mask = np.random.rand(*shape) > 0.2
+        rows, cols = np.meshgrid(np.arange(shape[1]), np.arange(shape[2]), indexing='ij')
+        radius = np.hypot(rows - shape[1]//2, cols - shape[2]//2)[np.newaxis,:,:] + 3*np.arange(shape[0])[:,np.newaxis,np.newaxis]
+        angle = np.arctan2(rows - shape[1]//2, cols - shape[2]//2)[np.newaxis,:,:]
+        color = (np.minimum(radius//25, 9) * mask).astype(np.int32)
+        finecolor = ((6*np.minimum(radius//5, 49) + (angle + np.pi)//(np.pi/3) + 1) * mask).astype(np.int32)
+        color2total = UserG2.sumColoredPixels(color)
+        finecolor2total = UserG2.sumColoredPixels(finecolor)
+        G2 = np.random.rand(numDelays, *shape).astype(np.float32) + 0.1
+        IF = np.random.rand(numDelays, *shape).astype(np.float32) + 0.1
+        IP = np.random.rand(numDelays, *shape).astype(np.float32) + 0.1
+
+        t0 = time.time()
+        delayCurves = dict([(c, np.zeros(numDelays, np.float32)) for c in color2total])
+        for delayIdx in range(numDelays):
+            fineColorAvg_IF = corAna.replaceSubsetsWithAverage(IF[delayIdx], finecolor, finecolor2total)
+            fineColorAvg_IP = corAna.replaceSubsetsWithAverage(IP[delayIdx], finecolor, finecolor2total)
+            final = G2[delayIdx] / (fineColorAvg_IP * fineColorAvg_IF)
+            finalColorSums = np.bincount(color.flatten(), final.flatten())
+            for c, colorTotal in color2total.items():
+                delayCurves[c][delayIdx] = finalColorSums[c]/np.float32(colorTotal)
+
+        t1 = time.time()
+        colorLabels = corAna.PixelLabels(color)
+        fineColorLabels = corAna.PixelLabels(finecolor)
+        fineColorSums_IF = np.empty((numDelays, fineColorLabels.numBins), np.float64)
+        fineColorSums_IP = np.empty((numDelays, fineColorLabels.numBins), np.float64)
+        for delayIdx in range(numDelays):
+            fineColorLabels.labelSums(IF[delayIdx], out=fineColorSums_IF[delayIdx])
+            fineColorLabels.labelSums(IP[delayIdx], out=fineColorSums_IP[delayIdx])
+        fineColorAvgProduct = fineColorLabels.labelAverages(fineColorSums_IP).astype(np.float32) * \
+                              fineColorLabels.labelAverages(fineColorSums_IF).astype(np.float32)
+        fineColorAvgProduct[:,0] = 1.0
+        finalColorSums = np.empty((numDelays, colorLabels.numBins), np.float64)
+        for delayIdx in range(numDelays):
+            final = G2[delayIdx] / fineColorLabels.toPixels(fineColorAvgProduct[delayIdx])
+            colorLabels.labelSums(final, out=finalColorSums[delayIdx])
+        t2 = time.time()
+
+        sys.stdout.write("\nreplaceSubsetsWithAverage: %.2f sec, PixelLabels: %.2f sec\n" % (t1-t0, t2-t1))
+        for c, colorTotal in zip(colorLabels.labels, colorLabels.totals):
+            self.assertTrue(np.all((finalColorSums[:,c]/np.float32(colorTotal)).astype(np.float32) == delayCurves[c]))
+
+    def test_adaptUpdateInterval(self):
+        # update took 10% of the time, target is 5%, interval doubles
+        self.assertEqual(corAna.adaptUpdateInterval(1000, 1.0, 10.0, 0.05, 100, 10000), 2000)
+        # update took 2.5% of the time, target is 5%, interval halves
+        self.assertEqual(corAna.adaptUpdateInterval(1000, 0.25, 10.0, 0.05, 100, 10000), 500)
+        # at most a factor of 2
+        self.assertEqual(corAna.adaptUpdateInterval(1000, 9.0, 10.0, 0.05, 100, 10000), 2000)
+        self.assertEqual(corAna.adaptUpdateInterval(1000, 0.01, 10.0, 0.05, 100, 10000), 500)
+        # bounds
+        self.assertEqual(corAna.adaptUpdateInterval(8000, 9.0, 10.0, 0.05, 100, 10000), 10000)
+        self.assertEqual(corAna.adaptUpdateInterval(150, 0.01, 10.0, 0.05, 100, 10000), 100)
+        self.assertEqual(corAna.adaptUpdateInterval(1000, 0.6, 10.0, 0.05, 100, 10000), 1200)
+
+    def test_appendToH5Datasets(self):
+        tempDir = tempfile.mkdtemp()
+        h5fileName = os.path.join(tempDir, 'appended.h5')
+        h5file = h5py.File(h5fileName, 'w')
+        delays = [1, 2, 4]
+        A = np.arange(6, dtype=np.float32).reshape(2,3)
+        corAna.appendToH5Datasets(h5file, {'G2':{1:A, 2:A+1}}, delays, 0, 'gzip')
+        corAna.appendToH5Datasets(h5file, {'G2':{4:A+2}}, delays, 0, 'gzip')
+        corAna.appendToH5Datasets(h5file, {'G2':{2:A+3}}, delays, 2, 'gzip')
+        G2 = h5file['G2']
+        self.assertEqual(G2.shape, (3, 3, 2, 3))
+        self.assertEqual(G2.chunks, (1, 1, 2, 3))
+        self.assertTrue(np.all(G2[0,0] == A))
+        self.assertTrue(np.all(G2[0,1] == A+1))
+        self.assertTrue(np.all(G2[0,2] == A+2))
+        self.assertTrue(np.all(np.isnan(G2[1])))
+        self.assertTrue(np.all(G2[2,1] == A+3))
+        self.assertTrue(np.all(np.isnan(G2[2,0])))
+        h5file.close()
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_expandMaskedFlat(self):
+        tempDir = tempfile.mkdtemp()
+        h5fileName = os.path.join(tempDir, 'maskedFlat.h5')
+        h5file = h5py.File(h5fileName, 'w')
+        mask = np.array([[1,0,1],[0,1,1]], np.int8)
+        h5file.create_group('system')
+        h5file['system'].create_group('system_params')
+        h5file['system']['system_params']['maskNdarrayCoords'] = mask
+        h5file['system']['maskedFlatIndices'] = np.array([5,0,2,4], np.int64)
+        ndarray = np.array([[1,0,2],[0,3,4]], np.float32)
+        corAna.appendToH5Datasets(h5file, {'G2':{1:ndarray}}, [1], 0, flatIndices=np.array([5,0,2,4]))
+        self.assertEqual(h5file['G2'].shape, (1,1,4))
+        self.assertEqual(list(h5file['G2'][0,0]), [4.0, 1.0, 2.0, 3.0])
+        expanded = corAna.expandMaskedFlat(h5file, h5file['G2'][:])
+        self.assertEqual(expanded.shape, (1,1,2,3))
+        self.assertTrue(np.all(expanded[0,0] == ndarray))
+        h5file.close()
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_h5Writer(self):
+        written = []
+        def write(x, y):
+            written.append((x,y))
+        h5writer = corAna.H5Writer.H5Writer(2)
+        for idx in range(10):
+            h5writer.submit(write, idx, 2*idx)
+        h5writer.close()
+        self.assertEqual(written, [(idx, 2*idx) for idx in range(10)])
+        self.assertEqual(h5writer.timingDict['h5writerWrite'][1], 10)
+
+        def failingWrite():
+            raise IOError("disk full")
+        h5writer = corAna.H5Writer.H5Writer(2)
+        h5writer.submit(failingWrite)
+        self.assertRaises(Exception, h5writer.close)
+
+    def test_checkpointElementsForWorker(self):
+        # a checkpoint worker had elements 5,0,2 - now this worker has 2,3,5
+        selected, positions = corAna.checkpointElementsForWorker(np.array([2,3,5]), np.array([5,0,2]))
+        self.assertEqual(list(selected), [True, False, True])
+        self.assertEqual(list(positions), [2, 0])
+        selected, positions = corAna.checkpointElementsForWorker(np.array([1]), np.array([7,9]))
+        self.assertEqual(len(positions), 0)
+        self.assertEqual(corAna.checkpointWorkerName('/a/b/ckpt.h5', 3, 1), '/a/b/ckpt_worker3_1.h5')
+
+    def test_photonize(self):
+        pixels, photons = corAna.photonize(np.array([0.2, 5.0, 0.0, 30.9, 14.9, -8.0]), 10.0)
+        self.assertEqual(list(pixels), [1, 3, 4])
+        self.assertEqual(list(photons), [1, 3, 1])
+        pixels, photons = corAna.photonize(np.array([5.0, 19.5]), 10.0, threshold=0.9)
+        self.assertEqual(list(pixels), [1])
+        self.assertEqual(list(photons), [2])
+
+    def test_restrictMask(self):
+        mask = np.array([[1,1,1],[1,0,1]], np.int8)
+        color = np.array([[0,2,1],[1,1,1]], np.int32)
+        hotPixels = np.array([[0,0,0],[0,0,1]], np.int8)
+        restricted = corAna.restrictMask(mask, color, [hotPixels, np.array([3])])
+        self.assertEqual(restricted.dtype, np.int8)
+        self.assertEqual(restricted.tolist(), [[0,1,1],[0,0,0]])
+        self.assertEqual(mask.tolist(), [[1,1,1],[1,0,1]])
+        self.assertEqual(corAna.restrictMask(mask).tolist(), mask.tolist())
+
+    def test_timeBlockOwners(self):
+        # blocks of 10 counters over 3 workers, with a halo of 5
+        self.assertEqual(corAna.timeBlockOwners(3, 10, 3, 5), [0])
+        # there are no blocks before the first
+        self.assertEqual(corAna.timeBlockOwners(3, 10, 3, 50), [0])
+        self.assertEqual(corAna.timeBlockOwners(12, 10, 3, 5), [1, 0])
+        self.assertEqual(corAna.timeBlockOwners(35, 10, 3, 5), [0])
+        # a halo longer than the blocks goes back several blocks, each worker once
+        self.assertEqual(corAna.timeBlockOwners(34, 10, 3, 50), [0, 2, 1])
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+        workerData = corAna.WorkerData(logger, True, 15, 1)
+        self.assertTrue(np.all(workerData.ownsTimes([3, 12, 35])))
+        workerData.setTimeOwner(10, 3, 1)
+        self.assertEqual(list(workerData.ownsTimes([3, 12, 35, 40])), [False, True, False, True])
+
+    def test_delayGroups(self):
+        offsets, counts = corAna.divideAmongDelayGroups(11, 6, 2)
+        self.assertEqual(counts, [4,0,4,0,3,0])
+        self.assertEqual(offsets, [0,4,4,8,8,11])
+        # one delay group is the usual division among the workers
+        self.assertEqual(corAna.divideAmongDelayGroups(11, 3, 1), ([0,4,8], [4,4,3]))
+        self.assertEqual(corAna.delayGroupIndices(5, 2, 0), [0,2,4])
+        self.assertEqual(corAna.delayGroupIndices(5, 2, 1), [1,3])
+        allDelays = sorted(sum([corAna.delayGroupIndices(7, 3, g) for g in range(3)], []))
+        self.assertEqual(allDelays, list(range(7)))
+
+    def test_multiAnalysis(self):
+        class Analysis(object):
+            def __init__(self, user_params, system_params, mpiParams, testAlternate):
+                self.history = user_params['history']
+            def workerHistoryNeeded(self):
+                return self.history
+            def viewerInit(self, maskNdarrayCoords, h5GroupUser):
+                self.h5Group = h5GroupUser
+            def viewerPublish(self, counts, lastEventTime, name2delay2ndarray, int8ndarray, h5GroupUser):
+                self.published = (counts, name2delay2ndarray, h5GroupUser)
+        class Sum(Analysis):
+            def fwArrayNames(self):
+                return ['S']
+            def workerCalc(self, workerData):
+                return {'S':np.ones((2,3), np.float32)}, np.array([1,2], np.int64), np.array([0,1,0], np.int8)
+            def workerH5Arrays(self, name2array, counts):
+                return {'S':name2array['S'] / counts[:,np.newaxis]}
+            def viewerSetH5Writer(self, h5writer):
+                self.h5writer = h5writer
+        class Mean(Analysis):
+            def fwArrayNames(self):
+                return ['S', 'M']
+            def workerCalc(self, workerData):
+                return {'S':np.zeros((2,3), np.float32), 'M':np.zeros((2,3), np.float32)}, \
+                    np.array([3,4], np.int64), np.array([1,0,0], np.int8)
+        system_params = {'delays':[1,2]}
+        multi = corAna.MultiAnalysis([Sum, Mean], {'history':10}, system_params, None, False)
+        self.assertEqual(multi.fwArrayNames(), ['Sum_S', 'Mean_S', 'Mean_M'])
+        name2array, counts, int8array = multi.workerCalc(None)
+        self.assertEqual(set(name2array.keys()), set(['Sum_S', 'Mean_S', 'Mean_M']))
+        self.assertEqual(name2array['Sum_S'][0,0], 1.0)
+        self.assertEqual(counts.tolist(), [[1,2],[3,4]])
+        self.assertEqual(int8array.tolist(), [1,1,0])
+        self.assertEqual(multi.analysisName2array(1, name2array)['S'][0,0], 0.0)
+        self.assertEqual(multi.workerHistoryNeeded(), 10)
+        multi.analyses[1].history = None
+        self.assertIsNone(multi.workerHistoryNeeded())
+
+        # only the analyses that implement workerH5Arrays change their rows, with their own counts
+        h5Arrays = multi.workerH5Arrays(name2array, counts)
+        self.assertEqual(set(h5Arrays.keys()), set(['Sum_S', 'Mean_S', 'Mean_M']))
+        self.assertTrue(np.allclose(h5Arrays['Sum_S'], [[1.0,1.0,1.0], [0.5,0.5,0.5]]))
+        self.assertIs(h5Arrays['Mean_S'], name2array['Mean_S'])
+
+        # the h5 writer thread goes to the analyses that implement viewerSetH5Writer
+        multi.viewerSetH5Writer('h5writer')
+        self.assertEqual(multi.analyses[0].h5writer, 'h5writer')
+        self.assertFalse(hasattr(multi.analyses[1], 'h5writer'))
+
+        # each analysis writes to its own subgroup, and is published its own counts and arrays
+        h5file = h5py.File('multiAnalysis.h5', 'w', driver='core', backing_store=False)
+        h5GroupUser = h5file.create_group('user')
+        multi.viewerInit(None, h5GroupUser)
+        self.assertEqual(sorted(h5GroupUser.keys()), ['Mean', 'Sum'])
+        self.assertEqual(multi.analyses[0].h5Group.name, '/user/Sum')
+        self.assertEqual(multi.analyses[1].h5Group.name, '/user/Mean')
+        name2delay2ndarray = dict([(fwName, {1:np.full((2,2), idx), 2:np.full((2,2), 10+idx)}) \
+                                   for idx, fwName in enumerate(multi.fwArrayNames())])
+        multi.viewerPublish(counts, {'counter':10}, name2delay2ndarray, np.zeros((2,2), np.int8), h5GroupUser)
+        for idx, prefix in enumerate(['Sum', 'Mean']):
+            publishedCounts, publishedArrays, publishedGroup = multi.analyses[idx].published
+            self.assertEqual(list(publishedCounts), list(counts[idx]))
+            self.assertEqual(sorted(publishedArrays.keys()), sorted(multi.analyses[idx].fwArrayNames()))
+            for nm in publishedArrays:
+                self.assertIs(publishedArrays[nm], name2delay2ndarray['%s_%s' % (prefix, nm)])
+            self.assertEqual(publishedGroup.name, '/user/%s' % prefix)
+        h5file.close()
+        # without an h5 file, the analyses get None
+        multi = corAna.MultiAnalysis([Sum, Mean], {'history':10}, system_params, None, False)
+        multi.viewerInit(None, None)
+        self.assertIsNone(multi.analyses[0].h5Group)
+        self.assertIsNone(multi.analyses[1].h5Group)
+
+    def test_migrateFromStraggler(self):
+        self.assertIsNone(corAna.identifyStraggler([1.0, 1.1, 0.9], 1.5))
+        self.assertEqual(corAna.identifyStraggler([1.0, 2.0, 1.0], 1.5), 1)
+        newCounts = corAna.migrateFromStraggler([10,10,10], [1.0, 2.0, 1.0], 1, 1.5)
+        self.assertEqual(newCounts, [12,5,13])
+        newCounts = corAna.migrateFromStraggler([10,10,10], [3.0, 1.0, 1.0], 0, 1.5)
+        self.assertEqual(sum(newCounts), 30)
+        self.assertLess(newCounts[0], 10)
+        self.assertEqual(newCounts[2], 10)
+
+    def test_migrationCountsOffsets(self):
+        sendCounts, sendOffsets, recvCounts, recvOffsets = corAna.migrationCountsOffsets([4,4], [3,5], 0)
+        self.assertEqual(sendCounts, [3,1])
+        self.assertEqual(sendOffsets, [0,3])
+        self.assertEqual(recvCounts, [3,0])
+        self.assertEqual(recvOffsets, [0,3])
+        sendCounts, sendOffsets, recvCounts, recvOffsets = corAna.migrationCountsOffsets([4,4], [3,5], 1)
+        self.assertEqual(sendCounts, [0,4])
+        self.assertEqual(recvCounts, [1,4])
+        self.assertEqual(recvOffsets, [0,1])
+
+    def test_workerRepartition(self):
+        # three workers move their stored data and UserG2 pixel arrays over a fake workersComm,
+        # for both WorkerData layouts, in memory and in a memmap
+        class Exchange(object):
+            '''what the workersComm of numWorkers threads share. Each Alltoallv waits for all the
+            workers to make the same call.
+            '''
+            def __init__(self, numWorkers):
+                self.numWorkers = numWorkers
+                self.condition = threading.Condition()
+                # for each call, the send buffer of each worker, and how many workers have received
+                self.calls = []
+                self.numDone = []
+            def wait(self, ready):
+                deadline = time.time() + 60
+                while not ready():
+                    assert time.time() < deadline, "timed out waiting for the other workers"
+                    self.condition.wait(1)
+            def Alltoallv(self, callIdx, workerIdx, sendbuf, recvbuf):
+                self.condition.acquire()
+                try:
+                    if callIdx == len(self.calls):
+                        self.calls.append({})
+                        self.numDone.append(0)
+                    sent = self.calls[callIdx]
+                    sent[workerIdx] = sendbuf
+                    self.condition.notify_all()
+                    self.wait(lambda : len(sent) == self.numWorkers)
+                    # one MPI element is one row of the pixel major buffers
+                    recvArray, (recvCounts, recvOffsets), recvType = recvbuf
+                    for other in range(self.numWorkers):
+                        sendArray, (sendCounts, sendOffsets), sendType = sent[other]
+                        assert sendCounts[workerIdx] == recvCounts[other], "worker %d sends %d, worker %d receives %d" % \
+                            (other, sendCounts[workerIdx], workerIdx, recvCounts[other])
+                        recvArray[recvOffsets[other]:recvOffsets[other] + recvCounts[other]] = \
+                            sendArray[sendOffsets[workerIdx]:sendOffsets[workerIdx] + sendCounts[workerIdx]]
+                    self.numDone[callIdx] += 1
+                    self.condition.notify_all()
+                    self.wait(lambda : self.numDone[callIdx] == self.numWorkers)
+                finally:
+                    self.condition.release()
+        class WorkersComm(object):
+            def __init__(self, exchange, workerIdx):
+                self.exchange = exchange
+                self.workerIdx = workerIdx
+                self.numCalls = 0
+            def Alltoallv(self, sendbuf, recvbuf):
+                self.exchange.Alltoallv(self.numCalls, self.workerIdx, sendbuf, recvbuf)
+                self.numCalls += 1
+
+        tempDir = tempfile.mkdtemp()
+        numPixels = 9
+        mask = np.ones((1, numPixels), np.int8)
+        color = np.ones((1, numPixels), np.int32)
+        system_params = {'delays':[1,2], 'times':5}
+        times = [1,2,3,4]
+        np.random.seed(5)
+        data = np.random.rand(len(times), numPixels).astype(np.float32)
+        name2pixels = {'G2':np.random.rand(2, numPixels).astype(np.float32),
+                       'IP':np.random.rand(2, numPixels).astype(np.float32),
+                       'IF':np.random.rand(2, numPixels).astype(np.float32),
+                       'saturatedElements':np.random.randint(0, 2, numPixels).astype(np.int8)}
+        oldCounts = [3,3,3]
+        newCounts = [1,5,3]
+        workerRanks = [10, 11, 12]
+        for layout, insertBlock, useStoreDir in [('time', 0, False), ('time', 0, True),
+                                                 ('pixel', 2, False), ('pixel', 0, True)]:
+            storeDir = None
+            if useStoreDir:
+                storeDir = os.path.join(tempDir, 'store_%s' % layout)
+                os.mkdir(storeDir)
+            exchange = Exchange(len(workerRanks))
+            workers = []
+            for workerIdx, workerRank in enumerate(workerRanks):
+                g2 = makeTestG2(tempDir, UserG2.G2atEnd, system_params, mask, color, color)
+                mp = g2.mp
+                mp.workerRanks = workerRanks
+                mp.numWorkers = len(workerRanks)
+                mp.rank = workerRank
+                mp.isFirstWorker = workerIdx == 0
+                mp.workersComm = WorkersComm(exchange, workerIdx)
+                mp.setWorkerCounts(oldCounts)
+                offset = mp.workerWorldRankToOffset[workerRank]
+                count = oldCounts[workerIdx]
+                g2.workerInit(count)
+                g2.workerSetPixelArrays(dict([(nm, array[..., offset:offset + count].copy()) \
+                                              for nm, array in name2pixels.items()]), count)
+                worker = corAna.XCorrBase.__new__(corAna.XCorrBase)
+                worker.mp = mp
+                worker.userObj = g2
+                worker.asyncRequests = []
+                worker.initDelayAndGather = lambda : None
+                worker.workerData = corAna.WorkerData(mp.logger, workerIdx == 0, system_params['times'], count,
+                                                      storeDir=storeDir, layout=layout, insertBlock=insertBlock)
+                for tmIdx, tm in enumerate(times):
+                    worker.workerData.addData(tm, data[tmIdx, offset:offset + count])
+                workers.append(worker)
+
+            errors = []
+            def repartition(worker):
+                try:
+                    worker.workerRepartition(newCounts)
+                except Exception as exp:
+                    errors.append(exp)
+            threads = [threading.Thread(target=repartition, args=(worker,)) for worker in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(120)
+            self.assertEqual(errors, [])
+            # the stored data, then the four pixel arrays
+            self.assertEqual(exchange.numDone, [len(workers)] * 5)
+
+            newOffsets = [0, 1, 6]
+            for workerIdx, worker in enumerate(workers):
+                offset, count = newOffsets[workerIdx], newCounts[workerIdx]
+                msg = "layout=%s storeDir=%s worker=%d" % (layout, storeDir, workerIdx)
+                self.assertEqual(worker.mp.workerCounts(), newCounts, msg=msg)
+                self.assertEqual(worker.elementsThisWorker, count, msg=msg)
+                workerData = worker.workerData
+                self.assertEqual(workerData.X.shape, (system_params['times'], count), msg=msg)
+                if useStoreDir:
+                    self.assertIsInstance(workerData.XT if layout == 'pixel' else workerData.X, np.memmap, msg=msg)
+                if layout == 'pixel':
+                    self.assertTrue(workerData.pixelSeries().flags['C_CONTIGUOUS'], msg=msg)
+                for tm, xInd in workerData.timesDataIndexes():
+                    self.assertTrue(np.all(workerData.X[xInd,:] == data[times.index(tm), offset:offset + count]), msg=msg)
+                self.assertEqual(sorted([tm for tm, xInd in workerData.timesDataIndexes()]), times, msg=msg)
+                g2 = worker.userObj
+                self.assertEqual(g2.numElementsWorker, count, msg=msg)
+                for nm, array in g2.workerPixelArrays().items():
+                    self.assertTrue(np.all(array == name2pixels[nm][..., offset:offset + count]), msg="%s %s" % (msg, nm))
+                # the worker keeps storing data for its new pixels
+                worker.workerData.addData(5, data[0, offset:offset + count])
+                worker.workerData.flush()
+                self.assertIn(5, [tm for tm, xInd in workerData.timesDataIndexes()], msg=msg)
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_orderPixelsByLabels(self):
+        mp = corAna.CommSystem.getTestingMPIObject()
+        mp.setLogger('WARNING')
+        mask = np.array([[1,1,0,1],[1,0,1,1]], np.int8)
+        color = np.array([[2,1,1,2],[1,2,2,1]], np.int32)
+        fineColor = np.array([[4,2,1,3],[1,4,3,2]], np.int32)
+        mp.setMask(mask, [color, fineColor])
+        data = np.arange(8, dtype=np.float32).reshape(mask.shape)
+        maskedFlat = mp.maskedFlat(data)
+        self.assertEqual(list(maskedFlat), [4.0, 1.0, 7.0, 3.0, 6.0, 0.0])
+        self.assertEqual(list(color.flatten()[mp.maskedFlatIndices]), [1,1,1,2,2,2])
+        ndarray = mp.maskedFlatToNdarray(maskedFlat)
+        self.assertEqual(ndarray.shape, mask.shape)
+        self.assertTrue(np.all(ndarray == data * mask))
+
+    def test_workerReduceFullUpdate(self):
+        # light updates call workerReduce when fullUpdate > 0, even if workerReduce is False
+        tempDir = tempfile.mkdtemp()
+        mask = np.ones((2,4), np.int8)
+        color = [[1,1,2,2],[1,1,2,2]]
+        fineColor = [[1,2,3,4],[1,2,3,4]]
+        system_params = {'delays':[1,2], 'times':10, 'workerReduce':False, 'fullUpdate':5}
+        g2 = makeTestG2(tempDir, UserG2.G2atEnd, system_params, mask, color, fineColor)
+        g2.workerInit(8)
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+        workerData = corAna.WorkerData(logger, True, 10, 8)
+        # each pixel is constant in time, so the normalized G2 is 1
+        for tm in range(1,6):
+            workerData.addData(tm, np.array([1,2,3,4,1,2,3,4], np.float32))
+        name2array, counts, int8array = g2.workerCalc(workerData)
+        reduced = g2.workerReduce(name2array, counts, int8array, lambda array: array)
+        self.assertEqual(list(reduced['colorTotals']), [0,4,4])
+        self.assertTrue(np.allclose(reduced['colorSums'][:,1:], 4.0))
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_asyncGather(self):
+        # workerStartAsyncGather on two workers, and viewerAsyncGather, over a fake viewerWorkersComm.
+        # A send request reads its buffer when it completes, as MPI may, so the snapshots must be
+        # copies, and not be overwritten before the last gather of them has finished.
+        log = []
+        class Request(object):
+            def __init__(self, buf):
+                self.buf = buf
+                self.sent = None
+            def complete(self):
+                if self.sent is None:
+                    self.sent = self.buf.copy()
+                return self.sent
+        class FakeMPI(object):
+            FLOAT = MPI.FLOAT
+            INT8_T = MPI.INT8_T
+            INT64_T = MPI.INT64_T
+            class Request(object):
+                @staticmethod
+                def Waitall(requests):
+                    log.append('wait')
+                    for request in requests:
+                        if isinstance(request, Request):
+                            request.complete()
+                @staticmethod
+                def Testall(requests):
+                    return all([request.sent is not None for request in requests])
+        class ViewerWorkersComm(object):
+            def __init__(self, numWorkers):
+                self.countsSends = []
+                self.workerGathers = [[] for idx in range(numWorkers)]
+            def Recv(self, buf, source):
+                # pairs with the Isend of the first worker
+                request = self.countsSends.pop(0)
+                buf[0][:] = request.complete()
+            def Igatherv(self, sendbuf, recvbuf, root):
+                # the viewer receives the next gather of each worker, in worker order
+                array, (counts, offsets), mpiType = recvbuf
+                for workerIdx, gathers in enumerate(self.workerGathers):
+                    request = gathers.pop(0)
+                    sent = request.complete().flatten()
+                    assert len(sent) == counts[workerIdx], "worker %d sent %d elements" % (workerIdx, len(sent))
+                    array[offsets[workerIdx]:offsets[workerIdx] + counts[workerIdx]] = sent
+                return Request(np.zeros(0))
+        class WorkerComm(object):
+            def __init__(self, comm, workerIdx):
+                self.comm = comm
+                self.workerIdx = workerIdx
+            def Isend(self, buf, dest):
+                log.append(('send', self.workerIdx))
+                request = Request(buf[0])
+                self.comm.countsSends.append(request)
+                return request
+            def Igatherv(self, sendbuf, recvbuf, root):
+                assert recvbuf is None
+                log.append(('send', self.workerIdx))
+                request = Request(sendbuf[0])
+                self.comm.workerGathers[self.workerIdx].append(request)
+                return request
+
+        mp = corAna.CommSystem.getTestingMPIObject()
+        mp.setLogger('WARNING')
+        mask = np.array([[1,1,0,1],[1,0,1,1]], np.int8)
+        mp.setMask(mask)
+        delays = [1,2,4]
+        numDelays = len(delays)
+        workerCounts = [2,4]
+        comm = ViewerWorkersComm(2)
+        mp.firstWorkerRankInViewerWorkersComm = 1
+        mp.viewerWorkersComm = comm
+
+        viewer = corAna.XCorrBase.__new__(corAna.XCorrBase)
+        viewer.mp = mp
+        viewer.logger = mp.logger
+        viewer.delays = delays
+        viewer.numDelays = numDelays
+        viewer.numGatherDelays = numDelays
+        viewer.countsShape = (numDelays,)
+        viewer.arrayNames = ['G2', 'IF']
+        viewer.gatherAllDelayCounts = [numDelays * count for count in workerCounts]
+        viewer.gatherAllDelayOffsets = [0, numDelays * workerCounts[0]]
+        viewer.gatherOneNDArrayCounts = workerCounts
+        viewer.gatherOneNDArrayOffsets = [0, workerCounts[0]]
+        viewer.gatheredFlatNDArrays = dict([(nm, np.zeros(numDelays * 6, np.float32)) for nm in viewer.arrayNames])
+        viewer.gatheredInt8array = np.zeros(6, np.int8)
+        viewer.viewerNDarrays = dict([(nm, np.zeros((numDelays,) + mask.shape, np.float32)) for nm in viewer.arrayNames])
+        viewer.viewerDelayViews = {}
+        viewer.viewerWorkerSegments = [(2, mp.maskedFlatIndices[0:2]), (4, mp.maskedFlatIndices[2:6])]
+        viewer.viewerInt8ndarray = np.zeros(mask.shape, np.int8)
+
+        workers = []
+        for workerIdx in range(2):
+            worker = corAna.XCorrBase.__new__(corAna.XCorrBase)
+            worker.mp = copy.copy(mp)
+            worker.mp.isViewer = False
+            worker.mp.isFirstWorker = workerIdx == 0
+            worker.mp.viewerWorkersComm = WorkerComm(comm, workerIdx)
+            worker.arrayNames = viewer.arrayNames
+            worker.asyncRequests = []
+            worker.asyncSnapshot = {}
+            workers.append(worker)
+
+        np.random.seed(3)
+        def workerResults(workerIdx):
+            name2array = dict([(nm, np.random.rand(numDelays, workerCounts[workerIdx]).astype(np.float32)) \
+                               for nm in viewer.arrayNames])
+            int8array = np.random.randint(0, 2, workerCounts[workerIdx]).astype(np.int8)
+            return name2array, int8array
+
+        xCorrBaseModule = sys.modules[corAna.XCorrBase.__module__]
+        origMPI = xCorrBaseModule.MPI
+        xCorrBaseModule.MPI = FakeMPI
+        try:
+            for update in range(3):
+                counts = np.array([10+update, 8, 6], np.int64)
+                results = [workerResults(workerIdx) for workerIdx in range(2)]
+                expected = dict([(nm, [array.copy() for array in [result[0][nm] for result in results]]) \
+                                 for nm in viewer.arrayNames])
+                expectedInt8 = np.concatenate([result[1] for result in results])
+                del log[:]
+                for worker, (name2array, int8array) in zip(workers, results):
+                    inFlight = len(worker.asyncRequests)
+                    worker.workerStartAsyncGather(name2array, counts, int8array)
+                    # the gather of the last snapshot is finished before the snapshot is overwritten
+                    if inFlight > 0:
+                        self.assertEqual(log[-len(worker.asyncRequests)-1], 'wait')
+                    # one snapshot in flight, the counts from the first worker, then each array and the int8array
+                    self.assertEqual(len(worker.asyncRequests), len(viewer.arrayNames) + 1 + int(worker.mp.isFirstWorker))
+                    # later changes to the workerCalc results do not reach the gathered data
+                    for array in name2array.values():
+                        array[:] = -1
+                    int8array[:] = -1
+                    counts[:] = -1
+                    self.assertNotIn(id(int8array), [id(snapshot) for snapshot in worker.asyncSnapshot.values()])
+
+                gatheredCounts = viewer.viewerAsyncGather()
+                self.assertEqual(list(gatheredCounts), [10+update, 8, 6])
+                self.assertEqual(len(comm.countsSends), 0)
+                self.assertEqual([len(gathers) for gathers in comm.workerGathers], [0, 0])
+                name2delay2ndarray, int8ndarray = viewer.viewerFormNDarrays(gatheredCounts, update)
+                # the same ndarrays the blocking gather forms, with all the data of each worker in turn
+                for nm in viewer.arrayNames:
+                    for delayIdx, delay in enumerate(delays):
+                        flat = np.concatenate([array[delayIdx] for array in expected[nm]])
+                        self.assertTrue(np.all(name2delay2ndarray[nm][delay] == mp.maskedFlatToNdarray(flat)))
+                self.assertTrue(np.all(int8ndarray == mp.maskedFlatToNdarray(expectedInt8)))
+                if update == 1:
+                    # workers let the gather progress between events
+                    for worker in workers:
+                        worker.workerProgressAsyncGather()
+                        self.assertEqual(worker.asyncRequests, [])
+            for worker in workers:
+                worker.workerFinishAsyncGather()
+                self.assertEqual(worker.asyncRequests, [])
+
+            # a repartition waits for the gather in flight before it moves the pixels
+            class UserObj(object):
+                def workerPixelArrays(self):
+                    return {}
+                def workerSetPixelArrays(self, name2array, numElements):
+                    pass
+            worker = workers[1]
+            name2array, int8array = workerResults(1)
+            worker.workerStartAsyncGather(name2array, np.zeros(numDelays, np.int64), int8array)
+            worker.mp.workerRanks = [worker.mp.rank]
+            worker.mp.setWorkerCounts([6])
+            worker.mp.logInfo = lambda msg: None
+            worker.userObj = UserObj()
+            worker.initDelayAndGather = lambda : None
+            worker.workerData = corAna.WorkerData(mp.logger, True, 3, 6)
+            def exchangePixelColumns(array, *countsOffsets):
+                log.append('exchange')
+                return array
+            worker.exchangePixelColumns = exchangePixelColumns
+            del log[:]
+            worker.workerRepartition([6])
+            self.assertEqual(log, ['wait', 'exchange'])
+            self.assertEqual(worker.asyncRequests, [])
+        finally:
+            xCorrBaseModule.MPI = origMPI
+
+        # the viewer tells the master when a full asynchronous update is done, so the master
+        # does not start another while a snapshot is in flight
+        self.assertTrue(corAna.CommSystem.viewerReportsUpdateDone(True, 0.0, light=False))
+        self.assertFalse(corAna.CommSystem.viewerReportsUpdateDone(True, 0.0, light=True))
+        self.assertFalse(corAna.CommSystem.viewerReportsUpdateDone(False, 0.0, light=False))
+
+    def test_sparseSaturated(self):
+        # the sparse mode flags the same saturated pixels as workerAdjustData does on the dense data
+        tempDir = tempfile.mkdtemp()
+        mask = np.ones((2,4), np.int8)
+        color = [[1,1,2,2],[1,1,2,2]]
+        fineColor = [[1,2,3,4],[1,2,3,4]]
+        photonADU = 1000.0
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+        rawRows = [np.array([40000, 5000, 0, 0, 200, 0, 0, 0], np.float32),
+                   np.array([0, 0, 1<<15, 0, 0, 1200, 0, 0], np.float32),
+                   np.array([0, 0, 0, 0, 0, 0, 0, 99000], np.float32)]
+        dense = makeTestG2(tempDir, UserG2.G2atEnd, {'delays':[1], 'times':10}, mask, color, fineColor)
+        dense.workerInit(8)
+        sparse = makeTestG2(tempDir, UserG2.G2atEnd, {'delays':[1], 'times':10, 'sparsePhotonADU':photonADU},
+                            mask, color, fineColor)
+        sparse.workerInit(8)
+        self.assertEqual(sparse.saturatedPhotons, 33)
+        sparseData = corAna.SparseWorkerData(logger, True, 10, 8, addRemoveCallbackObject=sparse)
+        for tm, rawRow in enumerate(rawRows):
+            dense.workerAdjustData(rawRow.copy())
+            sparseData.addData(tm + 1, corAna.photonize(rawRow, photonADU))
+        self.assertEqual(list(dense.saturatedElements), [1,0,1,0,0,0,0,1])
+        self.assertEqual(list(sparse.workerCalc(sparseData)[2]), list(dense.saturatedElements))
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_sparseSameAsDense(self):
+        # the sparse mode gives the same G2, IP, IF and counts as the dense data of the same photons
+        tempDir = tempfile.mkdtemp()
+        mask = np.ones((2,4), np.int8)
+        color = [[1,1,2,2],[1,1,2,2]]
+        fineColor = [[1,2,3,4],[1,2,3,4]]
+        numTimes = 12
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+        np.random.seed(13)
+        # mostly empty rows, some with no photons, and gaps in the times
+        times = [tm for tm in range(1, 30) if tm % 5 != 2]
+        rows = dict([(tm, (np.random.rand(8) < 0.3) * np.random.randint(1, 4, 8)) for tm in times])
+        rows[times[3]][:] = 0
+        for userClass in [UserG2.G2atEnd, UserG2.G2IncrementalAccumulator, UserG2.G2IncrementalWindowed]:
+            results = []
+            for photonADU in [None, 1.0]:
+                system_params = {'delays':[1,2,3,7], 'times':numTimes}
+                if photonADU is not None:
+                    system_params['sparsePhotonADU'] = photonADU
+                g2 = makeTestG2(tempDir, userClass, system_params, mask, color, fineColor)
+                g2.workerInit(8)
+                # the dense data is not raised to notzero, as the sparse data is not
+                g2.notzero = 0.0
+                if photonADU is None:
+                    workerData = corAna.WorkerData(logger, True, numTimes, 8, addRemoveCallbackObject=g2)
+                else:
+                    workerData = corAna.SparseWorkerData(logger, True, numTimes, 8, addRemoveCallbackObject=g2)
+                for tm in times:
+                    if photonADU is None:
+                        workerData.addData(tm, rows[tm].astype(np.float32))
+                    else:
+                        workerData.addData(tm, corAna.photonize(rows[tm].astype(np.float32), photonADU))
+                name2array, counts, int8array = g2.workerCalc(workerData)
+                results.append((dict([(nm, array.copy()) for nm, array in name2array.items()]), counts.copy()))
+            self.assertEqual(list(results[0][1]), list(results[1][1]), msg=userClass.__name__)
+            self.assertGreater(min(results[0][1]), 0, msg=userClass.__name__)
+            for nm in ['G2', 'IP', 'IF']:
+                self.assertTrue(np.allclose(results[0][0][nm], results[1][0][nm]), msg="%s %s" % (userClass.__name__, nm))
+            self.assertGreater(np.sum(results[1][0]['G2']), 0, msg=userClass.__name__)
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_viewerGatherDelayBlocks(self):
+        # gathering by blocks of delays forms the same ndarrays as gathering all the delays at once
+        mp = corAna.CommSystem.getTestingMPIObject()
+        mp.setLogger('WARNING')
+        mask = np.array([[1,1,0,1],[1,0,1,1]], np.int8)
+        mp.setMask(mask)
+        delays = [1,2,4,8,16]
+        np.random.seed(7)
+        workerArrays = [np.random.rand(len(delays), 2).astype(np.float32),
+                        np.random.rand(len(delays), 4).astype(np.float32)]
+
+        def formNDarrays(numGatherDelays, blocks):
+            xCorrBase = corAna.XCorrBase.__new__(corAna.XCorrBase)
+            xCorrBase.mp = mp
+            xCorrBase.delays = delays
+            xCorrBase.arrayNames = ['G2']
+            xCorrBase.numGatherDelays = numGatherDelays
+            xCorrBase.viewerNDarrays = {'G2':np.zeros((numGatherDelays,) + mask.shape, np.float32)}
+            xCorrBase.viewerDelayViews = {}
+            xCorrBase.viewerWorkerSegments = [(2, mp.maskedFlatIndices[0:2]), (4, mp.maskedFlatIndices[2:6])]
+            xCorrBase.gatheredFlatNDArrays = {'G2':np.zeros(numGatherDelays * 6, np.float32)}
+            delay2ndarray = {}
+            for blockStart, blockEnd in blocks:
+                # what Gatherv receives, the rows of the block from each worker in turn
+                gathered = np.concatenate([array[blockStart:blockEnd,:].flatten() for array in workerArrays])
+                xCorrBase.gatheredFlatNDArrays['G2'][0:len(gathered)] = gathered
+                for delay, ndarray in xCorrBase.viewerFormDelayNDarrays(None, blockStart, blockEnd)['G2'].items():
+                    delay2ndarray[delay] = ndarray.copy()
+            return delay2ndarray
+
+        oneShot = formNDarrays(5, [(0,5)])
+        blocked = formNDarrays(2, [(0,2), (2,4), (4,5)])
+        self.assertEqual(sorted(blocked.keys()), delays)
+        for delayIdx, delay in enumerate(delays):
+            expected = mp.maskedFlatToNdarray(np.concatenate([array[delayIdx] for array in workerArrays]))
+            self.assertTrue(np.all(oneShot[delay] == expected))
+            self.assertTrue(np.all(blocked[delay] == expected))
+
+    def test_int8Changes(self):
+        # the viewer rebuilds the int8 ndarray from the elements that changed on each worker
+        mp = corAna.CommSystem.getTestingMPIObject()
+        mp.setLogger('WARNING')
+        mask = np.array([[1,1,0,1],[1,0,1,1]], np.int8)
+        mp.setMask(mask)
+        viewer = corAna.XCorrBase.__new__(corAna.XCorrBase)
+        viewer.mp = mp
+        viewer.gatheredInt8array = np.zeros(6, np.int8)
+        viewer.viewerInt8ndarray = np.zeros(mask.shape, np.int8)
+        # two workers, with elements [0,2) and [2,6) of the masked elements
+        workers = []
+        for workerOffset in [0, 2]:
+            worker = corAna.XCorrBase.__new__(corAna.XCorrBase)
+            worker.mp = copy.copy(mp)
+            worker.mp.workerWorldRankToOffset = {mp.rank:workerOffset}
+            worker.workerSentInt8array = None
+            workers.append(worker)
+        int8arrays = [np.array([0,1], np.int8), np.array([0,0,1,0], np.int8)]
+
+        def update():
+            changedPositions = []
+            for worker, int8array in zip(workers, int8arrays):
+                positions, values = worker.workerInt8Changes(int8array)
+                viewer.gatheredInt8array[positions] = values
+                changedPositions.extend(positions)
+            return np.array(changedPositions, np.int64)
+
+        # the first update sends all the elements
+        changed = update()
+        self.assertEqual(list(changed), list(range(6)))
+        expected = mp.maskedFlatToNdarray(np.concatenate(int8arrays))
+        self.assertTrue(np.all(viewer.viewerFormInt8ndarray(changed) == expected))
+        int8arrays[1][3] = 1
+        changed = update()
+        self.assertEqual(list(changed), [5])
+        expected = mp.maskedFlatToNdarray(np.concatenate(int8arrays))
+        self.assertTrue(np.all(viewer.viewerFormInt8ndarray(changed) == expected))
+        # nothing changed
+        self.assertEqual(len(update()), 0)
+
+    def test_psmonPublisherQueue(self):
+        # no helper process, a thread queue has the same interface
+        publisher = corAna.PsmonPublisher.PsmonPublisher.__new__(corAna.PsmonPublisher.PsmonPublisher)
+        publisher.plotQueue = queue.Queue(maxsize=2)
+        publisher.numDropped = 0
+        for counter in range(3):
+            publisher.send('MULTI', counter, 3, [])
+        publisher.send('DEBUG', 10, 3, [])
+        # the oldest updates were dropped to make room
+        self.assertEqual(publisher.numDropped, 2)
+        self.assertEqual(publisher.plotQueue.qsize(), 2)
+        topic2latest, done = corAna.PsmonPublisher.takeLatest(publisher.plotQueue)
+        self.assertFalse(done)
+        self.assertEqual(sorted(topic2latest.keys()), ['DEBUG', 'MULTI'])
+        self.assertEqual(topic2latest['MULTI'][1], 2)
+        self.assertEqual(topic2latest['DEBUG'][1], 10)
+        # several updates of a topic are coalesced to the latest, and None stops the helper
+        for counter in range(2):
+            publisher.send('MULTI', 20+counter, 3, [])
+        topic2latest, done = corAna.PsmonPublisher.takeLatest(publisher.plotQueue)
+        self.assertEqual(list(topic2latest.keys()), ['MULTI'])
+        self.assertEqual(topic2latest['MULTI'][1], 21)
+        publisher.plotQueue.put(('MULTI', 30, 3, []))
+        publisher.plotQueue.put(None)
+        topic2latest, done = corAna.PsmonPublisher.takeLatest(publisher.plotQueue)
+        self.assertTrue(done)
+        self.assertEqual(topic2latest['MULTI'][1], 30)
+
+    def test_viewerDelayBlocks(self):
+        for numDelays, numViewers, viewerDelayBlock in [(7,2,3), (7,2,0), (10,3,2), (5,5,0), (12,1,5)]:
+            numGatherDelays, blocks = corAna.viewerDelayBlocks(numDelays, numViewers, viewerDelayBlock)
+            self.assertEqual(len(blocks), numViewers)
+            # each delay once, in order, the first viewer has the first delays
+            allBlocks = [block for viewerBlocks in blocks for block in viewerBlocks]
+            delays = [delay for blockStart, blockEnd in allBlocks for delay in range(blockStart, blockEnd)]
+            self.assertEqual(delays, list(range(numDelays)))
+            for viewerBlocks in blocks:
+                self.assertGreater(len(viewerBlocks), 0)
+                for blockStart, blockEnd in viewerBlocks:
+                    self.assertGreater(blockEnd, blockStart)
+                    self.assertLessEqual(blockEnd - blockStart, numGatherDelays)
+                    if viewerDelayBlock > 0:
+                        self.assertLessEqual(blockEnd - blockStart, viewerDelayBlock)
+            # the viewers have as even a share of the delays as can be
+            viewerNumDelays = [sum([blockEnd - blockStart for blockStart, blockEnd in viewerBlocks]) for viewerBlocks in blocks]
+            self.assertLessEqual(max(viewerNumDelays) - min(viewerNumDelays), 1)
+        numGatherDelays, blocks = corAna.viewerDelayBlocks(7, 2, 3)
+        self.assertEqual(numGatherDelays, 3)
+        self.assertEqual(blocks, [[(0,3),(3,4)], [(4,7)]])
+
+    def test_viewersH5Output(self):
+        # with several viewers, each helper viewer writes its own file, linked from h5output
+        class ViewersComm(object):
+            def bcast(self, msg, root):
+                if msg is not None:
+                    self.msg = msg
+                return self.msg
+
+        tempDir = tempfile.mkdtemp()
+        h5output = os.path.join(tempDir, 'g2calc.h5')
+        system_params = {'h5output':h5output, 'overwrite':False, 'delays':[1,2]}
+        mp = corAna.CommSystem.getTestingMPIObject()
+        mp.setLogger('WARNING')
+        mp.setMask(np.ones((2,2), np.int8))
+        mp.numViewers = 2
+        mp.viewersComm = ViewersComm()
+        helperMp = copy.copy(mp)
+        helperMp.isViewer = False
+        helperMp.isHelperViewer = True
+        helperMp.viewerIndex = 1
+        viewers = []
+        # the first viewer picks the name and broadcasts it first
+        for viewerMp in [mp, helperMp]:
+            viewer = corAna.XCorrBase.__new__(corAna.XCorrBase)
+            viewer.mp = viewerMp
+            viewer.numViewers = 2
+            viewer.system_params = system_params
+            viewer.user_params = {}
+            viewer.userObj = object()
+            viewer.h5parallel = False
+            viewer.logger = mp.logger
+            viewer.viewerInitH5Output()
+            viewers.append(viewer)
+        self.assertEqual(viewers[1].h5output, os.path.join(tempDir, 'g2calc_viewer1.h5'))
+        self.assertEqual(corAna.viewerH5Name(h5output, 1), viewers[1].h5output)
+        self.assertIsNone(viewers[1].h5GroupFramework)
+        viewers[1].h5GroupUser.create_group('helperResults')
+        for viewer in viewers:
+            viewer.shutdown_viewer()
+        h5file = h5py.File(h5output, 'r')
+        self.assertIn('system_params', h5file['system'])
+        self.assertIn('user', h5file)
+        # the link to the helper viewers file
+        self.assertIn('helperResults', h5file['viewer1/user'])
+        self.assertNotIn('system', h5file['viewer1'])
+        h5file.close()
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_helperViewerUpdateMessage(self):
+        # the UPDATE message the first viewer broadcasts reproduces its int8 array on a helper viewer
+        class ViewersComm(object):
+            def __init__(self):
+                self.messages = []
+            def bcast(self, msg, root):
+                if msg is not None:
+                    # what mpi4py does to send a python object
+                    self.messages.append(pickle.loads(pickle.dumps(msg)))
+                    return msg
+                return self.messages.pop(0)
+
+        viewersComm = ViewersComm()
+        mp = corAna.CommSystem.getTestingMPIObject()
+        mp.setLogger('WARNING')
+        mp.numViewers = 2
+        mp.viewersComm = viewersComm
+        helperMp = copy.copy(mp)
+        helperMp.isViewer = False
+        helperMp.isHelperViewer = True
+        helperMp.viewerIndex = 1
+
+        first = corAna.XCorrBase.__new__(corAna.XCorrBase)
+        first.mp = mp
+        first.numViewers = 2
+        first.gatheredInt8array = np.array([0,1,0,1,1,0], np.int8)
+        helper = corAna.XCorrBase.__new__(corAna.XCorrBase)
+        helper.mp = helperMp
+        helper.numViewers = 2
+        helper.gatheredInt8array = np.array([0,0,0,1,0,0], np.int8)
+        published = []
+        helper.viewerGatherAndPublishDelays = lambda lastTime, counts, int8changed: \
+            published.append((lastTime, counts, list(int8changed)))
+        helper.viewersMergeDelayResults = lambda : published.append('merge')
+        helper.shutdown_viewer = lambda : published.append('shutdown')
+
+        lastTime = {'sec':10, 'nsec':20, 'fiducials':30, 'counter':40}
+        counts = np.array([5,4,3], np.int64)
+        int8changed = np.array([1,4], np.int64)
+        first.viewerInformHelpers(('UPDATE', lastTime, counts, int8changed, first.gatheredInt8array[int8changed]))
+        first.viewerInformHelpers(('END',))
+        self.assertEqual(len(viewersComm.messages), 2)
+
+        runHelperViewer = corAna.RunHelperViewer(viewersComm, helper, mp.logger)
+        runHelperViewer.run()
+        self.assertTrue(np.all(helper.gatheredInt8array == first.gatheredInt8array))
+        self.assertEqual(len(published), 3)
+        self.assertEqual(published[0][0], lastTime)
+        self.assertEqual(list(published[0][1]), list(counts))
+        self.assertEqual(published[0][2], [1,4])
+        self.assertEqual(published[1:], ['merge', 'shutdown'])
+
+        # helpers are not told anything when there is one viewer
+        first.numViewers = 1
+        first.viewerInformHelpers(('END',))
+        self.assertEqual(len(viewersComm.messages), 0)
+
+    def test_workersH5Name(self):
+        self.assertEqual(corAna.workersH5Name('/a/b/g2_run10.h5'), '/a/b/g2_run10_workers.h5')
+        self.assertEqual(corAna.workersH5Name('g2'), 'g2_workers')
+
+    def test_workerH5Arrays(self):
+        g2 = UserG2.G2atEnd.__new__(UserG2.G2atEnd)
+        g2._arrayNames = ['G2','IF','IP']
+        counts = np.array([2,0,4], np.int64)
+        name2array = dict([(nm, np.arange(6, dtype=np.float32).reshape(3,2) + idx) for idx, nm in enumerate(g2._arrayNames)])
+        h5Arrays = g2.workerH5Arrays(name2array, counts)
+        for idx, nm in enumerate(g2._arrayNames):
+            original = np.arange(6, dtype=np.float32).reshape(3,2) + idx
+            # the arrays workerCalc returned are not modified
+            self.assertTrue(np.all(name2array[nm] == original))
+            # divided by the delay counts, a delay with 0 counts is left as is
+            self.assertTrue(np.allclose(h5Arrays[nm][0], original[0] / 2.0))
+            self.assertTrue(np.allclose(h5Arrays[nm][1], original[1]))
+            self.assertTrue(np.allclose(h5Arrays[nm][2], original[2] / 4.0))
+
+    def test_workerWriteH5Parallel(self):
+        # two workers write their elements of each update to the shared file. Without an MPI-IO
+        # h5py, they take turns writing to a serial file
+        class UserObj(object):
+            def workerH5Arrays(self, name2array, counts):
+                return dict([(nm, 10 * array) for nm, array in name2array.items()])
+
+        mp = corAna.CommSystem.getTestingMPIObject()
+        mp.setLogger('WARNING')
+        mask = np.array([[1,1,0,1],[1,0,1,1]], np.int8)
+        mp.setMask(mask)
+        arrayNames = ['A', 'B']
+        numDelays = 3
+        workers = []
+        for workerOffset, workerCount in [(0,2), (2,4)]:
+            worker = corAna.XCorrBase.__new__(corAna.XCorrBase)
+            worker.mp = copy.copy(mp)
+            worker.mp.isFirstWorker = workerOffset == 0
+            worker.mp.workerWorldRankToOffset = {mp.rank:workerOffset}
+            worker.mp.workerWorldRankToCount = {mp.rank:workerCount}
+            worker.userObj = UserObj()
+            worker.arrayNames = arrayNames
+            worker.numDelays = numDelays
+            worker.countsShape = (numDelays,)
+            worker.totalMaskedElements = 6
+            worker.workerBusyTime = 0.0
+            workers.append(worker)
+        tempDir = tempfile.mkdtemp()
+        h5filename = os.path.join(tempDir, 'workers.h5')
+        h5file = h5py.File(h5filename, 'w')
+        workers[0].workerCreateH5ParallelDatasets(h5file)
+        workers[1].h5parallelUpdate = 0
+
+        def workerArrays(workerOffset, workerCount, update):
+            return dict([(nm, np.ones((numDelays, workerCount), np.float32) * (update + 1) * (idx + 1) + \
+                          np.arange(workerOffset, workerOffset + workerCount)) \
+                         for idx, nm in enumerate(arrayNames)])
+
+        for update, counter in enumerate([100, 250]):
+            counts = np.array([update + 1, update + 2, update + 3], np.int64)
+            for worker in workers:
+                worker.h5parallelFile = h5file
+                offset = worker.mp.workerWorldRankToOffset[mp.rank]
+                count = worker.mp.workerWorldRankToCount[mp.rank]
+                worker.workerWriteH5Parallel(counter, workerArrays(offset, count, update), counts)
+        h5file.close()
+
+        h5file = h5py.File(h5filename, 'r')
+        self.assertEqual(list(h5file['system/maskedFlatIndices'][:]), list(mp.maskedFlatIndices))
+        self.assertEqual(list(h5file['system/ndarrayShape'][:]), [2,4])
+        self.assertEqual(list(h5file['counter'][:]), [100, 250])
+        self.assertEqual(h5file['delay_counts'][:].tolist(), [[1,2,3], [2,3,4]])
+        for nm in arrayNames:
+            self.assertEqual(h5file[nm].shape, (2, numDelays, 6))
+            for update in range(2):
+                expected = np.concatenate([workerArrays(0, 2, update)[nm], workerArrays(2, 4, update)[nm]], axis=1)
+                self.assertTrue(np.allclose(h5file[nm][update], 10 * expected))
+        h5file.close()
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_accumulatorHistoryNeeded(self):
+        # storing only workerHistoryNeeded times gives the same G2 as storing all of them
+        tempDir = tempfile.mkdtemp()
+        mask = np.ones((2,4), np.int8)
+        color = [[1,1,2,2],[1,1,2,2]]
+        fineColor = [[1,2,3,4],[1,2,3,4]]
+        numTimes = 600
+        system_params = {'delays':[1,2,5,10,30], 'times':numTimes}
+        # times with gaps, and some arriving late, but within HISTORY_MARGIN
+        times = [tm for tm in range(1, 500) if tm % 7 != 3]
+        for idx in range(10, len(times) - 60, 100):
+            times[idx], times[idx + 50] = times[idx + 50], times[idx]
+        np.random.seed(11)
+        data = dict([(tm, np.random.rand(8).astype(np.float32)) for tm in times])
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+        results = []
+        for useHistoryNeeded in [False, True]:
+            g2 = makeTestG2(tempDir, UserG2.G2IncrementalAccumulator, system_params, mask, color, fineColor)
+            g2.workerInit(8)
+            workerNumTimes = numTimes
+            if useHistoryNeeded:
+                workerNumTimes = g2.workerHistoryNeeded()
+                self.assertEqual(workerNumTimes, 30 + 1 + UserG2.G2IncrementalAccumulator.HISTORY_MARGIN)
+            workerData = corAna.WorkerData(logger, True, workerNumTimes, 8, addRemoveCallbackObject=g2)
+            for tm in times:
+                workerData.addData(tm, data[tm])
+            name2array, counts, int8array = g2.workerCalc(workerData)
+            results.append((dict([(nm, array.copy()) for nm, array in name2array.items()]), counts.copy()))
+        self.assertEqual(list(results[0][1]), list(results[1][1]))
+        self.assertGreater(min(results[0][1]), 0)
+        for nm in ['G2', 'IF', 'IP']:
+            self.assertTrue(np.allclose(results[0][0][nm], results[1][0][nm]))
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_timeParallelSameAsDense(self):
+        # G2atEnd summed over the time parallel workers is the same as one worker with all the times,
+        # while the counters span no more than times. After that, when every counter is stored, it is
+        # the same as one worker with the last numWorkers*ceil(times/numWorkers) times
+        tempDir = tempfile.mkdtemp()
+        mask = np.ones((2,4), np.int8)
+        color = [[1,1,2,2],[1,1,2,2]]
+        fineColor = [[1,2,3,4],[1,2,3,4]]
+        numTimes = 40
+        delays = [1,2,3,7]
+        numWorkers = 3
+        blockCounters = int(math.ceil(numTimes / float(numWorkers)))
+        halo = max(delays)
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+        # some counters are missing, they are filtered or dropped events
+        spanTimes = [counter for counter in range(5, 5 + numTimes) if counter % 6 != 1]
+        for counters, denseTimes in [(spanTimes, numTimes),
+                                     (list(range(5, 200)), numWorkers * blockCounters)]:
+            np.random.seed(3)
+            data = dict([(counter, np.random.rand(8).astype(np.float32)) for counter in counters])
+
+            dense = makeTestG2(tempDir, UserG2.G2atEnd, {'delays':delays, 'times':denseTimes}, mask, color, fineColor)
+            dense.workerInit(8)
+            denseData = corAna.WorkerData(logger, True, denseTimes, 8)
+            workers = []
+            for workerIdx in range(numWorkers):
+                g2 = makeTestG2(tempDir, UserG2.G2atEnd, {'delays':delays, 'times':numTimes, 'timeParallel':True},
+                                mask, color, fineColor)
+                g2.workerInit(8)
+                workerData = corAna.WorkerData(logger, workerIdx == 0, min(numTimes, blockCounters + halo), 8)
+                workerData.setTimeOwner(blockCounters, numWorkers, workerIdx)
+                workers.append((g2, workerData))
+            for counter in counters:
+                denseData.addData(counter, data[counter])
+                for owner in corAna.timeBlockOwners(counter, blockCounters, numWorkers, halo):
+                    workers[owner][1].addData(counter, data[counter])
+
+            denseName2array, denseCounts, denseInt8array = dense.workerCalc(denseData)
+            self.assertGreater(min(denseCounts), 0)
+            summedCounts = np.zeros(len(delays), np.int64)
+            summed = dict([(nm, np.zeros((len(delays), 8), np.float64)) for nm in ['G2', 'IF', 'IP']])
+            for g2, workerData in workers:
+                name2array, counts, int8array = g2.workerCalc(workerData)
+                summedCounts += counts
+                for nm in summed:
+                    summed[nm] += name2array[nm]
+            self.assertEqual(list(summedCounts), list(denseCounts), msg="denseTimes=%d" % denseTimes)
+            for nm in summed:
+                self.assertTrue(np.allclose(summed[nm], denseName2array[nm], rtol=1e-5), msg="denseTimes=%d %s" % (denseTimes, nm))
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_delayGroupsColorLabels(self):
+        # every worker in a pixel group gets the color labels of the pixels of the group
+        tempDir = tempfile.mkdtemp()
+        mask = np.ones((2,4), np.int8)
+        color = [[1,1,2,2],[3,3,4,4]]
+        fineColor = [[1,2,3,4],[5,6,7,8]]
+        g2 = makeTestG2(tempDir, UserG2.G2atEnd, {'delays':[1,2], 'times':10, 'workerReduce':True},
+                        mask, color, fineColor)
+        mp = copy.copy(g2.mp)
+        mp.workerRanks = [10,11,12,13]
+        mp.numWorkers = 4
+        mp.setMask(mask, delayGroups=2)
+        g2.mp = mp
+        mp.rank = 10
+        g2.workerInit(4)
+        for rank, expectedColor in [(10, [1,1,2,2]), (11, [1,1,2,2]), (12, [3,3,4,4]), (13, [3,3,4,4])]:
+            mp.rank = rank
+            g2.workerSetColorLabels()
+            self.assertEqual(list(g2.workerColor), expectedColor)
+        self.assertEqual(list(g2.workerFineColor), [5,6,7,8])
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_delayGroupsSameAsAllDelays(self):
+        # the delay groups each compute a subset of the delays, summed over the groups, and by
+        # workerReduceDelayGroups, they are the same as computing all the delays
+        class PixelGroupComm(object):
+            '''the workers of a pixel group, called one after the other. workerReduceDelayGroups
+            returns its receive buffers without reading them, they are filled in by finish.
+            '''
+            def __init__(self):
+                self.collectives = []
+
+            def member(self, rank):
+                group = self
+                class MemberComm(object):
+                    def __init__(self):
+                        self.numCalls = 0
+                    def Get_rank(self):
+                        return rank
+                    def Allreduce(self, sendbuf, recvbuf, op):
+                        group.contribute(rank, self.numCalls, sendbuf[0], recvbuf[0], op)
+                        self.numCalls += 1
+                    def Reduce(self, sendbuf, recvbuf, op, root):
+                        group.contribute(rank, self.numCalls, sendbuf[0], None if recvbuf is None else recvbuf[0], op)
+                        self.numCalls += 1
+                return MemberComm()
+
+            def contribute(self, rank, callIdx, sendArray, recvArray, op):
+                # the members make the same collective calls in the same order
+                if rank == 0:
+                    self.collectives.append({'op':op, 'sent':[], 'recv':[]})
+                collective = self.collectives[callIdx]
+                collective['sent'].append(sendArray.copy())
+                if recvArray is not None:
+                    collective['recv'].append(recvArray)
+
+            def finish(self):
+                for collective in self.collectives:
+                    combine = np.sum if collective['op'] == MPI.SUM else np.max
+                    for recvArray in collective['recv']:
+                        recvArray[:] = combine(np.array(collective['sent']), axis=0)
+
+        tempDir = tempfile.mkdtemp()
+        mask = np.ones((2,4), np.int8)
+        color = [[1,1,2,2],[1,1,2,2]]
+        fineColor = [[1,2,3,4],[1,2,3,4]]
+        delays = [1,2,3,5,8]
+        numTimes = 30
+        delayGroups = 2
+        np.random.seed(5)
+        data = dict([(tm, np.random.rand(8).astype(np.float32)) for tm in range(1, numTimes + 1) if tm % 5 != 2])
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+
+        for userClass in [UserG2.G2atEnd, UserG2.G2IncrementalAccumulator]:
+            system_params = {'delays':delays, 'times':numTimes}
+            results = []
+            for delayIndices in [None] + [corAna.delayGroupIndices(len(delays), delayGroups, delayGroup)
+                                          for delayGroup in range(delayGroups)]:
+                g2 = makeTestG2(tempDir, userClass, system_params, mask, color, fineColor)
+                g2.workerInit(8)
+                if delayIndices is not None:
+                    g2.workerSetDelayIndices(delayIndices)
+                workerData = corAna.WorkerData(logger, True, numTimes, 8, addRemoveCallbackObject=g2)
+                for tm in sorted(data.keys()):
+                    workerData.addData(tm, data[tm].copy())
+                name2array, counts, int8array = g2.workerCalc(workerData)
+                results.append((dict([(nm, array.copy()) for nm, array in name2array.items()]), counts.copy(), int8array.copy()))
+            allDelays = results[0]
+            groupResults = results[1:]
+            self.assertGreater(min(allDelays[1]), 0)
+            for delayGroup, (name2array, counts, int8array) in enumerate(groupResults):
+                # each group only has its delays
+                delayIndices = corAna.delayGroupIndices(len(delays), delayGroups, delayGroup)
+                self.assertEqual(list(np.flatnonzero(counts)), delayIndices)
+
+            reduced = []
+            pixelGroupComm = PixelGroupComm()
+            for delayGroup in range(delayGroups):
+                xCorrBase = corAna.XCorrBase.__new__(corAna.XCorrBase)
+                xCorrBase.arrayNames = ['G2', 'IF', 'IP']
+                xCorrBase.workerPixelGroupComm = pixelGroupComm.member(delayGroup)
+                reduced.append(xCorrBase.workerReduceDelayGroups(*groupResults[delayGroup]))
+            pixelGroupComm.finish()
+
+            firstName2array, firstCounts, firstInt8array = reduced[0]
+            for nm in ['G2', 'IF', 'IP']:
+                self.assertTrue(np.allclose(firstName2array[nm], allDelays[0][nm], rtol=1e-5))
+                self.assertTrue(np.allclose(sum([name2array[nm] for name2array, counts, int8array in groupResults]),
+                                            allDelays[0][nm], rtol=1e-5))
+            self.assertEqual(list(firstCounts), list(allDelays[1]))
+            self.assertEqual(list(firstInt8array), list(allDelays[2]))
+            # the other workers in the group send nothing to the viewer, but get the counts
+            otherName2array, otherCounts, otherInt8array = reduced[1]
+            self.assertEqual(otherName2array['G2'].shape, (len(delays), 0))
+            self.assertEqual(len(otherInt8array), 0)
+            self.assertEqual(list(otherCounts), list(allDelays[1]))
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
+    def test_multiAnalysisPsmon(self):
+        # each UserG2 analysis in a list publishes to its own topics
+        tempDir = tempfile.mkdtemp()
+        mask = np.ones((2,4), np.int8)
+        color = [[1,1,2,2],[1,1,2,2]]
+        fineColor = [[1,2,3,4],[1,2,3,4]]
+        system_params = {'delays':[1,2], 'times':10}
+        user_params, mp = makeTestG2Params(tempDir, mask, color, fineColor)
+        multi = corAna.MultiAnalysis([UserG2.G2atEnd, UserG2.G2IncrementalAccumulator], user_params,
+                                     system_params, mp, False)
+        self.assertEqual([analysis.plotTopic('MULTI') for analysis in multi.analyses],
+                         ['G2atEnd_MULTI', 'G2IncrementalAccumulator_MULTI'])
+        self.assertEqual(multi.analyses[1].plotTopic('DEBUG'), 'G2IncrementalAccumulator_DEBUG')
+        g2 = makeTestG2(tempDir, UserG2.G2atEnd, system_params, mask, color, fineColor)
+        self.assertEqual(g2.plotTopic('MULTI'), 'MULTI')
+
+        # psmon is initialized, or the publishing process started, once, and closed by the last user
+        class Recorder(object):
+            def __init__(self):
+                self.numInit = 0
+                self.numClosed = 0
+                self.numDropped = 0
+            def init(self):
+                self.numInit += 1
+            def __call__(self):
+                self.numInit += 1
+                return self
+            def close(self):
+                self.numClosed += 1
+        origPsmonPublish = UserG2.psmonPublish
+        origPublisher = corAna.PsmonPublisher.PsmonPublisher
+        try:
+            for usePublisherProcess in [False, True]:
+                recorder = Recorder()
+                UserG2.psmonPublish = recorder
+                corAna.PsmonPublisher.PsmonPublisher = recorder
+                publishers = [UserG2.startPsmon(usePublisherProcess) for idx in range(3)]
+                self.assertEqual(recorder.numInit, 1)
+                if usePublisherProcess:
+                    self.assertTrue(all([publisher is recorder for publisher in publishers]))
+                else:
+                    self.assertEqual(publishers, [None, None, None])
+                self.assertIsNone(UserG2.stopPsmon())
+                self.assertIsNone(UserG2.stopPsmon())
+                self.assertEqual(recorder.numClosed, 0)
+                lastPublisher = UserG2.stopPsmon()
+                if usePublisherProcess:
+                    self.assertIs(lastPublisher, recorder)
+                    self.assertEqual(recorder.numClosed, 1)
+                else:
+                    self.assertIsNone(lastPublisher)
+        finally:
+            UserG2.psmonPublish = origPsmonPublish
+            corAna.PsmonPublisher.PsmonPublisher = origPublisher
+        if not NOCLEAN:
+            shutil.rmtree(tempDir)
+
 if __name__ == "__main__":
     unittest.main(argv=[sys.argv[0], '-v'])
 
@@ -2,6 +2,9 @@
 #   Test script for ParCorAna
 
 import sys
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
 import ParCorAna as corAna
@@ -96,6 +99,101 @@ class WorkerDataNoCallback( unittest.TestCase ):
 
         self.assertEqual(len(self.workerData.timesForStoredData()),0)
 
+    def test_restoreData(self):
+        '''checkpoint a WorkerData that has wrapped around, restore it in a new one, and add
+        more data to both.
+        '''
+        def mkArray(x):
+            a=np.zeros(1,dtype=np.float32)
+            a[0]=x
+            return a
+        for tm in [3,1,2,5,4,8,7,9]:
+            self.workerData.addData(tm, mkArray(tm))
+        times, Xrows = self.workerData.storedTimesAndData()
+        self.assertEqual(list(times), [4,5,7,8,9])
+        self.assertEqual(list(Xrows[:,0]), [4,5,7,8,9])
+
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+        restored = corAna.WorkerData(logger, True, self.numTimes, 1, addRemoveCallbackObject = None)
+        restored.restoreData(times, Xrows)
+        self.assertTrue(restored.filledX())
+        self.assertEqual(restored.timesForStoredData(), [4,5,7,8,9])
+        for tm in [11,10,12]:
+            self.workerData.addData(tm, mkArray(tm))
+            restored.addData(tm, mkArray(tm))
+        self.assertEqual(restored.timesForStoredData(), self.workerData.timesForStoredData())
+        for tm in restored.timesForStoredData():
+            self.assertEqual(restored.X[restored.tm2idx(tm),0], tm)
+
+    def test_storeDirAndTimeBlocks(self):
+        '''X in a memmap file, tms2idx and timeBlocks agree with tm2idx and timesDataIndexes
+        '''
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+        storeDir = tempfile.mkdtemp()
+        workerData = corAna.WorkerData(logger, True, self.numTimes, 2, addRemoveCallbackObject = None,
+                                       storeDir=storeDir)
+        self.assertTrue(isinstance(workerData.X, np.memmap))
+        self.assertEqual(os.listdir(storeDir), [])
+        for tm in [3,1,2,5,4,8,7,9,11]:
+            workerData.addData(tm, np.array([tm, -tm], np.float32))
+        tms = [4,5,6,7,8,9,10,11,12]
+        xInds = workerData.tms2idx(tms)
+        for tm, xInd in zip(tms, xInds):
+            if workerData.tm2idx(tm) is None:
+                self.assertEqual(xInd, corAna.WorkerData.INVALID_INDEX)
+            else:
+                self.assertEqual(xInd, workerData.tm2idx(tm))
+                self.assertEqual(workerData.X[xInd,1], -tm)
+        blocks = list(workerData.timeBlocks(2))
+        self.assertEqual([len(blockTimes) for blockTimes, blockXInds in blocks], [2,2,1])
+        self.assertEqual(list(zip(np.concatenate([blockTimes for blockTimes, blockXInds in blocks]),
+                                  np.concatenate([blockXInds for blockTimes, blockXInds in blocks]))),
+                         list(workerData.timesDataIndexes()))
+        shutil.rmtree(storeDir)
+
+    def test_sparseWorkerData(self):
+        '''sparse rows are kept in the same ring of times as the dense rows
+        '''
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+        denseData = corAna.WorkerData(logger, True, self.numTimes, 4, addRemoveCallbackObject = None)
+        sparseData = corAna.SparseWorkerData(logger, True, self.numTimes, 4, addRemoveCallbackObject = None)
+        for tm in [3,1,2,5,4,8,7,9,11]:
+            row = np.zeros(4, np.float32)
+            row[tm % 4] = tm
+            denseData.addData(tm, row)
+            sparseData.addData(tm, (np.array([tm % 4]), np.array([tm])))
+        self.assertTrue(sparseData.sparse)
+        self.assertEqual(list(denseData.timesDataIndexes()), list(sparseData.timesDataIndexes()))
+        for tm, xInd in sparseData.timesDataIndexes():
+            self.assertTrue(np.all(sparseData.denseRow(xInd) == denseData.X[xInd,:]))
+        self.assertEqual(sparseData.numPhotonsStored(), self.numTimes)
+        xInds = [xInd for tm, xInd in sparseData.timesDataIndexes()][0:3]
+        pixels, photons, rows = sparseData.concatenatedRows(xInds)
+        self.assertEqual(list(rows), [0,1,2])
+        self.assertEqual(list(pixels), [sparseData.pixels[xInd][0] for xInd in xInds])
+        self.assertEqual(list(photons), [sparseData.photons[xInd][0] for xInd in xInds])
+        self.assertRaises(Exception, sparseData.storedTimesAndData)
+        self.assertRaises(Exception, sparseData.setPixelData, denseData.X)
+
+    def test_pixelLayout(self):
+        '''pixel layout with buffered inserts stores the same data as the time layout
+        '''
+        logger = corAna.makeLogger(isTestMode=True,isMaster=True,isViewer=True,isServer=True,rank=0)
+        timeData = corAna.WorkerData(logger, True, self.numTimes, 3, addRemoveCallbackObject = None)
+        pixelData = corAna.WorkerData(logger, True, self.numTimes, 3, addRemoveCallbackObject = None,
+                                      layout='pixel', insertBlock=2)
+        for tm in [3,1,2,5,4,8,7,9,11]:
+            row = np.array([tm, -tm, 2*tm], np.float32)
+            timeData.addData(tm, row)
+            pixelData.addData(tm, row)
+        pixelData.flush()
+        self.assertTrue(pixelData.pixelSeries().flags['C_CONTIGUOUS'])
+        timeTimes, timeRows = timeData.storedTimesAndData()
+        pixelTimes, pixelRows = pixelData.storedTimesAndData()
+        self.assertEqual(list(timeTimes), list(pixelTimes))
+        self.assertTrue(np.all(timeRows == pixelRows))
+        self.assertTrue(np.all(pixelData.pixelSeries().T == pixelData.X))
+
     def test_addDataOutOfOrder(self):
         tms = [20,19,10,13,18]
 